@@ -31,6 +31,9 @@ __download__ = 'https://www.github.com/ChristophKirst/ClearMap2'
 
 import os
 import collections 
+import hashlib
+import multiprocessing as mp
+import concurrent.futures
 
 import json
 
@@ -42,6 +45,8 @@ import ClearMap.Settings
 import ClearMap.Settings as settings
 
 import ClearMap.IO.IO as clearmap_io
+import ClearMap.IO.MMP as mmp
+import ClearMap.IO.CellTable as cell_table
 import ClearMap.IO.FileUtils as fu
 
 import ClearMap.Alignment.Resampling as res
@@ -58,9 +63,11 @@ from skimage import io
 # ## Atlas Structures
 ###############################################################################
 
+atlas_component_names = ('annotation', 'hemispheres', 'reference', 'distance_to_surface')
+
+
 def decompress_atlases(atlas_base_name):
     paths = []
-    atlas_component_names = ('annotation', 'hemispheres', 'reference', 'distance_to_surface')
     for atlas_type in atlas_component_names:
         f_path = os.path.join(settings.atlas_folder, f'{atlas_base_name}_{atlas_type}.tif')
         fu.uncompress(f_path, extension='zip')
@@ -78,8 +85,22 @@ Note
   isotropic resolution.
 """
 
-default_annotation_file, default_hemispheres_file,\
-default_reference_file, default_distance_to_surface_file = decompress_atlases(atlas_base_name)
+_default_atlas_files = None
+
+
+def default_atlas_file(atlas_type):
+    """The default atlas file of the given component, decompressed on first use.
+
+    Note
+    ----
+      The module attributes default_annotation_file, default_hemispheres_file,
+      default_reference_file and default_distance_to_surface_file resolve to
+      these files, so that importing this module does not decompress the atlases.
+    """
+    global _default_atlas_files
+    if _default_atlas_files is None:
+        _default_atlas_files = dict(zip(atlas_component_names, decompress_atlases(atlas_base_name)))
+    return _default_atlas_files[atlas_type]
 
 default_label_file = os.path.join(settings.atlas_folder, 'ABA_annotation.json')
 
@@ -110,6 +131,121 @@ Note
 """
 
 
+def _cache_is_valid(cache_file, source_file):
+    return os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(source_file)
+
+
+def load_atlas(annotation_file, cache=True):
+    """Load an annotation volume as a read only memory map.
+
+    Arguments
+    ---------
+    annotation_file : str
+        The annotation volume file.
+    cache : bool
+        If True, store the volume uncompressed in its native integer type
+        next to the annotation file and memory map it, so that processes
+        share the pages instead of holding private copies.
+
+    Returns
+    -------
+    atlas : array
+        The annotation volume.
+    """
+    cache_file = os.path.splitext(annotation_file)[0] + '_cache.npy'
+    if cache and _cache_is_valid(cache_file, annotation_file):
+        return np.load(cache_file, mmap_mode='r')
+
+    atlas = np.asarray(clearmap_io.read(annotation_file))
+    if atlas.dtype.kind == 'f':
+        atlas = atlas.astype(int)
+    if cache:
+        try:
+            np.save(cache_file, atlas)
+            return np.load(cache_file, mmap_mode='r')
+        except OSError:
+            pass
+    return atlas
+
+
+def load_label_tree(label_file, cache=True):
+    """Load the label tree from a json file.
+
+    Arguments
+    ---------
+    label_file : str
+        File with label information in json format.
+    cache : bool
+        If True, store the tree as flat arrays in pre-order next to the json
+        file and rebuild it from these on subsequent calls.
+
+    Returns
+    -------
+    root : Label
+        The root of the label tree.
+    """
+    cache_file = os.path.splitext(label_file)[0] + '_cache.npz'
+    if cache and _cache_is_valid(cache_file, label_file):
+        with np.load(cache_file) as flat:
+            return _flat_to_tree(flat)
+
+    with open(label_file, 'r') as file_in:
+        aba = json.load(file_in)
+    root = _json_to_tree(aba['msg'][0])
+    if cache:
+        try:
+            np.savez(cache_file, **_tree_to_flat(root))
+        except OSError:
+            pass
+    return root
+
+
+def _json_to_tree(root, parent=None, level=0):
+    label = Label({k: v for k, v in root.items() if k != "children"}, parent=parent, level=level)
+    label.children = [_json_to_tree(c, parent=label, level=level + 1) for c in root['children']]
+    return label
+
+
+def _tree_to_flat(root):
+    """Flat pre-order arrays of the label data, parent indices and levels, None values are masked."""
+    nodes = []
+    parents = []
+    stack = [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        parents.append(parent)
+        nodes.append(node)
+        stack.extend((c, len(nodes) - 1) for c in node.children[::-1])
+
+    flat = {'__parent': np.array(parents), '__level': np.array([n.level for n in nodes])}
+    for key in nodes[0].data.keys():
+        values = [n.data.get(key) for n in nodes]
+        missing = np.array([v is None for v in values])
+        default = next((v for v in values if v is not None), 0)
+        flat[key] = np.array([default if v is None else v for v in values])
+        if np.any(missing):
+            flat['__none_' + key] = missing
+    return flat
+
+
+def _flat_to_tree(flat):
+    keys = [k for k in flat.files if not k.startswith('__')]
+    columns = {k: flat[k].tolist() for k in keys}
+    missing = {k: np.nonzero(flat['__none_' + k])[0] for k in keys if '__none_' + k in flat.files}
+    for k, m in missing.items():
+        for i in m:
+            columns[k][i] = None
+
+    nodes = []
+    for i, (parent, level) in enumerate(zip(flat['__parent'].tolist(), flat['__level'].tolist())):
+        parent = nodes[parent] if parent >= 0 else None
+        node = Label({k: columns[k][i] for k in keys}, children=[], parent=parent, level=level)
+        if parent is not None:
+            parent.children.append(node)
+        nodes.append(node)
+    return nodes[0]
+
+
 class Label(object):
     """Class holding information of an individual Atlas label."""
 
@@ -169,9 +305,435 @@ class Label(object):
         return self.__str__(ident=ident, with_children=False)
 
 
+class RegionHierarchy(object):
+    """Ancestor index of a region hierarchy for hierarchical aggregation.
+
+    The regions are enumerated in depth first pre-order (an Euler tour), so
+    that each region and all of its descendants occupy a contiguous interval
+    [start, stop) of that enumeration. Aggregating values to every ancestor
+    then reduces to differences of a single cumulative sum.
+
+    Example
+    -------
+    >>> h = RegionHierarchy(ids=[1, 2, 3, 4], parent_ids=[-1, 1, 1, 3])
+    >>> h.count([2, 4, 4, 7])
+    array([3., 1., 2., 2.])
+    """
+
+    def __init__(self, ids, parent_ids):
+        """Initialization
+
+        Arguments
+        ---------
+        ids : array
+          The ids of the regions.
+        parent_ids : array
+          The id of the parent of each region. Parents that are not in ids
+          (e.g. None, -1 or an omitted root) mark top level regions.
+        """
+        self.ids = np.asarray(ids).astype(np.int64)
+        parent_ids = np.array([-1 if p is None or p != p else p for p in parent_ids]).astype(np.int64)
+
+        self._sorter = np.argsort(self.ids, kind='stable')
+        self._sorted_ids = self.ids[self._sorter]
+
+        parents = self.index(parent_ids)
+        self.parents = parents
+
+        children = [[] for _ in range(len(self.ids))]
+        roots = []
+        for i, p in enumerate(parents):
+            if p < 0:
+                roots.append(i)
+            else:
+                children[p].append(i)
+
+        # Euler tour in pre-order
+        n = len(self.ids)
+        self.start = np.zeros(n, dtype=np.int64)
+        self.stop = np.zeros(n, dtype=np.int64)
+        self.preorder = np.zeros(n, dtype=np.int64)
+        position = 0
+        stack = [(r, False) for r in reversed(roots)]
+        while stack:
+            i, done = stack.pop()
+            if done:
+                self.stop[i] = position
+                continue
+            self.start[i] = position
+            self.preorder[position] = i
+            position += 1
+            stack.append((i, True))
+            stack.extend((c, False) for c in reversed(children[i]))
+
+    @property
+    def n_regions(self):
+        return len(self.ids)
+
+    def index(self, ids, invalid=-1):
+        """Convert region ids to region indices.
+
+        Arguments
+        ---------
+        ids : array
+          The region ids.
+        invalid : int
+          Index for ids that are not in the hierarchy.
+
+        Returns
+        -------
+        indices : array
+          The indices of the regions.
+        """
+        ids = np.asarray(ids).astype(np.int64)
+        if len(self._sorted_ids) == 0:
+            return np.full(ids.shape, invalid, dtype=np.int64)
+        pos = np.searchsorted(self._sorted_ids, ids)
+        pos[pos >= len(self._sorted_ids)] = 0
+        valid = self._sorted_ids[pos] == ids
+        return np.where(valid, self._sorter[pos], invalid)
+
+    def roll_up(self, values):
+        """Aggregate values of each region to all of its ancestors.
+
+        Arguments
+        ---------
+        values : array
+          Values of the regions of shape (n_regions,) or (n_regions, ...).
+
+        Returns
+        -------
+        totals : array
+          The sum of the values of each region and all its descendants.
+        """
+        values = np.asarray(values)
+        if values.shape[0] != self.n_regions:
+            raise ValueError(f'Expected {self.n_regions} values, found {values.shape[0]}!')
+        cumulative = np.zeros((self.n_regions + 1,) + values.shape[1:], dtype=np.result_type(values, np.int64))
+        np.cumsum(values[self.preorder], axis=0, out=cumulative[1:])
+        return cumulative[self.stop] - cumulative[self.start]
+
+    def count(self, labels, weights=None, hierarchical=True):
+        """Count (weighted) labels per region.
+
+        Arguments
+        ---------
+        labels : array
+          The region ids of the points, e.g. cells.
+        weights : array or None
+          Optional weights of the points, e.g. intensities or voxel volumes.
+        hierarchical : bool
+          If True, add the counts of all descendants to each region.
+
+        Returns
+        -------
+        counts : array
+          The counts of the regions.
+        """
+        indices = self.index(np.ravel(labels))
+        valid = indices >= 0
+        if weights is not None:
+            weights = np.ravel(weights)[valid]
+        counts = np.bincount(indices[valid], weights=weights, minlength=self.n_regions).astype(float)
+        if hierarchical:
+            counts = self.roll_up(counts)
+        return counts
+
+    def density(self, counts, volumes):
+        """Density of counts per volume, zero for empty regions."""
+        counts = np.asarray(counts, dtype=float)
+        volumes = np.asarray(volumes, dtype=float)
+        densities = np.zeros(np.broadcast(counts, volumes).shape)
+        np.divide(counts, volumes, out=densities, where=volumes != 0)
+        return densities
+
+    def __str__(self):
+        return f'RegionHierarchy({self.n_regions})'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class RegionIndex(object):
+    """Cells sorted by region in pre-order of the region hierarchy.
+
+    As each region and its descendants occupy a contiguous interval of the
+    pre-order, the cells of any sub-tree form a single contiguous slice of
+    the sorted, memory mapped cells.
+
+    Example
+    -------
+    >>> index = create_region_index('cells.table')
+    >>> cortex = index.cells(315)
+    """
+
+    def __init__(self, location):
+        """Load a region index.
+
+        Arguments
+        ---------
+        location : str
+          The index file created by :func:`create_region_index`.
+        """
+        self.location = location
+        with np.load(location) as index:
+            self.hierarchy = RegionHierarchy(index['ids'], index['parents'])
+            self.offsets = index['offsets']
+            self.key = str(index['key'])
+            self._cells_file = os.path.join(os.path.dirname(location), str(index['cells']))
+        self._cells = None
+        self._permutation = None
+
+    @property
+    def cells_file(self):
+        """The file of the sorted cells."""
+        return self._cells_file
+
+    @property
+    def sorted_cells(self):
+        """The memory mapped cells or cell table sorted by region."""
+        if self._cells is None:
+            if cell_table.is_cell_table(self._cells_file):
+                self._cells = cell_table.Table(self._cells_file)
+            else:
+                self._cells = np.load(self._cells_file, mmap_mode='r')
+        return self._cells
+
+    @property
+    def permutation(self):
+        """Original position of each sorted cell."""
+        if self._permutation is None:
+            with np.load(self.location) as index:
+                self._permutation = index['permutation']
+        return self._permutation
+
+    def region_slice(self, region_id, descendants=True):
+        """Slice of the sorted cells in a region.
+
+        Arguments
+        ---------
+        region_id : int
+          The id of the region.
+        descendants : bool
+          If True, include the cells of all descendants of the region.
+
+        Returns
+        -------
+        slicing : slice
+          The slice of the sorted cells.
+        """
+        i = self.hierarchy.index([region_id])[0]
+        if i < 0:
+            raise KeyError(region_id)
+        start = self.hierarchy.start[i]
+        stop = self.hierarchy.stop[i] if descendants else start + 1
+        return slice(int(self.offsets[start]), int(self.offsets[stop]))
+
+    def region_slices(self, region_ids, descendants=True):
+        """Merged slices of the sorted cells in a set of regions."""
+        slices = sorted((self.region_slice(r, descendants=descendants) for r in np.atleast_1d(region_ids)),
+                        key=lambda s: s.start)
+        merged = []
+        for s in slices:
+            if merged and s.start <= merged[-1].stop:
+                merged[-1] = slice(merged[-1].start, max(merged[-1].stop, s.stop))
+            elif s.stop > s.start:
+                merged.append(s)
+        return merged
+
+    def cells(self, region_ids, descendants=True, positions=False):
+        """Cells in a set of regions.
+
+        Arguments
+        ---------
+        region_ids : int or array
+          The ids of the regions.
+        descendants : bool
+          If True, include the cells of all descendants of the regions.
+        positions : bool
+          If True, also return the positions of the cells in the original cells.
+
+        Returns
+        -------
+        cells : array
+          The cells in the regions.
+        positions : array
+          The positions of the cells in the original cells.
+        """
+        slices = self.region_slices(region_ids, descendants=descendants)
+        cells = self.sorted_cells
+        if len(slices) == 1:
+            result = cells[slices[0]]
+        else:
+            result = np.concatenate([cells[s] for s in slices]) if slices else cells[:0]
+        if positions:
+            permutation = self.permutation
+            index = np.concatenate([permutation[s] for s in slices]) if slices else permutation[:0]
+            return result, index
+        return result
+
+    def counts(self, hierarchical=True):
+        """Number of cells in each region in hierarchy order."""
+        hierarchy = self.hierarchy
+        stop = hierarchy.stop if hierarchical else hierarchy.start + 1
+        return self.offsets[stop] - self.offsets[hierarchy.start]
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __str__(self):
+        return f'RegionIndex({len(self)})[{self.hierarchy.n_regions}]{{{self.location}}}'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def create_region_index(source, sink=None, key='id', hierarchy=None, chunk_size=2**20):
+    """Sort cells by region and save them together with a region index.
+
+    Arguments
+    ---------
+    source : str
+        The cell table or npy file of the cells with a column holding the
+        region ids.
+    sink : str or None
+        The index file. If None, use '<source>_regions.npz'. The sorted cells
+        are written to the same base name with the extension of the source.
+    key : str
+        The field of the cells holding the region ids.
+    hierarchy : RegionHierarchy or None
+        The region hierarchy. If None, use the one of the annotation.
+    chunk_size : int
+        Number of cells to write at once.
+
+    Returns
+    -------
+    index : RegionIndex
+        The region index.
+
+    Note
+    ----
+    Cells with labels that are not in the hierarchy are placed after all
+    regions. For cell tables only the key column is read to sort the cells.
+    """
+    if hierarchy is None:
+        hierarchy = get_annotation().hierarchy
+    source = source.rstrip(os.sep)
+    is_table = cell_table.is_cell_table(source)
+    if sink is None:
+        sink = os.path.splitext(source)[0] + '_regions.npz'
+    cells_file = os.path.splitext(sink)[0] + ('.table' if is_table else '.npy')
+
+    cells = cell_table.Table(source) if is_table else np.load(source, mmap_mode='r')
+    n = hierarchy.n_regions
+    indices = hierarchy.index(cells[key])
+    positions = np.where(indices >= 0, hierarchy.start[indices], n)
+    permutation = np.argsort(positions, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(positions, minlength=n + 1))])
+
+    if is_table:
+        cell_table.take(cells, cells_file, permutation, chunk_size=chunk_size)
+    else:
+        with mmp.Writer(cells_file, dtype=cells.dtype) as writer:
+            for start in range(0, len(permutation), chunk_size):
+                chunk = permutation[start:start + chunk_size]
+                order = np.argsort(chunk)
+                block = np.empty(len(chunk), dtype=cells.dtype)
+                block[order] = cells[chunk[order]]  # read the memory map in increasing order
+                writer.append(block)
+
+    parents = np.where(hierarchy.parents >= 0, hierarchy.ids[hierarchy.parents], -1)
+    np.savez(sink, ids=hierarchy.ids, parents=parents, offsets=offsets, permutation=permutation,
+             key=key, cells=os.path.basename(cells_file))
+
+    return RegionIndex(sink)
+
+
+class LabelMap(object):
+    """Compact conversion of labels from one key of the annotation to another.
+
+    Keys are stored sorted and looked up with np.searchsorted, so the size of
+    the map is the number of structures and not the largest label. String
+    values are stored as categorical codes into a table of distinct values.
+    Unknown labels are converted to a default value.
+    """
+
+    def __init__(self, keys, values, default=0):
+        """Label map constructor.
+
+        Arguments
+        ---------
+        keys : list
+          The key of each structure.
+        values : list
+          The value of each structure.
+        default : object
+          The value of unknown labels.
+        """
+        self.default = default
+        keys = np.asarray(keys)
+        sorter = np.argsort(keys, kind='stable')
+        self.keys = keys[sorter]
+
+        if len(values) > 0 and all(isinstance(v, str) for v in values):
+            self.categories, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+            self.codes = codes.reshape(-1)[sorter]
+            self.values = None
+        else:
+            values = np.asarray(values)
+            if values.dtype.kind not in 'biuf':
+                values = np.array(list(values) + [None], dtype=object)[:-1]
+            self.categories = None
+            self.codes = None
+            self.values = values[sorter]
+
+    @property
+    def is_categorical(self):
+        return self.categories is not None
+
+    def index(self, label, invalid=-1):
+        """Position of the labels in the sorted keys, invalid for unknown labels."""
+        label = np.asarray(label)
+        index = np.searchsorted(self.keys, label)
+        index = np.clip(index, 0, len(self.keys) - 1)
+        return np.where(self.keys[index] == label, index, invalid)
+
+    def code(self, label, invalid=-1):
+        """Categorical codes of the labels for string values, invalid for unknown labels."""
+        if not self.is_categorical:
+            raise ValueError('Label map values are not categorical!')
+        index = self.index(label)
+        return np.where(index >= 0, self.codes[index], invalid)
+
+    def __call__(self, label):
+        index = self.index(label)
+        valid = index >= 0
+        if self.is_categorical:
+            values = self.categories[self.codes[index]]
+        else:
+            values = self.values[index]
+        if not np.all(valid):
+            if values.dtype.kind == 'U' and not isinstance(self.default, str):
+                values = values.astype(object)
+            values = np.where(valid, values, self.default)
+        return values
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __str__(self):
+        return f'LabelMap({len(self)})'
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class Annotation(object):
     """Class that holds information of the annotated regions."""
 
+    max_label_maps = 32
+    """Maximal number of cached label maps."""
+
     def __init__(self, label_file=None, extra_label=None, annotation_file=None):  # FIXME: add warning if None
         """Initialization
 
@@ -192,6 +754,9 @@ class Annotation(object):
         self.extra_label = None
         self.annotation_file = None
         self.label_file = None
+        self._hierarchy = None
+        self._atlas = None
+        self._children_df = None
 
         self.dict_id_to_acronym = {}
         self.dict_id_to_name = {}
@@ -230,7 +795,7 @@ class Annotation(object):
         if label_file is None:
             label_file = default_label_file
         if annotation_file is None:
-            annotation_file = default_annotation_file
+            annotation_file = default_atlas_file('annotation')
         if extra_label is None:
             extra_label = default_extra_label
         if extra_label in ['None', '', False]:   # add nodes for missing labels
@@ -240,12 +805,11 @@ class Annotation(object):
         self.annotation_file = annotation_file
         self.extra_label = extra_label
 
-        # initialize label tree
-        with open(label_file, 'r') as file_in:
-            aba = json.load(file_in)
+        self._hierarchy = None
+        self._label_maps = collections.OrderedDict()
 
-        root = aba['msg'][0]
-        self.root = self.initialize_tree(root)
+        # initialize label tree
+        self.root = load_label_tree(label_file)
 
         # maxgraph = max(self.get_list('graph_order'))
         for a in extra_label:
@@ -287,14 +851,29 @@ class Annotation(object):
         self.dict_acronym_to_id = self.get_dict(from_='acronym', to='id')
         self.dict_name_to_id = self.get_dict(from_='name', to='id')
 
-        # import atlas
-        self.atlas = clearmap_io.read(self.annotation_file).astype(int)
-        self.children_df = create_label_table(self.label_file, save=False, from_cached=True)
+        # atlas and label table are loaded on first use
+        self._atlas = None
+        self._children_df = None
+
+    @property
+    def atlas(self):
+        """The annotation volume, memory mapped from an uncompressed cache."""
+        if self._atlas is None:
+            self._atlas = load_atlas(self.annotation_file)
+        return self._atlas
+
+    @atlas.setter
+    def atlas(self, value):
+        self._atlas = value
+
+    @property
+    def children_df(self):
+        if self._children_df is None:
+            self._children_df = create_label_table(self.label_file, save=False, from_cached=True)
+        return self._children_df
 
     def initialize_tree(self, root, parent=None, level=0):
-        label = Label({k: v for k, v in root.items() if k != "children"}, parent=parent, level=level)
-        label.children = [self.initialize_tree(c, parent=label, level=level + 1) for c in root['children']]
-        return label
+        return _json_to_tree(root, parent=parent, level=level)
 
     def get_list(self, key=None, node=None, level=None):
         if node is None:
@@ -349,6 +928,22 @@ class Annotation(object):
 
         return d
 
+    def get_label_map(self, key, value, node=None, level=None):
+        """Cached compact :class:`LabelMap` converting labels from key to value.
+
+        The least recently used maps are dropped beyond :attr:`max_label_maps` maps.
+        """
+        cache_key = (key, value, None if node is None else id(node), level)
+        label_map = self._label_maps.pop(cache_key, None)
+        if label_map is None:
+            keys = self.get_list(key=key, node=node, level=None)
+            values = self.get_list(key=value, node=node, level=level)
+            label_map = LabelMap(keys, values)
+        self._label_maps[cache_key] = label_map
+        while len(self._label_maps) > self.max_label_maps:
+            self._label_maps.popitem(last=False)
+        return label_map
+
     def get_map(self, key, value, node=None, level=None):
         d = self.get_dictionary(key=key, value=value, node=node, level=level)
 
@@ -362,11 +957,12 @@ class Annotation(object):
         nodes = self.get_list()
         for n, d in zip(nodes, data):
             n.data[name] = d
+        self._label_maps = collections.OrderedDict()
 
     def convert_label(self, label, key='order', value='graph_order', node=None, level=None, method='map'):
-        if method in ['map']:
-            m = self.get_map(key=key, value=value, node=node, level=level)
-            return m[label]
+        if method in [None, 'map']:
+            m = self.get_label_map(key=key, value=value, node=node, level=level)
+            return m(label)
         else:
             d = self.get_dictionary(key=key, value=value, node=node, level=level)
             return np.vectorize(d.__getitem__, otypes=[type(d[list(d.keys())[0]])])(label)
@@ -409,6 +1005,38 @@ class Annotation(object):
 
         return self.find(p0[level+1], key=key, value=value)
 
+    @property
+    def hierarchy(self):
+        """The :class:`RegionHierarchy` of the labels, indexed by the label order."""
+        if self._hierarchy is None:
+            self._hierarchy = RegionHierarchy(self.get_list('id'), self.get_list('parent_structure_id'))
+        return self._hierarchy
+
+    def count_labels(self, label, key='id', weights=None, hierarchical=True):
+        """Count (weighted) labels per structure.
+
+        Arguments
+        ---------
+        label : array
+            The labels, e.g. of cells or graph vertices.
+        key : str
+            The key corresponding to the label.
+        weights : array or None
+            Optional weights, e.g. intensities.
+        hierarchical : bool
+            If True, add the counts of all sub-structures to each structure.
+
+        Returns
+        -------
+        counts : array
+            The counts of all structures in label order.
+        """
+        label = np.asarray(label)
+        if key != 'id':
+            order = label if key == 'order' else self.convert_label(label, key=key, value='order')
+            label = np.asarray(self.hierarchy.ids)[np.asarray(order, dtype=int)]
+        return self.hierarchy.count(label, weights=weights, hierarchical=hierarchical)
+
     @property
     def map_volume(self):
         uniques, counts = np.unique(self.atlas, return_counts=True)
@@ -494,35 +1122,47 @@ class Annotation(object):
 ##########################################################################################
 
 
-annotation = Annotation()
-"""Information on the annotated regions"""
-
-n_structures = annotation.n_structures  # remove
-get_dictionary = annotation.get_dictionary  # remove
-get_list = annotation.get_list  # remove
-get_map = annotation.get_map  # remove
-find = annotation.find  # Find and replace
+_annotation = None
 initialized = False
 
 
+def get_annotation():
+    """Information on the annotated regions, created on first use.
+
+    Note
+    ----
+      The module attribute annotation and its aliases n_structures,
+      get_dictionary, get_list, get_map and find resolve to this instance.
+    """
+    global _annotation
+    if _annotation is None:
+        _annotation = Annotation()
+    return _annotation
+
+
+def __getattr__(name):
+    if name.startswith('default_') and name.endswith('_file') and name[8:-5] in atlas_component_names:
+        return default_atlas_file(name[8:-5])
+    if name == 'annotation':
+        return get_annotation()
+    if name in ('n_structures', 'get_dictionary', 'get_list', 'get_map', 'find'):  # remove
+        return getattr(get_annotation(), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 def initialize(label_file=None, extra_label=None, annotation_file=None):
-    global initialized, annotation, n_structures, get_dictionary, get_list, get_map, find  # FIXME: avoid global
-    annotation = Annotation(label_file=label_file, extra_label=extra_label, annotation_file=annotation_file)
-
-    n_structures = annotation.n_structures
-    get_dictionary = annotation.get_dictionary
-    get_list = annotation.get_list
-    get_map = annotation.get_map
-    find = annotation.find
+    global initialized, _annotation
+    _annotation = Annotation(label_file=label_file, extra_label=extra_label, annotation_file=annotation_file)
     initialized = True
 
 
 def set_annotation_file(annotation_file):
+    annotation = get_annotation()
     initialize(annotation_file=annotation_file, label_file=annotation.label_file, extra_label=annotation.extra_label)
 
 
 def set_label_file(label_file, extra_label=None):
-    initialize(annotation_file=annotation.annotation_file, label_file=label_file, extra_label=extra_label)
+    initialize(annotation_file=get_annotation().annotation_file, label_file=label_file, extra_label=extra_label)
 
 
 ###############################################################################
@@ -581,6 +1221,162 @@ def label_points(points, annotation_file=None, annotation_array=None, invalid=0,
     return label
 
 
+def count_points(points, weight=None, annotation_file=None, invalid=0, hierarchical=True):
+    """Count points in the annotated structures.
+
+    Arguments
+    ---------
+    points : array
+        Array of ndim point coordinates.
+    weight : array or None
+        Optional weights of the points.
+    annotation_file : str
+        File name of the atlas annotation.
+    invalid : int
+        Label for points outside the atlas, these are not counted.
+    hierarchical : bool
+        If True, add the counts of all sub-structures to each structure.
+
+    Returns
+    -------
+    counts : array
+        The counts of all structures in label order.
+    """
+    label = label_points(points, annotation_file=annotation_file, invalid=invalid, key='id')
+    return get_annotation().count_labels(label, key='id', weights=weight, hierarchical=hierarchical)
+
+
+def count_label_voxels(annotation_file, ids=None, processes=None, block_size=8, cache=True, verbose=False):
+    """Count the voxels of each label in an annotation volume.
+
+    Arguments
+    ---------
+    annotation_file : str
+        File name of the (registered) annotation volume.
+    ids : array or None
+        The label ids to count. If None, use the ids of all structures.
+    processes : int or None
+        Number of threads to process blocks of z-planes with.
+    block_size : int
+        Number of z-planes per block.
+    cache : bool
+        If True, store the counts next to the annotation file and reuse them
+        as long as the content of the file and the ids do not change.
+    verbose : bool
+        Whether to print verbose output.
+
+    Returns
+    -------
+    counts : array
+        The number of voxels of each label in ids.
+
+    Note
+    ----
+    Labels are converted to compact codes via a sorted id table and counted
+    with np.bincount in parallel blocks instead of sorting the full volume.
+    """
+    if ids is None:
+        ids = get_annotation().hierarchy.ids
+    ids = np.asarray(ids).astype(np.int64)
+    hierarchy = RegionHierarchy(ids, np.full(len(ids), -1))
+
+    if cache:
+        cache_file = os.path.splitext(annotation_file)[0] + '_voxel_counts.npz'
+        digest = hashlib.blake2b(digest_size=16)
+        with open(annotation_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**24), b''):
+                digest.update(chunk)
+        digest.update(ids.tobytes())
+        key = digest.hexdigest()
+        if os.path.isfile(cache_file):
+            cached = np.load(cache_file)
+            if str(cached['key']) == key:
+                if verbose:
+                    print(f'Using cached voxel counts: {cache_file}')
+                return cached['counts']
+
+    counts = _bincount_labels(annotation_file, hierarchy, processes=processes, block_size=block_size)
+    counts = np.asarray(np.round(counts), dtype=np.int64)
+
+    if cache:
+        np.savez(cache_file, key=key, counts=counts)
+        if verbose:
+            print(f'Cached voxel counts: {cache_file}')
+
+    return counts
+
+
+def label_volumes(annotation_file, jacobian=None, ids=None, voxel_volume=1.0, processes=None, block_size=8, verbose=False):
+    """Volumes of labels in an annotation volume.
+
+    Arguments
+    ---------
+    annotation_file : str
+        File name of the annotation volume, e.g. the atlas annotation.
+    jacobian : str or None
+        File with the determinant of the Jacobian of a transformation on the
+        grid of the annotation. If None, voxels are counted.
+    ids : array or None
+        The label ids. If None, use the ids of all structures.
+    voxel_volume : float
+        The volume of a single voxel of the annotation.
+    processes : int or None
+        Number of threads to process blocks of z-planes with.
+    block_size : int
+        Number of z-planes per block.
+    verbose : bool
+        Whether to print verbose output.
+
+    Returns
+    -------
+    volumes : array
+        The volume of each label in ids.
+
+    Note
+    ----
+    With the Jacobian determinant of the map from the annotation to the
+    sample, the volumes are those of the regions in the sample, integrated
+    in annotation space instead of counting voxels of a warped annotation.
+    """
+    if jacobian is None:
+        return count_label_voxels(annotation_file, ids=ids, processes=processes, block_size=block_size,
+                                  verbose=verbose) * voxel_volume
+
+    if ids is None:
+        ids = get_annotation().hierarchy.ids
+    ids = np.asarray(ids).astype(np.int64)
+    hierarchy = RegionHierarchy(ids, np.full(len(ids), -1))
+
+    if clearmap_io.shape(jacobian)[:3] != clearmap_io.shape(annotation_file)[:3]:
+        raise ValueError(f'Shape of the Jacobian {clearmap_io.shape(jacobian)} does not match '
+                         f'the annotation {clearmap_io.shape(annotation_file)}!')
+
+    volumes = _bincount_labels(annotation_file, hierarchy, weights_file=jacobian,
+                               processes=processes, block_size=block_size)
+    return volumes * voxel_volume
+
+
+def _bincount_labels(annotation_file, hierarchy, weights_file=None, processes=None, block_size=8):
+    """Block parallel (weighted) count of the labels of an annotation volume."""
+    if processes is None:
+        processes = mp.cpu_count()
+    n_planes = clearmap_io.shape(annotation_file)[2]
+    n_ids = hierarchy.n_regions
+
+    def _count(z):
+        slicing = (slice(None), slice(None), slice(z, min(z + block_size, n_planes)))
+        block = clearmap_io.as_source(annotation_file)[slicing]
+        codes = hierarchy.index(np.ravel(block), invalid=n_ids)
+        weights = None
+        if weights_file is not None:
+            weights = np.ravel(np.asarray(clearmap_io.as_source(weights_file)[slicing], dtype=float))
+        return np.bincount(codes, weights=weights, minlength=n_ids + 1)[:n_ids]
+
+    with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+        counts = sum(executor.map(_count, range(0, n_planes, block_size)))
+    return np.asarray(counts, dtype=float)
+
+
 def convert_label(label, key='id', value='order', level=None, method=None):
     """
     Convert label using the atlas annotation data.
@@ -595,9 +1391,9 @@ def convert_label(label, key='id', value='order', level=None, method=None):
         The key to convert the label to. #TODO list possible values
     level : nt or None
         Convert at this level of the hierarchy. If None use full hierarchy.
-    method : 'map' or 'dictionary'
-        Convert labels using a mapping array or a dictionary. Depending on the keys
-        either can be faster for large data sets.
+    method : 'map', 'dictionary' or None
+        Convert labels using a cached compact :class:`LabelMap` or a dictionary.
+        If None, use the map.
 
     Returns
     -------
@@ -610,8 +1406,8 @@ def convert_label(label, key='id', value='order', level=None, method=None):
     if value in ('rgb', 'rgba', 'RGB', 'RGBA'):
         alpha = value.lower().endswith('a')
         as_int = value[:3] == 'RGB'
-        return annotation.label_to_color(label, key=key, alpha=alpha, as_int=as_int)
-    return annotation.convert_label(label, key=key, value=value, level=level, method=method)
+        return get_annotation().label_to_color(label, key=key, alpha=alpha, as_int=as_int)
+    return get_annotation().convert_label(label, key=key, value=value, level=level, method=method)
 
 
 def __get_module_annotation_file(annotation_file):
@@ -621,7 +1417,7 @@ def __get_module_annotation_file(annotation_file):
                              'the module has not been initialized. '
                              'Please call set_annotation_file first.')
         else:
-            return annotation.annotation_file
+            return get_annotation().annotation_file
     else:
         return annotation_file
 
@@ -671,13 +1467,13 @@ def prepare_annotation_files(slicing=None, orientation=None, directory=None, pos
         The distance cropped file.
     """
     if annotation_file is None:
-        annotation_file = default_annotation_file
+        annotation_file = default_atlas_file('annotation')
     if hemispheres_file is None:
-        hemispheres_file = default_hemispheres_file
+        hemispheres_file = default_atlas_file('hemispheres')
     if reference_file is None:
-        reference_file = default_reference_file
+        reference_file = default_atlas_file('reference')
     if distance_to_surface_file is None:
-        distance_to_surface_file = default_distance_to_surface_file
+        distance_to_surface_file = default_atlas_file('distance_to_surface')
 
     files = [annotation_file, reference_file, distance_to_surface_file]
     if hemispheres:
@@ -703,26 +1499,9 @@ def prepare_annotation_files(slicing=None, orientation=None, directory=None, pos
             if verbose:
                 print('Preparing: from source %r' % s)
 
-            data = np.array(s.array)
-
-            if orientation is not None:
-                # permute
-                per = res.orientation_to_permuation(orientation)
-                data = data.transpose(per)
-
-                # reverse axes
-                re_slice = False
-                sl = [slice(None)] * data.ndim
-                for d, o in enumerate(orientation):
-                    if o < 0:
-                        sl[d] = slice(None, None, -1)
-                        re_slice = True
-                if re_slice:
-                    data = data[tuple(sl)]
-
-            if slicing is not None:
-                data = data[slicing]
-            clearmap_io.write(fn, data)
+            # permute, reverse and crop out of core into a contiguous file
+            clearmap_io.delete_file(fn)
+            clearmap_io.reorient(s, fn, orientation=orientation, slicing=slicing)
             results.append(fn)
         else:
             results.append(None)
@@ -767,6 +1546,7 @@ def annotation_to_distance_file(annotation_file_path):
 
 
 def get_names_map():
+    annotation = get_annotation()
     return dict(zip(annotation.ids, annotation.names))
 
 
@@ -775,6 +1555,7 @@ def get_names_map():
 ###############################################################################
 
 if __name__ == "__main__":
+    annotation = get_annotation()
     assert annotation.df.shape == (1319, 5)
     assert annotation.dict_id_to_acronym[1] == "TMv"
     assert annotation.dict_name_to_id['Interpeduncular nucleus'] == 100
@@ -56,6 +56,10 @@ import os
 import tempfile
 import shutil
 import re
+import hashlib
+import subprocess
+import threading
+import concurrent.futures
 
 import numpy as np
 
@@ -306,7 +310,8 @@ def set_path_transform_files(result_directory):
   rec = re.compile("\(InitialTransformParametersFileName \"(?P<parname>.*)\"\)");
   
   for f in files:
-    fh, tmpfn = tempfile.mkstemp();
+    #note: replace atomically so that concurrent runs never see a missing file
+    fh, tmpfn = tempfile.mkstemp(dir=result_directory);
     ff = os.path.join(result_directory, f);
     #print ff        
       
@@ -327,8 +332,7 @@ def set_path_transform_files(result_directory):
             newfile.write(line);
                           
     os.close(fh);
-    os.remove(ff);
-    shutil.move(tmpfn, ff);
+    os.replace(tmpfn, ff);
 
 
 def set_metric_parameter_file(parameter_file, metric):
@@ -502,7 +506,57 @@ def rescale_size_and_spacing(size, spacing, scale):
 ### Elastix Runs
 ##############################################################################
 
-def align(fixed_image, moving_image, affine_parameter_file, bspline_parameter_file = None, result_directory = None, processes = None):
+def _run(args, name, log_directory = None, timeout = None):
+  """Run an elastix binary, capture its output and check the return code.
+  
+  Arguments
+  ---------
+  args : list of str
+    The binary and its arguments.
+  name : str
+    The name of the calling routine for error messages and the log file.
+  log_directory : str or None
+    If given, write the output of the binary to '<name>.log' in this directory.
+  timeout : float or None
+    Maximal run time in seconds.
+  
+  Returns
+  -------
+  output : str
+    The output of the binary.
+  """
+  args = [str(a) for a in args];
+  cmd = ' '.join(args);
+  try:
+    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
+                            universal_newlines=True, timeout=timeout);
+  except subprocess.TimeoutExpired:
+    raise RuntimeError('%s: timeout after %rs executing: %s' % (name, timeout, cmd));
+  
+  if log_directory is not None and os.path.isdir(log_directory):
+    with open(os.path.join(log_directory, '%s.log' % name), 'w') as f:
+      f.write(result.stdout);
+  
+  if result.returncode != 0:
+    tail = '\n'.join(result.stdout.splitlines()[-20:]);
+    raise RuntimeError('%s: failed executing (return code %d): %s\n%s' % (name, result.returncode, cmd, tail));
+  
+  return result.stdout;
+
+
+def _scratch_directory(name):
+  """Create a unique scratch directory for a run."""
+  return tempfile.mkdtemp(prefix='elastix_%s_' % name);
+
+
+def _threads(processes):
+  """Thread arguments for the elastix binaries."""
+  if processes is None:
+    return [];
+  return ['-threads', int(processes)];
+
+
+def align(fixed_image, moving_image, affine_parameter_file, bspline_parameter_file = None, result_directory = None, processes = None, timeout = None, cache = None):
   """Align images using elastix, estimates a transformation :math:`T:` fixed image :math:`\\rightarrow` moving image.
   
   Arguments
@@ -516,14 +570,24 @@ def align(fixed_image, moving_image, affine_parameter_file, bspline_parameter_fi
   bspline_parameter_file : str or None
     Elastix parameter file for the secondary non-linear transformation.
   result_directory : str or None
-    Elastic result directory.
+    Elastic result directory. If None, a new temporary directory is created.
   processes : int or None
     Number of threads to use.
+  timeout : float or None
+    Maximal run time in seconds.
+  cache : str, False or None
+    Directory of the registration cache. If None, use
+    :const:`ClearMap.Settings.elastix_cache_path`. If False, do not cache.
       
   Returns
   -------
   result_directory : str
     Path to elastix result directory.
+    
+  Note
+  ----
+  Cached registrations are keyed on the contents of the images and 
+  parameter files and the elastix version, see :func:`align_key`.
   """
   
   if processes is None:
@@ -533,28 +597,151 @@ def align(fixed_image, moving_image, affine_parameter_file, bspline_parameter_fi
 
   # result directory
   if result_directory == None:
-    result_directory = tempfile.gettempdir();
+    result_directory = _scratch_directory('align');
   
   if not os.path.exists(result_directory):
     os.mkdir(result_directory);
   
+  parameter_files = [f for f in (affine_parameter_file, bspline_parameter_file) if f is not None];
+  
+  # cache
+  if cache is None:
+    cache = settings.elastix_cache_path;
+  if cache:
+    key = align_key(fixed_image, moving_image, parameter_files);
+    cached = os.path.join(cache, key);
+    if os.path.isdir(cached):
+      print('Elastix: cache hit %s for %s' % (key, result_directory));
+      _copy_directory(cached, result_directory);
+      set_path_transform_files(result_directory);
+      return result_directory;
+    print('Elastix: cache miss %s for %s' % (key, result_directory));
+  
   # run elastix
-  if bspline_parameter_file is None:
-    cmd = '%s -threads %d -m %s -f %s -p %s -out %s' % (elastix_binary, processes, moving_image, fixed_image, affine_parameter_file, result_directory);
-  elif affine_parameter_file is None:
-    cmd = '%s -threads %d -m %s -f %s -p %s -out %s' % (elastix_binary, processes, moving_image, fixed_image, bspline_parameter_file, result_directory);
-  else:
-    cmd = '%s -threads %d -m %s -f %s -p %s -p %s -out %s' % (elastix_binary, processes, moving_image, fixed_image, affine_parameter_file, bspline_parameter_file, result_directory);
+  args = [elastix_binary] + _threads(processes) + ['-m', moving_image, '-f', fixed_image];
+  for f in parameter_files:
+    args += ['-p', f];
+  args += ['-out', result_directory];
   
-  res = os.system(cmd);
+  _run(args, 'align', log_directory=result_directory, timeout=timeout);
   
-  if res != 0:
-    raise RuntimeError('align: failed executing: ' + cmd);
+  if cache:
+    _cache_directory(result_directory, cache, key);
   
   return result_directory
 
 
-def transform(source, sink = [], transform_parameter_file = None, transform_directory = None, result_directory = None):
+def align_key(fixed_image, moving_image, parameter_files, initial_transform_file = None):
+  """Key of an alignment in the registration cache.
+  
+  Arguments
+  ---------
+  fixed_image : str or array
+    Image source of the fixed image.
+  moving_image : str or array
+    Image source of the moving image.
+  parameter_files : list of str
+    The elastix parameter files.
+  initial_transform_file : str or None
+    The parameter file of an initial transformation, e.g. for 
+    :func:`inverse_transform`.
+  
+  Returns
+  -------
+  key : str
+    Hex digest of the image contents, parameter files, initial 
+    transformation and elastix version.
+  """
+  h = hashlib.blake2b(digest_size=20);
+  h.update(elastix_version().encode());
+  for image in (fixed_image, moving_image):
+    h.update(_content_hash(image).encode());
+  for f in parameter_files:
+    with open(f, 'rb') as parfile:
+      h.update(parfile.read());
+  if initial_transform_file is not None:
+    h.update(b'initial transform');
+    h.update(_transform_hash(initial_transform_file).encode());
+  return h.hexdigest();
+
+
+def elastix_version():
+  """The version of the elastix binary."""
+  global _elastix_version
+  if _elastix_version is None:
+    check_elastix_initialized();
+    try:
+      _elastix_version = _run([elastix_binary, '--version'], 'version').strip();
+    except (RuntimeError, OSError):
+      _elastix_version = '%s:%r' % (elastix_binary, os.path.getmtime(elastix_binary));
+  return _elastix_version;
+
+_elastix_version = None;
+
+
+def _content_hash(source):
+  """Hash of the array of an image source."""
+  h = hashlib.blake2b(digest_size=20);
+  try:
+    array = np.ascontiguousarray(io.read(source));
+    h.update(('%r%r' % (array.shape, array.dtype)).encode());
+    h.update(array.data);
+  except Exception:
+    # formats not readable by ClearMap are hashed as files
+    with open(source, 'rb') as f:
+      for chunk in iter(lambda: f.read(2**24), b''):
+        h.update(chunk);
+  return h.hexdigest();
+
+
+def _transform_hash(transform_parameter_file):
+  """Hash of a chain of transform parameter files ignoring the paths of the initial transforms."""
+  rec = re.compile("\(InitialTransformParametersFileName \"(?P<parname>.*)\"\)");
+  h = hashlib.blake2b(digest_size=20);
+  while transform_parameter_file is not None:
+    initial = None;
+    with open(transform_parameter_file) as parfile:
+      for line in parfile:
+        m = rec.match(line);
+        if m is None:
+          h.update(line.encode());
+        elif m.group('parname') != 'NoInitialTransform':
+          initial = os.path.join(os.path.dirname(transform_parameter_file), os.path.basename(m.group('parname')));
+    transform_parameter_file = initial;
+  return h.hexdigest();
+
+
+def _set_initial_transform(parameter_file, initial_transform_file):
+  """Set the initial transformation in a transform parameter file."""
+  with open(parameter_file) as parfile:
+    lines = parfile.readlines();
+  lines = ['(InitialTransformParametersFileName "%s")\n' % initial_transform_file
+           if line.startswith('(InitialTransformParametersFileName') else line for line in lines];
+  with open(parameter_file, 'w') as parfile:
+    parfile.writelines(lines);
+
+
+def _copy_directory(source, sink):
+  """Copy the files of a directory into another one."""
+  for f in os.listdir(source):
+    if os.path.isfile(os.path.join(source, f)):
+      shutil.copy2(os.path.join(source, f), os.path.join(sink, f));
+
+
+def _cache_directory(result_directory, cache, key):
+  """Store a result directory in the cache."""
+  if not os.path.exists(cache):
+    os.makedirs(cache, exist_ok=True);
+  # copy to a unique directory first so concurrent runs never see partial results
+  temporary = tempfile.mkdtemp(prefix='.%s_' % key, dir=cache);
+  _copy_directory(result_directory, temporary);
+  try:
+    os.rename(temporary, os.path.join(cache, key));
+  except OSError:
+    shutil.rmtree(temporary, ignore_errors=True);
+
+
+def transform(source, sink = [], transform_parameter_file = None, transform_directory = None, result_directory = None, processes = None, timeout = None):
   """Transform a raw data set to reference using the elastix alignment results.
   
   Arguments
@@ -572,6 +759,10 @@ def transform(source, sink = [], transform_parameter_file = None, transform_dire
     If None the transform_parameter_file has to be given.
   result_directory : str or None
     The directorty for the transformix results.
+  processes : int or None
+    Number of threads to use.
+  timeout : float or None
+    Maximal run time in seconds.
       
   Returns
   -------
@@ -586,62 +777,55 @@ def transform(source, sink = [], transform_parameter_file = None, transform_dire
   """
   check_elastix_initialized();  
   
-  # image
-  source = io.as_source(source);
-  if isinstance(source, io.tif.Source):
-    imgname = source.location;
-    delete_image = None;
-  else:
-    imgname = os.path.join(tempfile.gettempdir(), 'elastix_input.tif');
-    io.write(source, imgname);
-    delete_image = imgname;
-
-  # result directory
-  delete_result_directory = None;
-  if result_directory == None:
-    resultdirname = os.path.join(tempfile.gettempdir(), 'elastix_output');
-    delete_result_directory = resultdirname;
-  else:
-    resultdirname = result_directory;
-     
-  if not os.path.exists(resultdirname):
-    os.makedirs(resultdirname);
-  
-  # tranformation parameter
-  transform_parameter_dir, transform_parameter_file = transform_directory_and_file(transform_parameter_file = transform_parameter_file, transform_directory = transform_directory);
+  scratch = _scratch_directory('transform');
+  try:
+    # image
+    source = io.as_source(source);
+    if isinstance(source, io.tif.Source):
+      imgname = source.location;
+    else:
+      imgname = os.path.join(scratch, 'input.tif');
+      io.write(imgname, source);
   
-  set_path_transform_files(transform_parameter_dir);
- 
-  #transformix -in inputImage.ext -out outputDirectory -tp TransformParameters.txx
-  cmd = '%s -in %s -out %s -tp %s' % (transformix_binary, imgname, resultdirname, transform_parameter_file);
-  
-  res = os.system(cmd);
-  
-  if res != 0:
-    raise RuntimeError('transform_data: failed executing: ' + cmd);
-  
-  # read data and clean up
-  if delete_image is not None:
-      os.remove(delete_image);
-  
-  if sink == []:
-    return result_data_file(resultdirname);
-  elif sink is None:
-    resultfile = result_data_file(resultdirname);
-    result = io.read(resultfile);
-  elif isinstance(sink, str):
-    resultfile = result_data_file(resultdirname);
-    result = io.convert(resultfile, sink);
-  else:
-    raise RuntimeError('transform_data: sink not valid!');
+    # result directory
+    if result_directory == None:
+      resultdirname = os.path.join(scratch, 'output');
+    else:
+      resultdirname = result_directory;
+       
+    if not os.path.exists(resultdirname):
+      os.makedirs(resultdirname);
+    
+    # tranformation parameter
+    transform_parameter_dir, transform_parameter_file = transform_directory_and_file(transform_parameter_file = transform_parameter_file, transform_directory = transform_directory);
+    
+    set_path_transform_files(transform_parameter_dir);
+   
+    #transformix -in inputImage.ext -out outputDirectory -tp TransformParameters.txx
+    args = [transformix_binary] + _threads(processes) + ['-in', imgname, '-out', resultdirname, '-tp', transform_parameter_file];
+    _run(args, 'transform', log_directory=resultdirname, timeout=timeout);
     
-  if delete_result_directory is not None:
-    shutil.rmtree(delete_result_directory);
+    if sink == []:
+      return result_data_file(resultdirname);
+    elif sink is None:
+      resultfile = result_data_file(resultdirname);
+      result = io.read(resultfile);
+    elif isinstance(sink, str):
+      resultfile = result_data_file(resultdirname);
+      result = io.convert(resultfile, sink);
+    else:
+      raise RuntimeError('transform_data: sink not valid!');
+  finally:
+    # clean up, keep the default result if its file name is returned
+    if sink == [] and result_directory is None:
+      _remove_inputs(scratch, keep='output');
+    else:
+      shutil.rmtree(scratch, ignore_errors=True);
   
   return result;
 
 
-def deformation_field(sink = [], transform_parameter_file = None, transform_directory = None, result_directory = None):
+def deformation_field(sink = [], transform_parameter_file = None, transform_directory = None, result_directory = None, processes = None, timeout = None):
   """Create the deformation field T(x) - x.
       
   Arguments
@@ -657,6 +841,10 @@ def deformation_field(sink = [], transform_parameter_file = None, transform_dire
     transform_parameter_file has to be given.
   result_directory : str or None
     The directorty for the transformix results.
+  processes : int or None
+    Number of threads to use.
+  timeout : float or None
+    Maximal run time in seconds.
       
   Returns
   -------
@@ -671,46 +859,129 @@ def deformation_field(sink = [], transform_parameter_file = None, transform_dire
   check_elastix_initialized();   
   
   # result directory
-  delete_result_directory = None;
+  scratch = None;
   if result_directory == None:
-    resultdirname = os.path.join(tempfile.gettempdir(), 'elastix_output');
-    delete_result_directory = resultdirname;
+    scratch = _scratch_directory('deformation_field');
+    resultdirname = scratch;
   else:
     resultdirname = result_directory;
       
   if not os.path.exists(resultdirname):
     os.makedirs(resultdirname);
      
-  # setup transformation 
-  transform_parameter_dir, transform_parameter_file = transform_directory_and_file(transform_parameter_file = transform_parameter_file, transform_directory = transform_directory); 
-  set_path_transform_files(transform_parameter_dir);
- 
-  #transformix -in inputImage.ext -out outputDirectory -tp TransformParameters.txt
-  cmd = '%s -def all -out %s -tp  %s' % (transformix_binary, resultdirname, transform_parameter_file)
-  
-  res = os.system(cmd);
-  
-  if res != 0:
-    raise RuntimeError('deformation_field: failed executing: ' + cmd);
-  
-  # read result and clean up
-  if sink == []:
-    return result_data_file(resultdirname);
-  elif sink is None:
-    resultfile = result_data_file(resultdirname);
-    result = io.read(resultfile);
-  elif isinstance(sink, str):
-    resultfile = result_data_file(resultdirname);
-    result = io.convert(resultfile, sink);
+  try:
+    # setup transformation 
+    transform_parameter_dir, transform_parameter_file = transform_directory_and_file(transform_parameter_file = transform_parameter_file, transform_directory = transform_directory); 
+    set_path_transform_files(transform_parameter_dir);
+   
+    #transformix -in inputImage.ext -out outputDirectory -tp TransformParameters.txt
+    args = [transformix_binary] + _threads(processes) + ['-def', 'all', '-out', resultdirname, '-tp', transform_parameter_file];
+    _run(args, 'deformation_field', log_directory=resultdirname, timeout=timeout);
+    
+    # read result and clean up
+    if sink == []:
+      return result_data_file(resultdirname);
+    elif sink is None:
+      resultfile = result_data_file(resultdirname);
+      result = io.read(resultfile);
+    elif isinstance(sink, str):
+      resultfile = result_data_file(resultdirname);
+      result = io.convert(resultfile, sink);
+    else:
+      raise RuntimeError('deformation_field: sink not valid!');
+  finally:
+    if scratch is not None and sink != []:
+      shutil.rmtree(scratch, ignore_errors=True);
+  
+  return result;
+
+
+def jacobian_determinant(sink = [], transform_parameter_file = None, transform_directory = None, result_directory = None, processes = None, timeout = None):
+  """Create the determinant of the spatial Jacobian of the transformation T(x).
+      
+  Arguments
+  ---------
+  sink : str, [] or None
+    Image sink to save the Jacobian determinant to; if [] return the default 
+    name of the data file generated by transformix.
+  transform_parameter_file : str or None
+    Parameter file for the primary transformation, if None, the file is 
+    determined from the transform_directory.
+  transform_directory : str or None
+    Result directory of elastix alignment, if None the 
+    transform_parameter_file has to be given.
+  result_directory : str or None
+    The directorty for the transformix results.
+  processes : int or None
+    Number of threads to use.
+  timeout : float or None
+    Maximal run time in seconds.
+      
+  Returns
+  -------
+  jacobian_determinant : array or str
+    Array or file name of the Jacobian determinant on the fixed image grid.
+      
+  Note
+  ----
+  The determinant is the local volume change of the map
+  :math:`T \mathrm{fixed} \rightarrow \mathrm{moving}`, i.e. integrating it
+  over a region in the fixed image gives the volume of its image in the 
+  moving image.
+  """
+  check_elastix_initialized();   
+  
+  # result directory
+  scratch = None;
+  if result_directory == None:
+    scratch = _scratch_directory('jacobian_determinant');
+    resultdirname = scratch;
   else:
-    raise RuntimeError('deformation_field: sink not valid!');
+    resultdirname = result_directory;
       
-  if delete_result_directory is not None:
-    shutil.rmtree(delete_result_directory);
+  if not os.path.exists(resultdirname):
+    os.makedirs(resultdirname);
+  
+  try:
+    # setup transformation 
+    transform_parameter_dir, transform_parameter_file = transform_directory_and_file(transform_parameter_file = transform_parameter_file, transform_directory = transform_directory); 
+    set_path_transform_files(transform_parameter_dir);
+   
+    #transformix -jac all -out outputDirectory -tp TransformParameters.txt
+    args = [transformix_binary] + _threads(processes) + ['-jac', 'all', '-out', resultdirname, '-tp', transform_parameter_file];
+    _run(args, 'jacobian_determinant', log_directory=resultdirname, timeout=timeout);
+    
+    # read result and clean up
+    files = sorted(f for f in os.listdir(resultdirname) if f.startswith('spatialJacobian.') and not f.endswith('.raw'));
+    if files == []:
+      raise RuntimeError('jacobian_determinant: cannot find result in %s!' % resultdirname);
+    resultfile = os.path.join(resultdirname, files[0]);
+    if sink == []:
+      return resultfile;
+    elif sink is None:
+      result = io.read(resultfile);
+    elif isinstance(sink, str):
+      result = io.convert(resultfile, sink);
+    else:
+      raise RuntimeError('jacobian_determinant: sink not valid!');
+  finally:
+    if scratch is not None and sink != []:
+      shutil.rmtree(scratch, ignore_errors=True);
   
   return result;
 
 
+def _remove_inputs(directory, keep):
+  """Remove all files in a scratch directory except a result sub-directory."""
+  for f in os.listdir(directory):
+    if f != keep:
+      path = os.path.join(directory, f);
+      if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True);
+      else:
+        os.remove(path);
+
+
 def deformation_distance(deformation_field, sink = None, scale = None):
   """Compute the distance field from a deformation vector field.
   
@@ -858,7 +1129,7 @@ def read_points(filename, indices = False, binary = True):
     return points;
 
 
-def transform_points(source, sink = None, transform_parameter_file = None, transform_directory = None, indices = False, result_directory = None, temp_file = None, binary = True):
+def transform_points(source, sink = None, transform_parameter_file = None, transform_directory = None, indices = False, result_directory = None, temp_file = None, binary = True, processes = None, timeout = None):
   """Transform coordinates math:`x` via elastix estimated transformation to :math:`T(x)`.
 
   Arguments
@@ -879,6 +1150,10 @@ def transform_points(source, sink = None, transform_parameter_file = None, trans
     Elastic result directory.
   temp_file : str or None
     Optional file name for the elastix point file.
+  processes : int or None
+    Number of threads to use.
+  timeout : float or None
+    Maximal run time in seconds.
       
   Returns
   -------
@@ -892,12 +1167,14 @@ def transform_points(source, sink = None, transform_parameter_file = None, trans
   """   
   check_elastix_initialized();    
 
+  scratch = _scratch_directory('transform_points');
+  
   # input point file
   if temp_file == None:
     if binary:
-      temp_file = os.path.join(tempfile.gettempdir(), 'elastix_input.bin');
+      temp_file = os.path.join(scratch, 'input.bin');
     else:
-      temp_file = os.path.join(tempfile.gettempdir(), 'elastix_input.txt');
+      temp_file = os.path.join(scratch, 'input.txt');
   
   delete_point_file = None;
   if isinstance(source, str):
@@ -917,58 +1194,58 @@ def transform_points(source, sink = None, transform_parameter_file = None, trans
     delete_point_file = temp_file;
     write_points(pointfile, source, indices = indices, binary = binary);
   else:
+    shutil.rmtree(scratch, ignore_errors=True);
     raise RuntimeError('transform_points: source not string or array!');
   #print(pointfile)
   
   # result directory
   if result_directory == None:
-    outdirname = os.path.join(tempfile.gettempdir(), 'elastix_output');
-    delete_result_directory = outdirname;
+    outdirname = os.path.join(scratch, 'output');
+    delete_result_directory = True;
   else:
     outdirname = result_directory;
-    delete_result_directory = None;
+    delete_result_directory = False;
       
   if not os.path.exists(outdirname):
     os.makedirs(outdirname);
   
-  #transform
-  transform_parameter_dir, transform_parameter_file = transform_directory_and_file(transform_parameter_file = transform_parameter_file, transform_directory = transform_directory);
-  set_path_transform_files(transform_parameter_dir);
-  
-  #run transformix   
-  cmd = '%s -def %s -out %s -tp %s' % (transformix_binary, pointfile, outdirname, transform_parameter_file);
-  print(cmd)
-  
-  res = os.system(cmd);
-  
-  if res != 0:
-    raise RuntimeError('failed executing ' + cmd);
-  
-  # read data and clean up
-  if delete_point_file is not None:
-    os.remove(delete_point_file);
-  
-  #read data / file 
-  if sink == []: # return sink as file name
-    if binary:
-      return os.path.join(outdirname, 'outputpoints.bin')
-    else:
-      return os.path.join(outdirname, 'outputpoints.txt')
-  
-  else:
-    if binary:
-      transpoints = read_points(os.path.join(outdirname, 'outputpoints.bin'), indices = indices, binary = True);
-    else:
-      transpoints = read_points(os.path.join(outdirname, 'outputpoints.txt'), indices = indices, binary = False); 
+  try:
+    #transform
+    transform_parameter_dir, transform_parameter_file = transform_directory_and_file(transform_parameter_file = transform_parameter_file, transform_directory = transform_directory);
+    set_path_transform_files(transform_parameter_dir);
+    
+    #run transformix   
+    args = [transformix_binary] + _threads(processes) + ['-def', pointfile, '-out', outdirname, '-tp', transform_parameter_file];
+    _run(args, 'transform_points', log_directory=outdirname, timeout=timeout);
+    
+    # read data and clean up
+    if delete_point_file is not None:
+      os.remove(delete_point_file);
     
-    if delete_result_directory is not None:
-      shutil.rmtree(delete_result_directory);
+    #read data / file 
+    if sink == []: # return sink as file name
+      delete_result_directory = False;
+      if binary:
+        return os.path.join(outdirname, 'outputpoints.bin')
+      else:
+        return os.path.join(outdirname, 'outputpoints.txt')
+    
+    else:
+      if binary:
+        transpoints = read_points(os.path.join(outdirname, 'outputpoints.bin'), indices = indices, binary = True);
+      else:
+        transpoints = read_points(os.path.join(outdirname, 'outputpoints.txt'), indices = indices, binary = False); 
+  finally:
+    if delete_result_directory:
+      shutil.rmtree(scratch, ignore_errors=True);
+    elif not os.listdir(scratch) or result_directory is not None:
+      shutil.rmtree(scratch, ignore_errors=True);
   
   return io.write(sink, transpoints);
 
         
         
-def inverse_transform(fixed_image, affine_parameter_file, bspline_parameter_file = None, transform_parameter_file = None, transform_directory = None, result_directory = None, processes = None):
+def inverse_transform(fixed_image, affine_parameter_file, bspline_parameter_file = None, transform_parameter_file = None, transform_directory = None, result_directory = None, processes = None, timeout = None, cache = None):
   """Estimate inverse tranformation :math:`T^{-1}:` moving image :math:`\\rightarrow` fixed image.
   
   Arguments
@@ -982,19 +1259,36 @@ def inverse_transform(fixed_image, affine_parameter_file, bspline_parameter_file
   transform_directory : str
     Elastic result directory of the original transform.
   result_directory : str or None
-    Elastic result directory of the inverse transform.
+    Elastic result directory of the inverse transform. If None, a new 
+    temporary directory is created.
+  processes : int or None
+    Number of threads to use.
+  timeout : float or None
+    Maximal run time in seconds.
+  cache : str, False or None
+    Directory of the registration cache. If None, use
+    :const:`ClearMap.Settings.elastix_cache_path`. If False, do not cache.
       
   Returns
   -------
   result_directory : str
     Path to elastix result directory.
+    
+  Note
+  ----
+  Cached inverse transformations are keyed on the contents of the fixed 
+  image, the parameter files and the original transformation, see 
+  :func:`align_key`.
   """
   
   check_elastix_initialized();
   
+  if processes is None:
+    processes = mp.cpu_count();
+  
   # result directory
   if result_directory == None:
-      result_directory = tempfile.getgettempdir()();
+      result_directory = _scratch_directory('inverse_transform');
   
   if not os.path.exists(result_directory):
       os.mkdir(result_directory);
@@ -1020,22 +1314,140 @@ def inverse_transform(fixed_image, affine_parameter_file, bspline_parameter_file
   else:
     affinefile = None;
   
+  parameter_files = [f for f in (affinefile, bsplinefile) if f is not None];
+  
+  # cache
+  if cache is None:
+    cache = settings.elastix_cache_path;
+  if cache:
+    key = align_key(fixed_image, fixed_image, parameter_files, initial_transform_file=transform_parameter_file);
+    cached = os.path.join(cache, key);
+    if os.path.isdir(cached):
+      print('Elastix: cache hit %s for %s' % (key, result_directory));
+      _copy_directory(cached, result_directory);
+      set_path_transform_files(result_directory);
+      _set_initial_transform(os.path.join(result_directory, 'TransformParameters.0.txt'), transform_parameter_file);
+      return result_directory;
+    print('Elastix: cache miss %s for %s' % (key, result_directory));
+  
   # run elastix
-  if bsplinefile is None:
-    cmd = '%s -threads %d -m %s -f %s -t0 %s -p %s -out %s' % (elastix_binary, processes, fixed_image, fixed_image, transform_parameter_file, affinefile,  result_directory);
-  elif affinefile is None:
-    cmd = '%s -threads %d -m %s -f %s -t0 %s -p %s -out %s' % (elastix_binary, processes, fixed_image, fixed_image, transform_parameter_file, bsplinefile, result_directory);
-  else:
-    cmd = '%s -threads %d -m %s -f %s -t0 %s -p %s -p %s -out %s' % (elastix_binary, processes, fixed_image, fixed_image, transform_parameter_file, affinefile, bsplinefile, result_directory);    
+  args = [elastix_binary] + _threads(processes) + ['-m', fixed_image, '-f', fixed_image, '-t0', transform_parameter_file];
+  for f in parameter_files:
+    args += ['-p', f];
+  args += ['-out', result_directory];
   
-  res = os.system(cmd);
+  _run(args, 'inverse_transform', log_directory=result_directory, timeout=timeout);
   
-  if res != 0:
-    raise RuntimeError('inverse_transform: failed executing: ' + cmd);
+  if cache:
+    _cache_directory(result_directory, cache, key);
   
   return result_directory
 
 
+###############################################################################
+### Jobs
+###############################################################################
+
+class Job(object):
+  """A deferred elastix or transformix run.
+  
+  Example
+  -------
+  >>> jobs = [elx.Job(elx.align, fixed_image=f, moving_image=m, affine_parameter_file=a, 
+  >>>                 result_directory=d, threads=8) for f, m, d in runs]
+  >>> directories = elx.run_jobs(jobs, processes=32)
+  """
+  
+  def __init__(self, function, *args, threads = 1, **kwargs):
+    """Job constructor.
+    
+    Arguments
+    ---------
+    function : function
+      The routine to run, e.g. :func:`align` or :func:`transform`.
+    *args, **kwargs
+      The arguments of the routine.
+    threads : int
+      The number of threads the run uses, passed as the processes argument.
+    """
+    self.function = function;
+    self.args = args;
+    self.kwargs = kwargs;
+    self.threads = max(1, int(threads));
+  
+  def run(self, threads = None):
+    """Run the job with the given number of threads."""
+    kwargs = dict(self.kwargs);
+    kwargs.setdefault('processes', self.threads if threads is None else threads);
+    return self.function(*self.args, **kwargs);
+  
+  def __str__(self):
+    return 'Job[%s](threads=%d)' % (self.function.__name__, self.threads);
+  
+  def __repr__(self):
+    return self.__str__();
+
+
+class _ThreadBudget(object):
+  """Shared number of threads available to concurrent jobs."""
+  
+  def __init__(self, threads):
+    self.threads = threads;
+    self.available = threads;
+    self.condition = threading.Condition();
+  
+  def acquire(self, threads):
+    threads = min(threads, self.threads);
+    with self.condition:
+      self.condition.wait_for(lambda: self.available >= threads);
+      self.available -= threads;
+    return threads;
+  
+  def release(self, threads):
+    with self.condition:
+      self.available += threads;
+      self.condition.notify_all();
+
+
+def run_jobs(jobs, processes = None, verbose = False):
+  """Run elastix and transformix jobs in parallel under a shared thread budget.
+  
+  Arguments
+  ---------
+  jobs : list of Job
+    The jobs to run. As each run uses its own scratch directory, jobs may 
+    transform the same data or use the same transformation concurrently.
+  processes : int or None
+    The total number of threads of all concurrently running jobs. 
+    If None, use the number of cpus.
+  verbose : bool
+    If True, print progress information.
+  
+  Returns
+  -------
+  results : list
+    The results of the jobs in the order of the jobs.
+  """
+  if processes is None:
+    processes = mp.cpu_count();
+  budget = _ThreadBudget(processes);
+  
+  def _run_job(i, job):
+    threads = budget.acquire(job.threads);
+    try:
+      if verbose:
+        print('Elastix: running job %d/%d %r with %d threads' % (i + 1, len(jobs), job, threads));
+      return job.run(threads=threads);
+    finally:
+      budget.release(threads);
+  
+  if len(jobs) == 0:
+    return [];
+  with concurrent.futures.ThreadPoolExecutor(len(jobs)) as executor:
+    futures = [executor.submit(_run_job, i, job) for i, job in enumerate(jobs)];
+    return [f.result() for f in futures];
+
+
 ###############################################################################
 ### Tests
 ###############################################################################
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Pyramid
+=======
+
+Multi-resolution pyramids of large volumes.
+
+A pyramid stores down-sampled versions of a volume, e.g. by factors of 2, 4,
+8 and at the atlas resolution, as npy files in a directory together with a
+json file describing the shape, resolution and down-sampling factor of each
+level. All levels are computed in a single streaming pass over the volume.
+
+Consumers such as the resampling for the registration, thumbnails or masks
+read the smallest level that is fine enough instead of the full data. As
+levels are averaged they are never used for resampling label volumes with
+nearest neighbour interpolation.
+
+Example
+-------
+>>> import ClearMap.Alignment.Pyramid as pyr
+>>> pyramid = pyr.create_pyramid('stitched.npy', 'pyramid', factors=(2,4,8),
+>>>                              resolutions=[(25,25,25)], source_resolution=(4,4,4))
+>>> pyramid.select(sink_resolution=(50,50,50))
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+
+import os
+import json
+
+import numpy as np
+
+import ClearMap.IO.IO as io
+import ClearMap.IO.FileUtils as fu
+
+import ClearMap.Alignment.Resampling as res
+
+import ClearMap.Utils.Timer as tmr
+
+
+metadata_file = 'pyramid.json'
+"""The name of the metadata file in the pyramid directory."""
+
+
+###############################################################################
+### Pyramid
+###############################################################################
+
+class Pyramid(object):
+  """Multi-resolution pyramid of a volume."""
+
+  def __init__(self, location):
+    """Pyramid constructor.
+
+    Arguments
+    ---------
+    location : str
+      The directory of the pyramid.
+    """
+    self.location = fu.abspath(location);
+    with open(os.path.join(self.location, metadata_file), 'r') as f:
+      self.metadata = json.load(f);
+
+  @property
+  def source(self):
+    """The volume the pyramid was created from."""
+    return self.metadata['source'];
+
+  @property
+  def source_shape(self):
+    return tuple(self.metadata['source_shape']);
+
+  @property
+  def source_resolution(self):
+    resolution = self.metadata['source_resolution'];
+    return tuple(resolution) if resolution is not None else None;
+
+  @property
+  def interpolation(self):
+    """The interpolation method used to compute the levels."""
+    return self.metadata.get('interpolation', 'area');
+
+  @property
+  def levels(self):
+    """The levels as dicts with file, shape, resolution and factor, finest first."""
+    return self.metadata['levels'];
+
+  def __len__(self):
+    return len(self.levels);
+
+  def filename(self, level):
+    """The file of a level."""
+    return os.path.join(self.location, self.levels[level]['file']);
+
+  def level(self, level):
+    """The source of a level."""
+    return io.as_source(self.filename(level));
+
+  def __getitem__(self, level):
+    return self.level(level);
+
+  def shape(self, level):
+    return tuple(self.levels[level]['shape']);
+
+  def select(self, sink_shape = None, sink_resolution = None):
+    """The smallest level at least as fine as a target shape or resolution.
+
+    Arguments
+    ---------
+    sink_shape : tuple or None
+      The target shape in the orientation of the source.
+    sink_resolution : tuple or None
+      The target resolution in the orientation of the source.
+
+    Returns
+    -------
+    level : int or None
+      The index of the level or None if no level is fine enough.
+    """
+    if sink_shape is None:
+      if sink_resolution is None:
+        raise ValueError('Either sink_shape or sink_resolution needs to be given!');
+      if self.source_resolution is None:
+        raise ValueError('The pyramid has no source resolution to select a level by resolution!');
+      _, sink_shape, _, _ = res.resample_shape(source_shape=self.source_shape, source_resolution=self.source_resolution,
+                                               sink_resolution=sink_resolution);
+
+    selected = None;
+    for i in range(len(self)):
+      shape = self.shape(i);
+      if np.all(np.array(shape) >= np.array(sink_shape)):
+        if selected is None or np.prod(shape) < np.prod(self.shape(selected)):
+          selected = i;
+    return selected;
+
+  def __str__(self):
+    return 'Pyramid%r[%s]{%s}' % (self.source_shape, ', '.join('%r' % (tuple(l['shape']),) for l in self.levels), self.location);
+
+  def __repr__(self):
+    return self.__str__();
+
+
+###############################################################################
+### Pyramid creation
+###############################################################################
+
+def create_pyramid(source, sink = None, factors = (2, 4, 8), resolutions = None, source_resolution = None,
+                   interpolation = 'area', processes = None, verbose = False):
+  """Create a multi-resolution pyramid in a single pass over the source.
+
+  Arguments
+  ---------
+  source : str or Source
+    The 3d volume, e.g. the stitched data or a file list.
+  sink : str or None
+    The pyramid directory, if None use :func:`pyramid_location`.
+  factors : tuple of int
+    The down-sampling factors of the levels.
+  resolutions : list of tuples or None
+    Additional levels at these resolutions.
+  source_resolution : tuple or None
+    The resolution of the source, required for resolution levels.
+  interpolation : str
+    The interpolation method, see :func:`ClearMap.Alignment.Resampling.resample`.
+    Resampling only uses levels built with the same interpolation.
+  processes : int, None or 'serial'
+    Number of processes to use.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  pyramid : Pyramid
+    The pyramid.
+  """
+  if verbose:
+    timer = tmr.Timer();
+
+  location = source if isinstance(source, str) else None;
+  source = io.as_source(source);
+  if sink is None:
+    sink = pyramid_location(location);
+  if sink is None:
+    raise ValueError('A sink is required for pyramids of sources without location!');
+  if resolutions is None:
+    resolutions = [];
+  if len(resolutions) > 0 and source_resolution is None:
+    raise ValueError('The source resolution is required for resolution levels!');
+  if not isinstance(processes, int) and processes != 'serial':
+    processes = io.mp.cpu_count();
+
+  source_shape = tuple(int(s) for s in source.shape);
+  levels = [];
+  for f in factors:
+    shape = tuple(max(1, int(round(float(s) / f))) for s in source_shape);
+    levels.append(dict(file='level_%d.npy' % f, shape=shape, factor=f));
+  for r in resolutions:
+    _, shape, _, _ = res.resample_shape(source_shape=source_shape, source_resolution=source_resolution, sink_resolution=r);
+    levels.append(dict(file='level_%s.npy' % '_'.join('%g' % x for x in r), shape=tuple(int(s) for s in shape), factor=None));
+  levels = sorted(levels, key=lambda l: -np.prod(l['shape']));
+  for l in levels:
+    l['resolution'] = None if source_resolution is None else \
+                      tuple(float(r) * s / t for r, s, t in zip(source_resolution, source_shape, l['shape']));
+
+  fu.create_directory(sink, split=False);
+  order = 'F' if res._stream_axis(source) == source.ndim - 1 else 'C';
+  sinks = [];
+  for l in levels:
+    filename = os.path.join(sink, l['file']);
+    io.delete_file(filename);
+    sinks.append(io.initialize(filename, shape=l['shape'], dtype=source.dtype, order=order, as_source=True));
+
+  res._resample_stream(source, sinks, interpolation=res._interpolation_to_cv2(interpolation), processes=processes, verbose=verbose);
+
+  metadata = dict(source=location, source_shape=source_shape, interpolation=interpolation,
+                  source_resolution=None if source_resolution is None else tuple(float(r) for r in source_resolution),
+                  levels=levels);
+  with open(os.path.join(sink, metadata_file), 'w') as f:
+    json.dump(metadata, f, indent=1);
+
+  if verbose:
+    timer.print_elapsed_time('Pyramid with %d levels created' % len(levels));
+
+  return Pyramid(sink);
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def pyramid_location(source):
+  """The default pyramid directory of a source file."""
+  if not isinstance(source, str):
+    return None;
+  base = os.path.splitext(source)[0];
+  for c in '<>,':
+    base = base.replace(c, '_');
+  return base + '_pyramid';
+
+
+def is_pyramid(location):
+  """Checks if the location is a pyramid directory."""
+  if isinstance(location, Pyramid):
+    return True;
+  if isinstance(location, str):
+    return fu.is_file(os.path.join(location, metadata_file));
+  return False;
+
+
+def find_pyramid(source):
+  """The pyramid at the default location of a source if it exists and is up to date."""
+  location = pyramid_location(source);
+  if location is None or not is_pyramid(location) or not fu.is_file(source):
+    return None;
+  if os.path.getmtime(os.path.join(location, metadata_file)) < os.path.getmtime(source):
+    return None;
+  return Pyramid(location);
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import ClearMap.IO.IO as io
+  import ClearMap.Alignment.Pyramid as pyr
+
+  data = np.asarray(np.random.rand(100, 80, 60), dtype='float32', order='F');
+  io.write('test.npy', data);
+
+  pyramid = pyr.create_pyramid('test.npy', factors=(2,4), resolutions=[(5,5,5)], source_resolution=(1,1,1), processes='serial');
+  print(pyramid)
+  print(pyramid.select(sink_shape=(30,20,15)))
+  print(pyramid[1].shape)
+
+  io.delete_file('test.npy');
+  fu.delete_directory(pyr.pyramid_location('test.npy'));
@@ -320,7 +320,7 @@ def resample_factor(source_shape, sink_shape = None, source_resolution = None, s
 def resample(source, sink = None, orientation = None, 
              sink_shape = None, source_resolution = None, sink_resolution = None, 
              interpolation = 'linear', axes_order = None, method = 'shared',
-             processes = None, verbose = True):
+             copy = None, pyramid = None, processes = None, verbose = True):
   """Resample data of source in new shape/resolution and orientation.
   
   Arguments
@@ -346,9 +346,21 @@ def resample(source, sink = None, orientation = None,
     If 'size' the axis order is determined automatically to maximally reduce 
     the size of the array in each resmapling step.
     If 'order' the axis order is chosed automatically to optimize io speed.
-  method : 'shared' or 'memmap'
+  method : 'shared', 'memmap' or 'stream'
     Method to handle intermediate resampling results. If 'shared' use shared 
-    memory, otherwise use a memory map on disk.
+    memory, if 'memmap' use a memory map on disk. If 'stream' resample 3d 
+    data in a single pass over the planes along the slowest axis without 
+    intermediate results, see :func:`_resample_stream`.
+  copy : str or None
+    If given and method is 'stream', also write the source data to this 
+    npy file while it is read, e.g. to convert a file list in the same pass.
+  pyramid : str, Pyramid, True, False or None
+    Pyramid of the source, see :mod:`ClearMap.Alignment.Pyramid`. The 
+    smallest level at least as fine as the sink is resampled instead of the
+    source if the pyramid was built with the same interpolation, pyramids 
+    are never used for 'nearest' interpolation. If True, use the pyramid at
+    the default location of the source if it exists and is up to date. If 
+    None or False, always use the source.
   processes : int, None or 'serial'
     Number of processes to use for parallel resampling, if None use maximal 
     processes avaialable, if 'serial' process in serial.
@@ -375,6 +387,7 @@ def resample(source, sink = None, orientation = None,
   if verbose:
     timer = tmr.Timer();
   
+  location = source;
   source = io.as_source(source);
   source_shape = source.shape;
   ndim = len(source_shape);
@@ -389,6 +402,12 @@ def resample(source, sink = None, orientation = None,
                     orientation=orientation);
   
   sink_shape_in_source_orientation = orient_shape(sink_shape, orientation, inverse=True);
+  
+  #resample from the closest pyramid level
+  level = _pyramid_level(location, source, pyramid, sink_shape_in_source_orientation, interpolation, verbose=verbose);
+  if level is not None:
+    source = level;
+    order = source.order;
                                    
   interpolation = _interpolation_to_cv2(interpolation);                                   
 
@@ -411,6 +430,11 @@ def resample(source, sink = None, orientation = None,
   n_steps = len(axes_order);
   last_source = source;
   delete_files = [];
+  if method == 'stream':
+    n_steps = 0;
+    resampled = io.initialize(source=sink if orientation is None else None, shape=sink_shape_in_source_orientation, dtype=dtype, as_source=True);
+    _resample_stream(source, resampled, interpolation=interpolation, copy=copy, processes=processes, verbose=verbose);
+  
   for step, axes, shape in zip(range(n_steps), axes_order, shape_order):
     if step == n_steps-1 and orientation is None:
       resampled = io.initialize(source=sink, shape=sink_shape, dtype=dtype, as_source=True); 
@@ -423,47 +447,21 @@ def resample(source, sink = None, orientation = None,
         delete_files.append(location);
     #print(resampled)
 
-    #indices for non-resampled axes
-    indices = tuple([range(s) for d,s in enumerate(shape) if d not in axes]);
-    indices = [i for i in itertools.product(*indices)];
-    n_indices = len(indices);
-    
     #resample step
-    last_source_virtual = last_source.as_virtual();
-    resampled_virtual = resampled.as_virtual();
-    _resample = ft.partial(_resample_2d, source=last_source_virtual, sink=resampled_virtual, axes=axes, shape=shape, 
-                                         interpolation=interpolation, n_indices=n_indices, verbose=verbose)                       
-    
-    if processes == 'serial': 
-      for index in indices:
-        _resample(index=index);
-    else:
-      #print(processes);
-      with concurrent.futures.ProcessPoolExecutor(processes) as executor:
-        executor.map(_resample, indices);
+    _resample_step(last_source, resampled, axes=axes, shape=shape, interpolation=interpolation, 
+                   order=last_source.order, processes=processes, verbose=verbose);
         
     last_source = resampled;
   
   #fix orientation
   if not orientation is None:
-    #permute
-    per = orientation_to_permuation(orientation);
-    resampled = resampled.transpose(per);
-
-    #reverse axes
-    reslice = False;
-    slicing = [slice(None)] * ndim;
-    for d,o in enumerate(orientation):
-      if o < 0:
-        slicing[d] = slice(None, None, -1);
-        reslice = True;
-    if reslice:
-      resampled = resampled[slicing];
+    #permute and reverse axes into a contiguous sink
+    if isinstance(sink, str):
+      io.delete_file(sink);
+    sink = io.reorient(resampled, sink, orientation=orientation, processes=processes);
       
     if verbose:
-      print("resample: re-oriented shape %r!" % (resampled.shape,))
-  
-    sink = io.write(sink, resampled);
+      print("resample: re-oriented shape %r!" % (sink_shape,))
   else: 
     sink = resampled;
   
@@ -476,30 +474,261 @@ def resample(source, sink = None, orientation = None,
   return sink;
 
 
+def _pyramid_level(location, source, pyramid, sink_shape, interpolation, verbose = False):
+  """The smallest pyramid level of a source at least as fine as the sink shape."""
+  import ClearMap.Alignment.Pyramid as pyr
+  interpolation = _interpolation_to_cv2(interpolation);
+  if pyramid is None or pyramid is False or interpolation == cv2.INTER_NEAREST:
+    return None;
+  if pyramid is True:
+    pyramid = pyr.find_pyramid(location) if isinstance(location, str) else None;
+  elif not isinstance(pyramid, pyr.Pyramid):
+    pyramid = pyr.Pyramid(pyramid);
+  if pyramid is None or pyramid.source_shape != tuple(source.shape):
+    return None;
+  if _interpolation_to_cv2(pyramid.interpolation) != interpolation:
+    if verbose:
+      print('resampling: pyramid with %r interpolation not used!' % (pyramid.interpolation,));
+    return None;
+  
+  level = pyramid.select(sink_shape=sink_shape);
+  if level is None:
+    return None;
+  if verbose:
+    print('resampling: using pyramid level %r of shape %r!' % (level, pyramid.shape(level)));
+  return pyramid.level(level);
+
+
+def _resample_step(source, sink, axes, shape, interpolation, order = None, processes = None, verbose = False):
+  """Resample source into sink along two axes in parallel slabs of planes.
+  
+  Arguments
+  ---------
+  source : Source
+    The source to resample.
+  sink : Source
+    The sink of the resampling step.
+  axes : tuple of int
+    The two axes to resample.
+  shape : tuple of int
+    The shape of the sink.
+  interpolation : int
+    The cv2 interpolation flag.
+  order : 'C', 'F' or None
+    The memory order of the source used to align the slabs.
+  processes : int or 'serial'
+    The number of processes.
+  verbose : bool
+    If True, print progress information.
+  
+  Note
+  ----
+  Each task resamples a contiguous slab of planes along the slowest varying 
+  non-resampled axis, the source and sink are opened only once per worker.
+  """
+  split, slabs = _resample_slabs(shape, axes, order=order, processes=processes);
+  _resample = ft.partial(_resample_slab, axes=axes, split=split, shape=shape, interpolation=interpolation, 
+                         order=order, n_slabs=len(slabs), verbose=verbose);
+  
+  source_virtual = source.as_virtual();
+  sink_virtual = sink.as_virtual();
+  if processes == 'serial':
+    _initialize_resample_worker(source_virtual, sink_virtual);
+    try:
+      for slab in slabs:
+        _resample(slab);
+    finally:
+      _initialize_resample_worker(None, None);
+  else:
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=_initialize_resample_worker, 
+                                                initargs=(source_virtual, sink_virtual)) as executor:
+      for _ in executor.map(_resample, slabs):
+        pass;
+
+
+def _resample_slabs(shape, axes, order = None, processes = None):
+  """Split the non-resampled axes into slabs of planes to balance the load."""
+  other = [d for d in range(len(shape)) if d not in axes];
+  split = other[-1] if order == 'F' else other[0];
+  n = shape[split];
+  n_tasks = 1 if processes == 'serial' else 4 * processes;
+  size = max(1, -(-n // n_tasks));
+  return split, [(start, min(start + size, n)) for start in range(0, n, size)];
+
+
+_resample_source = None;
+_resample_sink = None;
+
+def _initialize_resample_worker(source, sink):
+  """Open the source and sink once per worker process."""
+  global _resample_source, _resample_sink
+  _resample_source = source.as_real() if source is not None else None;
+  _resample_sink = sink.as_real() if sink is not None else None;
+
+
 @ptb.parallel_traceback
-def _resample_2d(index, source, sink, axes, shape, interpolation, n_indices, verbose):
-  """Resampling helper function to use for parallel resampling of image slices"""
+def _resample_slab(slab, axes, split, shape, interpolation, order, n_slabs, verbose):
+  """Resampling helper function to use for parallel resampling of slabs of image planes."""
+  start, stop = slab;
   if verbose:
-    pw.ProcessWriter(index).write("Resampling: resampling axes %r, slice %r / %d" % (axes, index, n_indices))
-  
-  #slicing
-  ndim = len(shape);   
-  slicing = ();
-  i = 0;
-  for d in range(ndim):
-    if d in axes:
-      slicing += (slice(None),);
-    else:
-      slicing += (index[i],);
-      i += 1;
+    pw.ProcessWriter(start).write("Resampling: resampling axes %r, planes %d-%d along axis %d / %d slabs" % (axes, start, stop, split, n_slabs))
+  
+  ndim = len(shape);
+  other = [d for d in range(ndim) if d not in axes];
+  if order == 'F':
+    other = other[::-1];
+  ranges = [range(start, stop) if d == split else range(shape[d]) for d in other];
+  
+  source, sink = _resample_source, _resample_sink;
+  for index in itertools.product(*ranges):
+    slicing = [slice(None)] * ndim;
+    for d, i in zip(other, index):
+      slicing[d] = i;
+    slicing = tuple(slicing);
+    sink[slicing] = cv2.resize(source[slicing], (shape[axes[1]], shape[axes[0]]), interpolation=interpolation);
+    #note cv2 takes reverse shape order !
+
+
+def _resample_stream(source, sink, interpolation, copy = None, processes = None, verbose = False):
+  """Resample 3d data in a single pass over the planes along its slowest axis.
+  
+  Arguments
+  ---------
+  source : Source
+    The 3d source to resample.
+  sink : Source or list of Sources
+    The sink with the resampled shape or several sinks to resample to in the 
+    same pass, e.g. the levels of a pyramid.
+  interpolation : int
+    The cv2 interpolation flag.
+  copy : str or None
+    Optional npy file to write the source planes to while they are read.
+  processes : int or 'serial'
+    The number of processes.
+  verbose : bool
+    If True, print progress information.
+  
+  Note
+  ----
+  Each source plane is read once and resized in-plane. File list sources are
+  streamed along the files so that each file is decoded once.
+  The resized planes are combined along the streamed axis with area, linear 
+  or nearest weights into the sink planes of each slab, so that only the 
+  final sink is written and no intermediate volumes are created.
+  """
+  if source.ndim != 3:
+    raise ValueError('resampling: streaming requires 3d data, got %dd!' % source.ndim);
+  sinks = sink if isinstance(sink, (list, tuple)) else [sink];
+  
+  axis = _stream_axis(source);
+  axes = tuple(d for d in range(source.ndim) if d != axis);
+  plane_shapes = [tuple(s.shape[d] for d in axes) for s in sinks];
+  weights = [_axis_weights(source.shape[axis], s.shape[axis], interpolation) for s in sinks];
+  
+  #slabs of source planes, each sink plane is computed in the slab of its first source plane
+  n_source = source.shape[axis];
+  _, slabs = _resample_slabs(source.shape, axes, processes=processes);
+  first = [np.argmax(w > 0, axis=1) for w in weights];
+  slabs = [(start, stop, [tuple(np.searchsorted(f, [start, stop])) for f in first]) for start, stop in slabs];
+  slabs = [slab for slab in slabs if copy is not None or any(r[0] < r[1] for r in slab[2])];
+  
+  if copy is not None:
+    copy = io.initialize(copy, shape=source.shape, dtype=source.dtype, order=source.order, as_source=True);
+  
+  _resample = ft.partial(_resample_stream_slab, axis=axis, plane_shapes=plane_shapes, weights=weights,
+                         interpolation=interpolation, copy=copy is not None, n_slabs=len(slabs), verbose=verbose);
+  
+  def _write(slab, results):
+    for sink, (start, stop), planes in zip(sinks, slab[2], results):
+      if start == stop:
+        continue;
+      dtype = np.dtype(sink.dtype);
+      if dtype.kind in 'iu':
+        info = np.iinfo(dtype);
+        planes = np.clip(np.round(planes), info.min, info.max);
+      slicing = [slice(None)] * sink.ndim;
+      slicing[axis] = slice(start, stop);
+      sink[tuple(slicing)] = np.moveaxis(planes, 0, axis).astype(dtype, copy=False);
+  
+  source_virtual = source.as_virtual();
+  copy_virtual = copy.as_virtual() if copy is not None else None;
+  if processes == 'serial':
+    _initialize_resample_worker(source_virtual, copy_virtual);
+    try:
+      for slab in slabs:
+        _write(slab, _resample(slab));
+    finally:
+      _initialize_resample_worker(None, None);
+  else:
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=_initialize_resample_worker, 
+                                                initargs=(source_virtual, copy_virtual)) as executor:
+      for slab, results in zip(slabs, executor.map(_resample, slabs)):
+        _write(slab, results);
+
+
+@ptb.parallel_traceback
+def _resample_stream_slab(slab, axis, plane_shapes, weights, interpolation, copy, n_slabs, verbose):
+  """Resampling helper function to stream the source planes of a slab into the sink planes."""
+  start, stop, ranges = slab;
+  rows = [w[a:b] for w, (a, b) in zip(weights, ranges)];
+  planes = [np.nonzero(np.any(r > 0, axis=0))[0] for r in rows];
+  if copy:
+    planes.append(np.arange(start, stop));
+  planes = np.unique(np.concatenate(planes));
+  if verbose:
+    pw.ProcessWriter(start).write("Resampling: streaming planes %d-%d along axis %d / %d slabs" % (planes[0], planes[-1], axis, n_slabs))
   
-  #resample planeresizeresizeresize
-  sink = sink.as_real()
-  source = source.as_real();
-  #print(source.shape, sink.shape, source[slicing].shape, sink[slicing].shape)
-  #print(shape, axes)
-  sink[slicing] = cv2.resize(source[slicing], (shape[axes[1]], shape[axes[0]]), interpolation=interpolation);
-  #note cv2 takes reverse shape order !
+  source, copy = _resample_source, _resample_sink;
+  if isinstance(source, fl.Source):
+    read = ft.partial(source.__getitem__, processes='serial');
+  else:
+    read = source.__getitem__;
+  
+  results = [np.zeros((b - a,) + s, dtype=np.float32) for (a, b), s in zip(ranges, plane_shapes)];
+  slicing = [slice(None)] * source.ndim;
+  for j in planes:
+    slicing[axis] = j;
+    plane = read(tuple(slicing));
+    if copy is not None and start <= j < stop:
+      copy[tuple(slicing)] = plane;
+    plane = np.asarray(plane, dtype=np.float32);
+    for result, r, shape in zip(results, rows, plane_shapes):
+      w = r[:, j];
+      if not np.any(w):
+        continue;
+      resized = plane if plane.shape == shape else cv2.resize(plane, (shape[1], shape[0]), interpolation=interpolation);
+      for i in np.nonzero(w)[0]:
+        result[i] += w[i] * resized;
+  return results;
+
+
+def _stream_axis(source):
+  """The slowest axis to read a source plane by plane."""
+  if isinstance(source, fl.Source):
+    return source.axes_list[-1];
+  return source.ndim - 1 if source.order == 'F' else 0;
+
+
+def _axis_weights(n_source, n_sink, interpolation):
+  """Weights of the source planes for each sink plane along an axis as in cv2.resize."""
+  weights = np.zeros((n_sink, n_source));
+  scale = float(n_source) / n_sink;
+  k = np.arange(n_sink);
+  if interpolation == cv2.INTER_NEAREST:
+    weights[k, np.minimum(np.floor(k * scale).astype(int), n_source - 1)] = 1;
+  elif interpolation == cv2.INTER_AREA and scale > 1:
+    edges = np.arange(n_sink + 1) * scale;
+    for i in k:
+      lo, hi = edges[i], edges[i+1];
+      j = np.arange(int(np.floor(lo)), min(int(np.ceil(hi)), n_source));
+      weights[i, j] = (np.minimum(j + 1, hi) - np.maximum(j, lo)) / scale;
+  else:
+    x = np.clip((k + 0.5) * scale - 0.5, 0, n_source - 1);
+    j0 = np.floor(x).astype(int);
+    j1 = np.minimum(j0 + 1, n_source - 1);
+    np.add.at(weights, (k, j0), 1 - (x - j0));
+    np.add.at(weights, (k, j1), x - j0);
+  return weights;
 
 
 def _axes_order(axes_order, source, sink_shape_in_source_orientation, order = None): 
@@ -753,21 +982,9 @@ def resample_inverse(source, sink = None,
   
   #reversed orientation
   if not orientation is None:
-    #reverse axes
-    slicing = [slice(None)] * ndim;
-    reslice = False;
-    for d,o in enumerate(orientation):
-      if o < 0:
-        slicing[d] = slice(None, None, -1);
-        reslice = True;
-    if reslice:
-      source = source[slicing];   
-    
-    #re-orient
-    per = orientation_to_permuation(orientation_inverse);
-    source = io.read(source);
-    source = source.transpose(per);
-    source = io.sma.as_shared(source);
+    #reverse axes and re-orient
+    source = io.reorient(source, orientation=orientation_inverse, order='C', processes=processes);
+    source = io.sma.as_shared(source.array);
  
   #reverse resampling steps
   axes_order = axes_order[::-1];
@@ -793,23 +1010,9 @@ def resample_inverse(source, sink = None,
         resampled = io.mmp.create(location, shape=shape, dtype=dtype, order='C', as_source=True);
         delete_files.append(location);
 
-    #indices for non-resampled axes
-    indices = tuple([range(s) for d,s in enumerate(shape) if d not in axes]);
-    indices = [i for i in itertools.product(*indices)];
-    n_indices = len(indices);
-    
     #resample step
-    last_source_virtual = last_source.as_virtual();
-    resampled_virtual = resampled.as_virtual();
-    _resample = ft.partial(_resample_2d, source=last_source_virtual, sink=resampled_virtual, axes=axes, shape=shape, 
-                                         interpolation=interpolation, n_indices=n_indices, verbose=verbose)                       
-    
-    if processes == 'serial': 
-      for index in indices:
-        _resample(index=index);
-    else:
-      with concurrent.futures.ProcessPoolExecutor(processes) as executor:
-        executor.map(_resample, indices);
+    _resample_step(last_source, resampled, axes=axes, shape=shape, interpolation=interpolation, 
+                   order=last_source.order, processes=processes, verbose=verbose);
         
     last_source = resampled;
   
@@ -906,7 +1109,7 @@ def resample_points(source, sink = None, resample_source = None, resample_sink =
         slicing[d] = slice(None, None, -1);
         reslice = True;
     if reslice:
-      resampled = resampled[slicing];
+      resampled = resampled[tuple(slicing)];
   
   return io.write(sink, resampled);
 
@@ -0,0 +1,865 @@
+# -*- coding: utf-8 -*-
+"""
+Transformation
+==============
+
+Evaluation of elastix transformations in python.
+
+This module parses the elastix transform parameter files
+(TransformParameters.*.txt) including chains of initial transforms and
+evaluates the transformation :math:`T(x)` on point arrays in vectorized,
+chunked and multi-threaded form without calling the transformix binary.
+
+Supported transforms are translation, Euler, similarity, affine and
+B-spline transforms combined via 'Compose' or 'Add'.
+
+Displacement fields of a transformation can be cached next to the parameter
+files to map repeated point sets by interpolation and label volumes such as
+the annotation are warped block-parallel with nearest neighbour sampling or
+only measured via :func:`label_volumes`.
+
+Example
+-------
+>>> import ClearMap.Alignment.Transformation as trf
+>>> transformation = trf.transformation(transform_directory='elastix_auto_to_reference')
+>>> transformation
+>>> points = trf.transform_points(cells, transform_directory='elastix_auto_to_reference')
+>>> trf.transform_labels('annotation.tif', 'annotation_warped.npy', transform_directory='elastix_auto_to_reference')
+
+See Also
+--------
+:func:`ClearMap.Alignment.Elastix.transform_points`
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+
+import os
+import re
+import hashlib
+import tempfile
+import multiprocessing as mp
+import concurrent.futures
+
+import numpy as np
+import scipy.ndimage as ndi
+
+import ClearMap.IO.IO as io
+import ClearMap.IO.FileUtils as fu
+
+import ClearMap.ParallelProcessing.BlockProcessing as bp
+
+import ClearMap.Utils.Timer as tmr
+
+
+###############################################################################
+### Parameter files
+###############################################################################
+
+def read_parameter_file(filename):
+  """Parse an elastix parameter file.
+
+  Arguments
+  ---------
+  filename : str
+    The parameter file.
+
+  Returns
+  -------
+  parameters : dict
+    The parameters as lists of numbers or strings.
+  """
+  token = re.compile(r'"[^"]*"|[^\s()]+');
+  parameters = dict();
+  with open(filename) as parfile:
+    for line in parfile:
+      line = line.split('//')[0].strip();
+      if not line.startswith('('):
+        continue;
+      tokens = token.findall(line);
+      if len(tokens) == 0:
+        continue;
+      name, values = tokens[0], tokens[1:];
+      if name == 'TransformParameters':
+        parameters[name] = np.array(values, dtype=float);
+      else:
+        parameters[name] = [_parse_value(v) for v in values];
+  return parameters;
+
+
+def transform_file(transform_parameter_file = None, transform_directory = None):
+  """The transform parameter file from either the file or elastix result directory.
+
+  Arguments
+  ---------
+  transform_parameter_file : str or None
+    File name of the transformation parameter file.
+  transform_directory : str or None
+    Elastix result directory, used if no file is given.
+
+  Returns
+  -------
+  transform_parameter_file : str
+    The top level transform parameter file.
+  """
+  if transform_parameter_file is not None:
+    return transform_parameter_file;
+  if transform_directory is None:
+    raise ValueError('Neither the alignment directory nor the transformation parameter file is specified!');
+  files = sorted(f for f in os.listdir(transform_directory) if re.match(r'TransformParameters.\d.txt', f));
+  if len(files) == 0:
+    raise RuntimeError('Cannot find a valid transformation file in %r!' % transform_directory);
+  return os.path.join(transform_directory, files[-1]);
+
+
+###############################################################################
+### Transformations
+###############################################################################
+
+class Transformation(object):
+  """Base class of elastix transformations."""
+
+  def __init__(self, parameters, initial = None, filename = None):
+    """Transformation constructor.
+
+    Arguments
+    ---------
+    parameters : dict
+      The parsed transform parameters.
+    initial : Transformation or None
+      The initial transformation.
+    filename : str or None
+      The transform parameter file.
+    """
+    self.parameters = parameters;
+    self.initial = initial;
+    self.filename = filename;
+    self.combination = self.parameter('HowToCombineTransforms', 'Compose');
+    if self.combination not in ('Compose', 'Add'):
+      raise ValueError('Transform combination %r not supported!' % self.combination);
+
+  def parameter(self, name, default = None):
+    """A scalar parameter."""
+    value = self.parameters.get(name, None);
+    if value is None or len(value) == 0:
+      return default;
+    return value[0];
+
+  def array(self, name, default = None):
+    """A vector parameter."""
+    value = self.parameters.get(name, None);
+    if value is None:
+      return default;
+    return np.array(value, dtype=float);
+
+  @property
+  def ndim(self):
+    return int(self.parameter('FixedImageDimension', 3));
+
+  @property
+  def name(self):
+    return self.parameter('Transform');
+
+  @property
+  def transformations(self):
+    """The chain of transformations, initial first."""
+    chain = [] if self.initial is None else self.initial.transformations;
+    return chain + [self];
+
+  @property
+  def fixed_size(self):
+    return tuple(int(s) for s in self.array('Size'));
+
+  @property
+  def fixed_spacing(self):
+    return self.array('Spacing', np.ones(self.ndim));
+
+  @property
+  def fixed_origin(self):
+    return self.array('Origin', np.zeros(self.ndim));
+
+  @property
+  def fixed_direction(self):
+    direction = self.array('Direction', None);
+    if direction is None:
+      return np.eye(self.ndim);
+    return direction.reshape((self.ndim, self.ndim)).T;
+
+  def index_to_point(self, indices):
+    """Physical coordinates of indices of the fixed image."""
+    indices = np.asarray(indices, dtype=float);
+    return self.fixed_origin + np.dot(indices * self.fixed_spacing, self.fixed_direction.T);
+
+  def point_to_index(self, points):
+    """Continuous indices in the fixed image of physical coordinates."""
+    points = np.asarray(points, dtype=float);
+    return np.dot(points - self.fixed_origin, np.linalg.inv(self.fixed_direction).T) / self.fixed_spacing;
+
+  def transform_points(self, points):
+    """Apply the transformation chain to points.
+
+    Arguments
+    ---------
+    points : array
+      Physical coordinates of shape (n, ndim).
+
+    Returns
+    -------
+    points : array
+      The transformed coordinates :math:`T(x)`.
+    """
+    points = np.asarray(points, dtype=float);
+    if self.initial is None:
+      return self._transform_points(points);
+    if self.combination == 'Compose':
+      return self._transform_points(self.initial.transform_points(points));
+    else:
+      return self._transform_points(points) + self.initial.transform_points(points) - points;
+
+  def __call__(self, points):
+    return self.transform_points(points);
+
+  def _transform_points(self, points):
+    raise NotImplementedError();
+
+  def __str__(self):
+    return 'Transformation[%s]{%s}' % (' -> '.join(t.name for t in self.transformations), self.filename);
+
+  def __repr__(self):
+    return self.__str__();
+
+
+class MatrixTransformation(Transformation):
+  """Translation, Euler, similarity or affine transformation :math:`T(x) = A (x - c) + t + c`."""
+
+  def __init__(self, parameters, initial = None, filename = None):
+    super(MatrixTransformation, self).__init__(parameters, initial=initial, filename=filename);
+    ndim = self.ndim;
+    p = self.parameters['TransformParameters'];
+    name = self.name;
+    if name == 'TranslationTransform':
+      matrix = np.eye(ndim);
+      translation = p;
+    elif name == 'AffineTransform':
+      matrix = p[:ndim*ndim].reshape((ndim, ndim));
+      translation = p[ndim*ndim:];
+    elif name == 'EulerTransform':
+      if ndim == 2:
+        matrix = _rotation_2d(p[0]);
+        translation = p[1:];
+      else:
+        matrix = _euler_3d(p[:3], self.parameter('ComputeZYX', 'false') == 'true');
+        translation = p[3:];
+    elif name == 'SimilarityTransform':
+      if ndim == 2:
+        matrix = p[0] * _rotation_2d(p[1]);
+        translation = p[2:];
+      else:
+        matrix = p[6] * _versor_3d(p[:3]);
+        translation = p[3:6];
+    else:
+      raise ValueError('Transform %r is not a matrix transform!' % name);
+
+    self.matrix = matrix;
+    self.translation = np.asarray(translation, dtype=float);
+    self.center = self.array('CenterOfRotationPoint', np.zeros(ndim));
+
+  def _transform_points(self, points):
+    return np.dot(points - self.center, self.matrix.T) + self.translation + self.center;
+
+
+class BSplineTransformation(Transformation):
+  """B-spline transformation :math:`T(x) = x + \\sum_k c_k \\beta(x - x_k)`."""
+
+  def __init__(self, parameters, initial = None, filename = None):
+    super(BSplineTransformation, self).__init__(parameters, initial=initial, filename=filename);
+    if self.parameter('UseCyclicTransform', 'false') == 'true':
+      raise ValueError('Cyclic B-spline transforms are not supported!');
+    ndim = self.ndim;
+    self.order = int(self.parameter('BSplineTransformSplineOrder', 3));
+    self.grid_size = np.array(self.array('GridSize'), dtype=int);
+    self.grid_origin = self.array('GridOrigin');
+    grid_spacing = self.array('GridSpacing');
+    grid_direction = self.array('GridDirection', None);
+    grid_direction = np.eye(ndim) if grid_direction is None else grid_direction.reshape((ndim, ndim)).T;
+    self.point_to_grid = np.linalg.inv(grid_direction * grid_spacing);
+    # coefficients are stored per dimension with the first grid axis fastest
+    self.coefficients = [c.reshape(tuple(self.grid_size), order='F') for c in self.parameters['TransformParameters'].reshape((ndim, -1))];
+
+  def _transform_points(self, points):
+    cindex = np.dot(points - self.grid_origin, self.point_to_grid.T);
+
+    # points outside the support of the grid are not displaced
+    start = np.floor(cindex - (self.order - 1) / 2.0);
+    inside = np.all((start >= 0) & (start + self.order < self.grid_size), axis=1);
+    cindex = cindex[inside].T;
+
+    points = points.copy();
+    for d in range(self.ndim):
+      points[inside, d] += ndi.map_coordinates(self.coefficients[d], cindex, order=self.order, prefilter=False);
+    return points;
+
+
+transformation_classes = {'TranslationTransform'      : MatrixTransformation,
+                          'EulerTransform'            : MatrixTransformation,
+                          'SimilarityTransform'       : MatrixTransformation,
+                          'AffineTransform'           : MatrixTransformation,
+                          'BSplineTransform'          : BSplineTransformation,
+                          'RecursiveBSplineTransform' : BSplineTransformation};
+"""Map from elastix transform names to transformation classes."""
+
+
+def transformation(transform_parameter_file = None, transform_directory = None):
+  """Read an elastix transformation including its initial transforms.
+
+  Arguments
+  ---------
+  transform_parameter_file : str or None
+    Parameter file of the primary transformation.
+    If None, the file is determined from the transform_directory.
+  transform_directory : str or None
+    Result directory of elastix alignment.
+    If None the transform_parameter_file has to be given.
+
+  Returns
+  -------
+  transformation : Transformation
+    The transformation.
+  """
+  filename = transform_file(transform_parameter_file, transform_directory);
+  parameters = read_parameter_file(filename);
+
+  name = parameters['Transform'][0];
+  if name not in transformation_classes:
+    raise ValueError('Transform %r not supported, use transformix instead!' % name);
+
+  initial = parameters.get('InitialTransformParametersFileName', ['NoInitialTransform'])[0];
+  if initial == 'NoInitialTransform':
+    initial = None;
+  else:
+    # files of moved result directories are found next to the parameter file
+    if not os.path.exists(initial):
+      initial = os.path.join(os.path.dirname(filename), os.path.basename(initial));
+    initial = transformation(transform_parameter_file=initial);
+
+  return transformation_classes[name](parameters, initial=initial, filename=filename);
+
+
+###############################################################################
+### Point transformations
+###############################################################################
+
+def transform_points(source, sink = None, transform_parameter_file = None, transform_directory = None, indices = False,
+                     field = False, chunk_size = 2**16, processes = None, verbose = False):
+  """Transform coordinates :math:`x` via an elastix transformation to :math:`T(x)`.
+
+  Arguments
+  ---------
+  source : str or array
+    Source of the points.
+  sink : str or None
+    Sink for transformed points.
+  transform_parameter_file : str, Transformation or None
+    Parameter file for the primary transformation or a transformation.
+    If None, the file is determined from the transform_directory.
+  transform_directory : str or None
+    Result directory of elastix alignment.
+    If None the transform_parameter_file has to be given.
+  indices : bool
+    If True use points as pixel coordinates of the fixed image otherwise
+    spatial coordinates. As in transformix the result indices are rounded.
+  field : bool or str
+    If False, evaluate the transformation exactly. If True, interpolate the 
+    cached displacement field of the transformation, creating it if needed, 
+    see :func:`cached_displacement_field`. If a file name, interpolate this
+    displacement field, see :func:`displacement_field`.
+  chunk_size : int
+    Number of points transformed in one step.
+  processes : int or None
+    Number of threads to use.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  points : array or str
+    Array or file name of transformed points.
+
+  Note
+  ----
+  This is an in-process replacement of
+  :func:`ClearMap.Alignment.Elastix.transform_points`.
+  """
+  if verbose:
+    timer = tmr.Timer();
+
+  t = _transformation(transform_parameter_file, transform_directory);
+
+  points = np.asarray(io.read(source), dtype=float);
+  if points.ndim != 2 or points.shape[1] != t.ndim:
+    raise ValueError('Points of shape %r do not match a %d dimensional transformation!' % (points.shape, t.ndim));
+
+  field = _displacement_field_source(t, field, processes=processes, verbose=verbose);
+  if field is not None:
+    field = field.array;
+
+  result = np.zeros(points.shape);
+  def _transform(start):
+    chunk = points[start:start+chunk_size];
+    if indices:
+      chunk = t.index_to_point(chunk);
+    chunk = _transform_physical_points(t, chunk, field);
+    if indices:
+      chunk = np.floor(t.point_to_index(chunk) + 0.5);
+    result[start:start+chunk_size] = chunk;
+
+  _map_chunks(_transform, len(points), chunk_size, processes);
+
+  if verbose:
+    timer.print_elapsed_time('Transformation of %d points' % len(points));
+
+  return io.write(sink, result);
+
+
+###############################################################################
+### Displacement fields
+###############################################################################
+
+def transformation_hash(transform_parameter_file = None, transform_directory = None):
+  """Hash of the parameter files of a transformation chain.
+
+  Arguments
+  ---------
+  transform_parameter_file : str, Transformation or None
+    Parameter file for the primary transformation or a transformation.
+  transform_directory : str or None
+    Result directory of elastix alignment.
+
+  Returns
+  -------
+  hash : str
+    The hex digest of the parameters.
+
+  Note
+  ----
+  The paths to the initial transforms are ignored as they are rewritten
+  when result directories are moved, see
+  :func:`ClearMap.Alignment.Elastix.set_path_transform_files`.
+  """
+  t = _transformation(transform_parameter_file, transform_directory);
+  h = hashlib.sha1();
+  for tt in t.transformations:
+    with open(tt.filename, 'rb') as parfile:
+      for line in parfile:
+        if not line.startswith(b'(InitialTransformParametersFileName'):
+          h.update(line);
+  return h.hexdigest();
+
+
+def displacement_field_file(transform_parameter_file = None, transform_directory = None):
+  """The cache file of the displacement field of a transformation next to its parameter file."""
+  t = _transformation(transform_parameter_file, transform_directory);
+  return os.path.join(os.path.dirname(fu.abspath(t.filename)), 'displacement_field_%s.npy' % transformation_hash(t)[:16]);
+
+
+def displacement_field(transform_parameter_file = None, transform_directory = None, sink = None,
+                       chunk_size = 2**18, processes = None, verbose = False):
+  """Displacement field :math:`T(x) - x` on the fixed image grid.
+
+  Arguments
+  ---------
+  transform_parameter_file : str, Transformation or None
+    Parameter file for the primary transformation or a transformation.
+  transform_directory : str or None
+    Result directory of elastix alignment.
+  sink : str, array or None
+    Sink for the field of shape (ndim,) + fixed image size.
+  chunk_size : int
+    Approximate number of grid points evaluated in one step.
+  processes : int or None
+    Number of threads to use.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  field : Source
+    The displacement field in physical units.
+
+  Note
+  ----
+  This is the native equivalent of 
+  :func:`ClearMap.Alignment.Elastix.deformation_field` with the vector
+  components as the first axis.
+  """
+  if verbose:
+    timer = tmr.Timer();
+
+  t = _transformation(transform_parameter_file, transform_directory);
+  size = t.fixed_size;
+  sink = io.initialize(sink, shape=(t.ndim,) + size, dtype='float32', order='C');
+  field = sink.array;
+
+  planes = max(1, chunk_size // int(np.prod(size[1:])));
+  def _evaluate(start):
+    stop = min(start + planes, size[0]);
+    grid = np.meshgrid(np.arange(start, stop), *[np.arange(s) for s in size[1:]], indexing='ij');
+    points = t.index_to_point(np.array([g.ravel() for g in grid]).T);
+    displacement = t.transform_points(points) - points;
+    field[:, start:stop] = displacement.T.reshape((t.ndim, stop - start) + size[1:]);
+
+  _map_chunks(_evaluate, size[0], planes, processes);
+
+  if verbose:
+    timer.print_elapsed_time('Displacement field of shape %r' % (size,));
+
+  return sink;
+
+
+def cached_displacement_field(transform_parameter_file = None, transform_directory = None, create = True,
+                              processes = None, verbose = False):
+  """The displacement field of a transformation cached next to its parameter file.
+
+  Arguments
+  ---------
+  transform_parameter_file : str, Transformation or None
+    Parameter file for the primary transformation or a transformation.
+  transform_directory : str or None
+    Result directory of elastix alignment.
+  create : bool
+    If True, compute the field if it is not cached.
+  processes : int or None
+    Number of threads to use.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  field : Source or None
+    The displacement field or None if it is not cached and not created.
+
+  Note
+  ----
+  The cache file is keyed on the hash of the parameter files, so changed
+  registrations never use stale fields.
+  """
+  t = _transformation(transform_parameter_file, transform_directory);
+  location = displacement_field_file(t);
+  if not os.path.exists(location):
+    if not create:
+      return None;
+    # write to a unique file first so concurrent calls never read partial fields
+    fh, temporary = tempfile.mkstemp(dir=os.path.dirname(location), suffix='.npy');
+    os.close(fh);
+    os.remove(temporary);
+    try:
+      displacement_field(t, sink=temporary, processes=processes, verbose=verbose);
+      os.replace(temporary, location);
+    finally:
+      if os.path.exists(temporary):
+        os.remove(temporary);
+  elif verbose:
+    print('Using cached displacement field %s' % location);
+  return io.as_source(location);
+
+
+###############################################################################
+### Label transformations
+###############################################################################
+
+def transform_labels(source, sink = None, transform_parameter_file = None, transform_directory = None,
+                     field = False, chunk_size = 2**22, processes = None, verbose = False):
+  """Warp a label volume onto the fixed image grid with nearest neighbour interpolation.
+
+  Arguments
+  ---------
+  source : str or array
+    The label volume in the moving image frame, e.g. the annotation.
+  sink : str or None
+    The sink for the labels on the fixed image grid. If None, a shared
+    memory array is created.
+  transform_parameter_file : str, Transformation or None
+    Parameter file for the primary transformation or a transformation.
+  transform_directory : str or None
+    Result directory of elastix alignment.
+  field : bool or str
+    Interpolate a displacement field instead of evaluating the 
+    transformation exactly, see :func:`transform_points`.
+  chunk_size : int
+    Approximate number of voxels in a processing block.
+  processes : int, 'serial' or None
+    Number of processes to use.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  sink : Source
+    The warped labels in the dtype of the source.
+
+  Note
+  ----
+  This replaces warping labels with transformix and a final B-spline 
+  interpolation order of 0. The blocks of the sink are processed in parallel 
+  and gather the labels from the memory mapped source, which is assumed to 
+  have unit spacing and zero origin as elastix assumes for tif files.
+  """
+  if verbose:
+    timer = tmr.Timer();
+
+  t = _transformation(transform_parameter_file, transform_directory);
+  labels = io.as_source(source);
+  if len(labels.shape) != t.ndim:
+    raise ValueError('Label volume of shape %r does not match a %d dimensional transformation!' % (labels.shape, t.ndim));
+  if not isinstance(source, str):
+    source = labels;
+
+  field = _displacement_field_source(t, field, processes=processes, verbose=verbose);
+  if field is not None:
+    field = field.location;
+
+  shape = t.fixed_size;
+  sink = io.initialize(sink, shape=shape, dtype=labels.dtype, order=labels.order, memory='shared' if sink is None else None);
+
+  axis = len(shape) - 1 if sink.order == 'F' else 0;
+  size_max = max(1, chunk_size // (int(np.prod(shape)) // shape[axis]));
+
+  bp.process(_transform_labels_block, sink, sink=None, function_type='block',
+             axes=[axis], size_max=size_max, size_min=1, overlap=0, optimization=False,
+             processes=processes, verbose=verbose,
+             labels=source, transformation=t, field=field);
+
+  if verbose:
+    timer.print_elapsed_time('Label transformation to shape %r' % (shape,));
+
+  return sink;
+
+
+def _transform_labels_block(block, labels = None, transformation = None, field = None):
+  """Gather the labels of a block of the fixed image grid."""
+  t = transformation;
+  lower = block.valid.base_lower;
+  upper = block.valid.base_upper;
+
+  grid = np.meshgrid(*[np.arange(l, u) for l, u in zip(lower, upper)], indexing='ij');
+  points = t.index_to_point(np.array([g.ravel() for g in grid]).T);
+  if field is not None:
+    field = io.as_source(field).array;
+  points = _transform_physical_points(t, points, field);
+
+  values = _gather_labels(io.as_source(labels), points);
+  block.valid[:] = values.reshape(tuple(u - l for l, u in zip(lower, upper)));
+
+
+def label_volumes(source, ids, transform_parameter_file = None, transform_directory = None, jacobian = False,
+                  field = False, chunk_size = 2**22, processes = None, verbose = False):
+  """Volumes of the labels warped onto the fixed image grid without writing the warped labels.
+
+  Arguments
+  ---------
+  source : str or array
+    The label volume in the moving image frame, e.g. the annotation.
+  ids : array
+    The label ids to measure.
+  transform_parameter_file : str, Transformation or None
+    Parameter file for the primary transformation or a transformation.
+  transform_directory : str or None
+    Result directory of elastix alignment.
+  jacobian : bool
+    If True, weight each voxel with the determinant of the Jacobian of the
+    transformation estimated by finite differences, i.e. measure the volumes
+    in the moving image frame.
+  field : bool or str
+    Interpolate a displacement field instead of evaluating the 
+    transformation exactly, see :func:`transform_points`.
+  chunk_size : int
+    Approximate number of voxels processed in one step.
+  processes : int, 'serial' or None
+    Number of threads to use.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  volumes : array
+    The number of fixed image voxels of each label in ids, weighted with the 
+    Jacobian determinant if requested.
+
+  Note
+  ----
+  The labels are gathered block by block as in :func:`transform_labels` and
+  counted immediately, so this equals counting the voxels of the warped 
+  labels at the cost of evaluating the existing transformation once.
+  """
+  if verbose:
+    timer = tmr.Timer();
+
+  t = _transformation(transform_parameter_file, transform_directory);
+  labels = io.as_source(source);
+  if len(labels.shape) != t.ndim:
+    raise ValueError('Label volume of shape %r does not match a %d dimensional transformation!' % (labels.shape, t.ndim));
+
+  field = _displacement_field_source(t, field, processes=processes, verbose=verbose);
+  if field is not None:
+    field = field.array;
+
+  ids = np.asarray(ids);
+  sorter = np.argsort(ids, kind='stable');
+  n_ids = len(ids);
+
+  size = t.fixed_size;
+  planes = max(1, chunk_size // int(np.prod(size[1:])));
+  counts = [];
+  def _count(start):
+    stop = min(start + planes, size[0]);
+    grid = np.meshgrid(np.arange(start, stop), *[np.arange(s) for s in size[1:]], indexing='ij');
+    points = t.index_to_point(np.array([g.ravel() for g in grid]).T);
+    transformed = _transform_physical_points(t, points, field);
+    values = _gather_labels(labels, transformed);
+
+    position = np.clip(np.searchsorted(ids, values, sorter=sorter), 0, n_ids - 1);
+    codes = np.where(ids[sorter[position]] == values, sorter[position], n_ids);
+
+    weights = None;
+    if jacobian:
+      steps = t.fixed_spacing * t.fixed_direction;
+      differences = [(_transform_physical_points(t, points + steps[:, d], field) - transformed) / t.fixed_spacing[d]
+                     for d in range(t.ndim)];
+      weights = np.abs(np.linalg.det(np.stack(differences, axis=-1)));
+    counts.append(np.bincount(codes, weights=weights, minlength=n_ids + 1)[:n_ids]);
+
+  _map_chunks(_count, size[0], planes, processes);
+
+  volumes = np.sum(counts, axis=0) if counts else np.zeros(n_ids);
+
+  if verbose:
+    timer.print_elapsed_time('Label volumes on the grid of shape %r' % (size,));
+
+  return volumes;
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def _transform_physical_points(t, points, field = None):
+  """Transform physical points, interpolating a displacement field array if given."""
+  if field is None:
+    return t.transform_points(points);
+  # trilinear interpolation inside the field, exact evaluation outside
+  index = t.point_to_index(points);
+  inside = np.all((index >= 0) & (index <= np.array(t.fixed_size) - 1), axis=1);
+  transformed = points.copy();
+  for d in range(t.ndim):
+    transformed[inside, d] += ndi.map_coordinates(field[d], index[inside].T, order=1);
+  transformed[~inside] = t.transform_points(points[~inside]);
+  return transformed;
+
+
+def _gather_labels(labels, points):
+  """Nearest neighbour labels at physical points of a label source with unit spacing, zero outside."""
+  index = np.asarray(np.floor(points + 0.5), dtype=np.int64);
+  inside = np.all((index >= 0) & (index < np.array(labels.shape)), axis=1);
+  values = np.zeros(len(points), dtype=labels.dtype);
+  values[inside] = labels.array[tuple(index[inside].T)];
+  return values;
+
+
+def _displacement_field_source(t, field, processes = None, verbose = False):
+  """The displacement field selected by a field argument or None for exact evaluation."""
+  if field is None or field is False:
+    return None;
+  if field is True:
+    return cached_displacement_field(t, processes=processes, verbose=verbose);
+  field = io.as_source(field);
+  if tuple(field.shape) != (t.ndim,) + t.fixed_size:
+    raise ValueError('Displacement field of shape %r does not match the transformation %r!' % (field.shape, (t.ndim,) + t.fixed_size));
+  return field;
+
+
+def _transformation(transform_parameter_file, transform_directory):
+  if isinstance(transform_parameter_file, Transformation):
+    return transform_parameter_file;
+  return transformation(transform_parameter_file=transform_parameter_file, transform_directory=transform_directory);
+
+
+def _map_chunks(function, n, chunk_size, processes):
+  """Call function on the starts of chunks of range(n) in parallel threads."""
+  if processes is None:
+    processes = mp.cpu_count();
+  starts = range(0, n, chunk_size);
+  if processes == 'serial' or processes == 1 or len(starts) <= 1:
+    for start in starts:
+      function(start);
+  else:
+    with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+      list(executor.map(function, starts));
+
+
+def _parse_value(value):
+  if value.startswith('"'):
+    return value.strip('"');
+  try:
+    return int(value);
+  except ValueError:
+    try:
+      return float(value);
+    except ValueError:
+      return value;
+
+
+def _rotation_2d(angle):
+  c, s = np.cos(angle), np.sin(angle);
+  return np.array([[c, -s], [s, c]]);
+
+
+def _euler_3d(angles, zyx = False):
+  """Rotation matrix of the itk Euler3DTransform."""
+  cx, cy, cz = np.cos(angles);
+  sx, sy, sz = np.sin(angles);
+  rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]]);
+  ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]]);
+  rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]);
+  if zyx:
+    return np.dot(rz, np.dot(ry, rx));
+  else:
+    return np.dot(rz, np.dot(rx, ry));
+
+
+def _versor_3d(versor):
+  """Rotation matrix of a versor given by its vector part."""
+  x, y, z = versor;
+  w = np.sqrt(max(0.0, 1.0 - x * x - y * y - z * z));
+  return np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - z * w),     2 * (x * z + y * w)],
+                   [2 * (x * y + z * w),     1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+                   [2 * (x * z - y * w),     2 * (y * z + x * w),     1 - 2 * (x * x + y * y)]]);
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import os
+  import numpy as np
+  import ClearMap.Settings as settings
+  import ClearMap.Alignment.Transformation as trf
+
+  path = os.path.join(settings.test_data_path, 'Elastix');
+  result_directory = os.path.join(path, 'elastix_template_to_ref');
+
+  t = trf.transformation(transform_directory=result_directory);
+  print(t)
+
+  shape = np.array([432, 512, 229]);
+  points = np.random.rand(30,3) * 0.25 * shape + 0.5 * shape;
+
+  test = trf.transform_points(points, transform_directory=result_directory);
+
+  # compare to transformix
+  import ClearMap.Alignment.Elastix as elx
+  reference = elx.transform_points(points, transform_directory=result_directory, binary=True, indices=False);
+  print(np.allclose(test, reference, atol=1e-3))
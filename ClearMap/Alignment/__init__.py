@@ -15,6 +15,8 @@ Supported functionality:
     * registering volumetric data onto references via 
       `Elastix <http://elastix.isi.uu.nl/>`_ in the 
       :mod:`~ClearMap.Alignment.Elastix` module.
+    * evaluating elastix transformations on points without transformix in the
+      :mod:`~ClearMap.Alignment.Transformation` module.
 
 All steps are demonstrated in the the :ref:`TubeMap tutorial </TubeMap.ipynb>`.
 
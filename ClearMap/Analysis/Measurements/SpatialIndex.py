@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+SpatialIndex
+============
+
+Persistent spatial index over detected cells for box, radius and nearest
+neighbour queries.
+
+The index sorts the cells into a uniform grid of bins and stores the sort
+order together with the offsets of each bin next to the cells file. Box
+queries gather a few contiguous ranges of the sorted cells, radius and
+nearest neighbour queries use a kd-tree over the sorted coordinates that is
+built on first use and run in parallel threads.
+
+Example
+-------
+>>> import ClearMap.Analysis.Measurements.SpatialIndex as si
+>>> index = si.spatial_index('cells.table', coordinates=('xt', 'yt', 'zt'))
+>>> index.box((100, 100, 100), (200, 200, 150))
+>>> counts = index.radius(index.points, 10, count_only=True)
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+
+import os
+import multiprocessing as mp
+import concurrent.futures
+
+import numpy as np
+
+from scipy import spatial
+
+import ClearMap.IO.IO as io
+import ClearMap.IO.CellTable as ct
+
+import ClearMap.Utils.Timer as tmr
+
+
+###############################################################################
+### Spatial index
+###############################################################################
+
+class SpatialIndex(object):
+  """Uniform grid index over cell coordinates."""
+
+  def __init__(self, location):
+    """Load a spatial index.
+
+    Arguments
+    ---------
+    location : str
+      The index file created by :func:`create_spatial_index`.
+    """
+    self.location = location;
+    with np.load(location) as index:
+      self.points = index['points'];
+      self.order = index['order'];
+      self.offsets = index['offsets'];
+      self.origin = index['origin'];
+      self.spacing = index['spacing'];
+      self.grid_shape = tuple(int(s) for s in index['grid_shape']);
+      self.coordinates = tuple(str(c) for c in index['coordinates']);
+    self._tree = None;
+
+  @property
+  def tree(self):
+    """kd-tree over the sorted coordinates."""
+    if self._tree is None:
+      self._tree = spatial.cKDTree(self.points, balanced_tree=False, compact_nodes=False);
+    return self._tree;
+
+  @property
+  def n_points(self):
+    return len(self.order);
+
+  def __len__(self):
+    return self.n_points;
+
+  def bins(self, points):
+    """Grid bin coordinates of points."""
+    bins = np.floor((np.asarray(points, dtype=float) - self.origin) / self.spacing).astype(np.int64);
+    return np.clip(bins, 0, np.array(self.grid_shape) - 1);
+
+  def box(self, lower, upper, sorted_indices = False):
+    """Cells in an axis aligned box.
+
+    Arguments
+    ---------
+    lower : array
+      Lower corner of the box (inclusive).
+    upper : array
+      Upper corner of the box (exclusive).
+    sorted_indices : bool
+      If True, return indices into the sorted points instead of the cells.
+
+    Returns
+    -------
+    indices : array
+      Indices of the cells in the box.
+    """
+    lower = np.asarray(lower, dtype=float);
+    upper = np.asarray(upper, dtype=float);
+    if np.any(upper <= lower) or np.any(upper <= self.origin) or np.any(lower >= self.origin + self.spacing * np.array(self.grid_shape)):
+      return np.zeros(0, dtype=np.int64);
+
+    lo = self.bins(lower);
+    hi = self.bins(np.nextafter(upper, -np.inf));
+
+    # bins along the last axis are contiguous in the sorted points
+    grid = np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(lo[:-1], hi[:-1])], indexing='ij');
+    grid = [g.ravel() for g in grid];
+    first = np.ravel_multi_index(grid + [np.full(len(grid[0]), lo[-1])], self.grid_shape);
+    last  = np.ravel_multi_index(grid + [np.full(len(grid[0]), hi[-1])], self.grid_shape);
+    starts = self.offsets[first];
+    stops  = self.offsets[last + 1];
+
+    candidates = _ranges(starts, stops);
+    p = self.points[candidates];
+    inside = np.all((p >= lower) & (p < upper), axis=1);
+    candidates = candidates[inside];
+
+    if sorted_indices:
+      return candidates;
+    return self.order[candidates];
+
+  def boxes(self, lower, upper, processes = None):
+    """Cells in a batch of boxes, see :meth:`box`.
+
+    Arguments
+    ---------
+    lower : array
+      Lower corners of the boxes of shape (n, ndim).
+    upper : array
+      Upper corners of the boxes of shape (n, ndim).
+    processes : int or None
+      Number of threads to use.
+
+    Returns
+    -------
+    indices : list of arrays
+      Indices of the cells in each box.
+    """
+    if processes is None:
+      processes = mp.cpu_count();
+    with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+      return list(executor.map(self.box, lower, upper));
+
+  def radius(self, points, radius, count_only = False, processes = None):
+    """Cells within a radius of points.
+
+    Arguments
+    ---------
+    points : array
+      Query points of shape (n, ndim) or a single point of shape (ndim,).
+    radius : float or array
+      The radius or the radius for each point.
+    count_only : bool
+      If True, only return the number of cells.
+    processes : int or None
+      Number of threads to use.
+
+    Returns
+    -------
+    indices : array of arrays or array
+      Indices of the cells near each point or their numbers. For a single
+      point the indices or the number of its cells.
+    """
+    if processes is None:
+      processes = -1;
+    points = np.asarray(points, dtype=float);
+    single = points.ndim == 1;
+    points = np.atleast_2d(points);
+    result = self.tree.query_ball_point(points, radius, workers=processes, return_length=count_only);
+    if count_only:
+      result = np.asarray(result);
+    else:
+      indices = np.empty(len(points), dtype=object);
+      for i, r in enumerate(result):
+        indices[i] = self.order[np.asarray(r, dtype=np.int64)];
+      result = indices;
+    return result[0] if single else result;
+
+  def nearest(self, points, k = 1, distance_upper_bound = np.inf, processes = None):
+    """k nearest cells of points.
+
+    Arguments
+    ---------
+    points : array
+      Query points of shape (n, ndim).
+    k : int
+      Number of neighbours.
+    distance_upper_bound : float
+      Only return neighbours within this distance.
+    processes : int or None
+      Number of threads to use.
+
+    Returns
+    -------
+    distances : array
+      Distances to the neighbours of shape (n, k).
+    indices : array
+      Indices of the neighbours of shape (n, k), -1 for missing neighbours.
+    """
+    if processes is None:
+      processes = -1;
+    distances, indices = self.tree.query(np.asarray(points, dtype=float), k=[i + 1 for i in range(k)],
+                                         distance_upper_bound=distance_upper_bound, workers=processes);
+    valid = indices < self.n_points;
+    indices = np.where(valid, self.order[np.where(valid, indices, 0)], -1);
+    return distances, indices;
+
+  def neighbour_counts(self, radius, processes = None):
+    """Number of other cells within a radius of each cell, in the order of the cells."""
+    counts = np.zeros(self.n_points, dtype=np.int64);
+    counts[self.order] = self.radius(self.points, radius, count_only=True, processes=processes) - 1;
+    return counts;
+
+  def __str__(self):
+    return 'SpatialIndex(%d)[%s]%r{%s}' % (self.n_points, ','.join(self.coordinates), self.grid_shape, self.location);
+
+  def __repr__(self):
+    return self.__str__();
+
+
+###############################################################################
+### Index creation
+###############################################################################
+
+def index_file(source, coordinates = ('x', 'y', 'z')):
+  """The default index file of a cells file or cell table."""
+  return os.path.splitext(source.rstrip(os.sep))[0] + '_index_%s.npz' % '_'.join(coordinates);
+
+
+def create_spatial_index(source, sink = None, coordinates = ('x', 'y', 'z'), points_per_bin = 16, verbose = False):
+  """Create a spatial index over cells.
+
+  Arguments
+  ---------
+  source : str
+    The cell table or cells file with the coordinates as fields.
+  sink : str or None
+    The index file, if None use :func:`index_file`.
+  coordinates : tuple of str
+    The names of the coordinate fields, e.g. ('x','y','z') for raw or
+    ('xt','yt','zt') for atlas coordinates.
+  points_per_bin : int
+    The average number of cells per grid bin.
+  verbose : bool
+    If True, print progress info.
+
+  Returns
+  -------
+  index : SpatialIndex
+    The spatial index.
+  """
+  if verbose:
+    timer = tmr.Timer();
+  if sink is None:
+    sink = index_file(source, coordinates);
+
+  # only the coordinate columns of cell tables are read
+  cells = ct.Table(source) if ct.is_cell_table(source) else io.read(source);
+  points = np.array([cells[c] for c in coordinates], dtype=float).T;
+  n_points, ndim = points.shape;
+
+  if n_points > 0:
+    origin = points.min(axis=0);
+    extent = np.maximum(points.max(axis=0) - origin, 1e-9);
+  else:
+    origin = np.zeros(ndim);
+    extent = np.ones(ndim);
+  n_bins = max(1, n_points // points_per_bin);
+  spacing = np.full(ndim, (np.prod(extent) / n_bins) ** (1.0 / ndim));
+  spacing = np.maximum(spacing, extent / 1024);
+  grid_shape = np.floor(extent / spacing).astype(int) + 1;
+
+  bins = np.clip(np.floor((points - origin) / spacing).astype(np.int64), 0, grid_shape - 1);
+  bins = np.ravel_multi_index(tuple(bins.T), tuple(grid_shape));
+  order = np.argsort(bins, kind='stable');
+  offsets = np.concatenate([[0], np.cumsum(np.bincount(bins, minlength=np.prod(grid_shape)))]);
+
+  np.savez(sink, points=points[order], order=order, offsets=offsets, origin=origin, spacing=spacing,
+           grid_shape=grid_shape, coordinates=np.array(coordinates));
+
+  if verbose:
+    timer.print_elapsed_time('Spatial index of %d cells with grid %r created' % (n_points, tuple(grid_shape)));
+
+  return SpatialIndex(sink);
+
+
+def spatial_index(source, coordinates = ('x', 'y', 'z'), rebuild = False, verbose = False):
+  """Load the spatial index of a cells file, creating it if needed.
+
+  Arguments
+  ---------
+  source : str
+    The cell table or cells file with the coordinates as fields.
+  coordinates : tuple of str
+    The names of the coordinate fields.
+  rebuild : bool
+    If True, always create a new index.
+  verbose : bool
+    If True, print progress info.
+
+  Returns
+  -------
+  index : SpatialIndex
+    The spatial index.
+  """
+  location = index_file(source, coordinates);
+  modified = os.path.join(source, ct.schema_file) if ct.is_cell_table(source) else source;
+  if not rebuild and os.path.isfile(location) and os.path.getmtime(location) >= os.path.getmtime(modified):
+    return SpatialIndex(location);
+  return create_spatial_index(source, sink=location, coordinates=coordinates, verbose=verbose);
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def _ranges(starts, stops):
+  """Concatenation of the integer ranges [start, stop)."""
+  lengths = stops - starts;
+  valid = lengths > 0;
+  starts, lengths = starts[valid], lengths[valid];
+  if len(lengths) == 0:
+    return np.zeros(0, dtype=np.int64);
+  ends = np.cumsum(lengths);
+  ranges = np.ones(ends[-1], dtype=np.int64);
+  ranges[0] = starts[0];
+  ranges[ends[:-1]] = starts[1:] - (starts[:-1] + lengths[:-1] - 1);
+  return np.cumsum(ranges);
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import ClearMap.Analysis.Measurements.SpatialIndex as si
+
+  cells = np.zeros(10000, dtype=[('x', float), ('y', float), ('z', float)]);
+  for c in 'xyz':
+    cells[c] = np.random.rand(10000) * 100;
+  np.save('test_cells.npy', cells);
+
+  index = si.spatial_index('test_cells.npy');
+  print(index)
+
+  points = np.array([cells[c] for c in 'xyz']).T;
+  inside = np.nonzero(np.all((points >= 20) & (points < 40), axis=1))[0];
+  print(np.all(np.sort(index.box((20,20,20), (40,40,40))) == inside))
+
+  distances, indices = index.nearest(points[:5], k=2);
+  print(indices[:,0])
+
+  print(index.neighbour_counts(5)[:10])
+
+  near = index.radius(points[0], 5);
+  print(np.all(np.sort(near) == np.sort(index.radius(points[:1], 5)[0])), index.radius(points[0], 5, count_only=True) == len(near))
+
+  import os
+  os.remove('test_cells.npy');
+  os.remove(si.index_file('test_cells.npy'));
@@ -11,10 +11,17 @@ __copyright__ = 'Copyright © 2020 by Christoph Kirst'
 __webpage__   = 'http://idisco.info'
 __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
+import math
+import multiprocessing as mp
+import concurrent.futures
+
 import numpy as np
 
+from scipy import signal
+
 import ClearMap.IO.IO as io
 
+import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
 import ClearMap.ParallelProcessing.DataProcessing.DevolvePointList as dpl
 
 
@@ -23,8 +30,8 @@ import ClearMap.ParallelProcessing.DataProcessing.DevolvePointList as dpl
 ###############################################################################
 
 def voxelize(source, sink = None, shape = None, dtype = None, weights = None,
-             method = 'sphere', radius = (1,1,1), kernel = None, 
-             processes = None, verbose = False):
+             method = 'sphere', radius = (1,1,1), kernel = None, engine = None,
+             specifications = None, processes = None, verbose = False):
   """Converts a list of points into an volumetric image array
   
   Arguments
@@ -45,6 +52,15 @@ def voxelize(source, sink = None, shape = None, dtype = None, weights = None,
     Radius of the voxel region to integrate over.
   kernel : function
     Optional function of distance to set weights in the voxelization.
+  engine : 'direct', 'fft', 'separable' or None
+    Devolve the kernel at each point ('direct'), or splat the points into a 
+    count volume and convolve it with the kernel via FFT ('fft') or 
+    separable box filters ('separable', rectangles without kernel only).
+    If None, choose from the number of points and the kernel size.
+  specifications : list or None
+    Optional list of (method, radius, weights) tuples or dicts to create 
+    several voxelizations in a single pass, see :func:`voxelize_multiple`.
+    In this case sink is a list of sinks and a list of sinks is returned.
   processes : int or None
     Number of processes to use.
   verbose : bool
@@ -55,6 +71,10 @@ def voxelize(source, sink = None, shape = None, dtype = None, weights = None,
   sink : str, array
     Volumetric data of voxelied point data.
   """
+  if specifications is not None:
+    return voxelize_multiple(source, specifications, sinks=sink, shape=shape,
+                             processes=processes, verbose=verbose);
+  
   points = io.read(source);
   
   points_shape = points.shape;
@@ -79,8 +99,346 @@ def voxelize(source, sink = None, shape = None, dtype = None, weights = None,
   else:
     raise ValueError("method not 'sphere', 'rectangle', or 'pixel', but %r!" % method)
   
-  return dpl.devolve(points, sink=sink, shape=shape, dtype=dtype,
-                     weights=weights, indices=indices, kernel=kernel, processes=processes, verbose=verbose);
+  if engine is None:
+    engine = choose_engine(points, shape if shape is not None else sink, indices, method=method, kernel=kernel);
+  
+  if engine == 'direct':
+    return dpl.devolve(points, sink=sink, shape=shape, dtype=dtype,
+                       weights=weights, indices=indices, kernel=kernel, processes=processes, verbose=verbose);
+  elif engine in ('fft', 'separable'):
+    if engine == 'separable' and (method not in ('rectangle', 'pixel') or kernel is not None):
+      raise ValueError('The separable engine requires a rectangle without kernel!');
+    return convolve_points(points, sink=sink, shape=shape, dtype=dtype, weights=weights, 
+                           indices=indices, kernel=kernel, separable=(engine == 'separable'),
+                           processes=processes, verbose=verbose);
+  else:
+    raise ValueError("engine not 'direct', 'fft' or 'separable', but %r!" % engine);
+
+
+def choose_engine(points, shape, indices, method = 'sphere', kernel = None):
+  """Choose the voxelization engine with the lowest estimated cost.
+  
+  Arguments
+  ---------
+  points : array
+    The points.
+  shape : tuple, str or None
+    The shape of the voxelized image or a source to infer it from.
+  indices : array
+    The relative kernel indices.
+  method : str
+    The voxelization method.
+  kernel : array or None
+    The kernel weights.
+  
+  Returns
+  -------
+  engine : str
+    'direct', 'fft' or 'separable'.
+  
+  Note
+  ----
+  Devolving costs one update per point and kernel voxel, convolution a few
+  operations per voxel of the image (times its log for FFTs).
+  """
+  n_indices = len(np.atleast_1d(indices)) if np.ndim(indices) < 2 else indices.shape[0];
+  if shape is None or n_indices <= 1:
+    return 'direct';
+  if not isinstance(shape, (tuple, list)):
+    try:
+      shape = io.shape(shape);
+    except (ImportError, ValueError, OSError):
+      # the shape is determined when the sink is initialized
+      return 'direct';
+  n_voxels = float(np.prod(shape));
+  
+  direct_cost = float(len(points)) * n_indices;
+  if method == 'rectangle' and kernel is None:
+    return 'separable' if direct_cost > 4 * len(shape) * n_voxels else 'direct';
+  return 'fft' if direct_cost > n_voxels * math.log2(max(n_voxels, 2)) else 'direct';
+
+
+def convolve_points(source, sink = None, shape = None, dtype = None, weights = None,
+                    indices = None, kernel = None, separable = False, block_size = 32,
+                    processes = None, verbose = False):
+  """Voxelize points by splatting them into a volume and convolving with a kernel.
+  
+  Arguments
+  ---------
+  source : str, array or Source
+    Source of point of nxd coordinates.
+  sink : str, array or None
+    The sink for the voxelized image, if None return array.
+  shape : tuple, str or None
+    Shape of the final voxelized data. If None, determine from points.
+  dtype : dtype or None
+    Optional data type of the sink.
+  weights : array or None
+    Weight array of length n for each point. If None, use uniform weights.
+  indices : array 
+    The relative indices of the kernel as nxd array.
+  kernel : array
+    Optional kernel weights for each index in indices.
+  separable : bool
+    If True, the kernel is a full rectangle with uniform weights and is 
+    applied as a sequence of one dimensional box sums.
+  block_size : int
+    Number of planes along the last axis convolved at once via FFT.
+  processes : int or None
+    Number of threads to use.
+  verbose : bool
+    If True, print progress info.
+  
+  Returns
+  -------
+  sink : str, array
+    Volumetric data of voxelized point data.
+  
+  Note
+  ----
+  The result equals :func:`DevolvePointList.devolve` for the same indices 
+  and kernel up to floating point rounding.
+  """
+  processes, timer = ap.initialize_processing(processes=processes, verbose=verbose, function='convolve_points');
+  
+  points = np.asarray(io.as_source(source).as_buffer());
+  if points.ndim == 1:
+    points = points[:,None];
+  ndim = points.shape[1];
+  
+  if sink is None and shape is None:
+    shape = tuple(int(math.ceil(points[:,d].max())) for d in range(ndim));
+  elif isinstance(shape, str):
+    shape = io.shape(shape);
+  
+  if sink is None and dtype is None:
+    if weights is not None:
+      dtype = io.dtype(weights);
+    elif kernel is not None:
+      dtype = np.asarray(kernel).dtype;
+    else:
+      dtype = int;
+  sink = ap.initialize_sink(sink=sink, shape=shape, dtype=dtype, return_buffer=False);
+  shape = sink.shape;
+  
+  indices = np.asarray(indices, dtype=int);
+  if indices.size == 1:
+    indices = np.zeros((1, ndim), dtype=int);
+  indices = indices.reshape(-1, ndim);
+  padding = np.max(np.abs(indices), axis=0);
+  
+  # splat points into a count volume padded by the kernel radius
+  counts = splat(points, np.array(shape) + 2 * padding, weights=weights, offset=padding);
+  
+  result = _convolve_counts(counts, indices, kernel, padding, separable=separable, block_size=block_size, processes=processes);
+  _write_result(sink, result);
+  
+  ap.finalize_processing(verbose=verbose, function='convolve_points', timer=timer);
+  
+  return sink;
+
+
+def voxelize_multiple(source, specifications, sinks = None, shape = None, 
+                      block_size = 32, processes = None, verbose = False):
+  """Voxelize points with several kernels and weights in a single pass.
+  
+  Arguments
+  ---------
+  source : str, array or Source
+    Source of point of nxd coordinates.
+  specifications : list of dict or tuple
+    The voxelizations as dicts with keys 'method', 'radius' and optionally 
+    'weights', 'kernel' and 'dtype' as in :func:`voxelize`, or as tuples
+    (method, radius, weights).
+  sinks : list or None
+    The sink for each voxelized image, if None return arrays.
+  shape : tuple, str or None
+    Shape of the voxelized data. If None, determine from the sinks or points.
+  block_size : int
+    Number of planes along the last axis convolved at once via FFT.
+  processes : int or None
+    Number of threads to use.
+  verbose : bool
+    If True, print progress info.
+  
+  Returns
+  -------
+  sinks : list
+    Volumetric data of voxelized point data for each specification.
+  
+  Note
+  ----
+  The voxel indices and bounds checks of the points are computed once, a 
+  count volume is splatted once per distinct weights and then convolved 
+  with each kernel, see :func:`convolve_points`.
+  """
+  processes, timer = ap.initialize_processing(processes=processes, verbose=verbose, function='voxelize_multiple');
+  
+  points = np.asarray(io.as_source(source).as_buffer());
+  if points.ndim == 1:
+    points = points[:,None];
+  ndim = points.shape[1];
+  
+  specifications = [_specification(s, ndim) for s in specifications];
+  if sinks is None:
+    sinks = [None] * len(specifications);
+  if len(sinks) != len(specifications):
+    raise ValueError('Number of sinks %d does not match the number of specifications %d!' % (len(sinks), len(specifications)));
+  
+  if shape is None:
+    shapes = [io.shape(s) for s in sinks if s is not None and (not isinstance(s, str) or io.is_file(s))];
+    if shapes:
+      shape = shapes[0];
+    else:
+      shape = tuple(int(math.ceil(points[:,d].max())) for d in range(ndim));
+  elif isinstance(shape, str):
+    shape = io.shape(shape);
+  shape = np.array(shape, dtype=int);
+  
+  padding = np.max([s['padding'] for s in specifications], axis=0);
+  padded_shape = tuple(shape + 2 * padding);
+  voxels, valid = _voxel_indices(points, padded_shape, offset=padding);
+  
+  # one count volume per distinct weights 
+  counts = {};
+  for spec in specifications:
+    key = id(spec['weights']);
+    if key not in counts:
+      weights = None if spec['weights'] is None else np.asarray(spec['weights'], dtype=float)[valid];
+      counts[key] = np.bincount(voxels, weights=weights, minlength=int(np.prod(padded_shape))).astype(float, copy=False).reshape(padded_shape);
+  
+  results = [];
+  for spec, sink in zip(specifications, sinks):
+    p = spec['padding'];
+    crop = tuple(slice(o, o + n) for o, n in zip(padding - p, shape + 2 * p));
+    result = _convolve_counts(counts[id(spec['weights'])][crop], spec['indices'], spec['kernel'], p, 
+                              separable=spec['separable'], block_size=block_size, processes=processes);
+    sink = ap.initialize_sink(sink=sink, shape=tuple(shape), dtype=spec['dtype'], return_buffer=False);
+    _write_result(sink, result);
+    results.append(sink);
+  
+  ap.finalize_processing(verbose=verbose, function='voxelize_multiple', timer=timer);
+  
+  return results;
+
+
+def splat(points, shape, weights = None, offset = None):
+  """Sum (weighted) points into the voxels of a volume.
+  
+  Arguments
+  ---------
+  points : array
+    Points of shape (n, ndim), coordinates are truncated to integers.
+  shape : tuple
+    Shape of the volume.
+  weights : array or None
+    Optional weights of the points.
+  offset : array or None
+    Optional offset added to the truncated coordinates.
+  
+  Returns
+  -------
+  counts : array
+    The volume of point counts or summed weights.
+  """
+  shape = tuple(int(s) for s in shape);
+  voxels, valid = _voxel_indices(points, shape, offset=offset);
+  if weights is not None:
+    weights = np.asarray(weights, dtype=float)[valid];
+  counts = np.bincount(voxels, weights=weights, minlength=int(np.prod(shape)));
+  return counts.astype(float, copy=False).reshape(shape);
+
+
+def _voxel_indices(points, shape, offset = None):
+  """Flat voxel indices of the points inside a volume and the mask of these points."""
+  voxels = np.trunc(points).astype(np.int64);
+  if offset is not None:
+    voxels += np.asarray(offset, dtype=np.int64);
+  valid = np.all((voxels >= 0) & (voxels < np.array(shape)), axis=1);
+  return np.ravel_multi_index(tuple(voxels[valid].T), shape), valid;
+
+
+def _specification(specification, ndim):
+  """Normalize a voxelization specification."""
+  if not isinstance(specification, dict):
+    specification = dict(zip(('method', 'radius', 'weights'), specification));
+  spec = dict(method='sphere', radius=(1,) * ndim, weights=None, kernel=None, dtype=None);
+  spec.update(specification);
+  
+  method, radius, kernel = spec['method'], spec['radius'], spec['kernel'];
+  if not hasattr(radius, '__len__'):
+    radius = [radius] * ndim;
+  if method == 'sphere':
+    indices, kernel = search_indices_sphere(radius, kernel);
+  elif method == 'rectangle':
+    indices, kernel = search_indices_rectangle(radius, kernel);
+  elif method == 'pixel':
+    indices = np.zeros((1, ndim), dtype=int);
+    if kernel is not None:
+      kernel = np.array([kernel(0)]);
+  else:
+    raise ValueError("method not 'sphere', 'rectangle', or 'pixel', but %r!" % method);
+  
+  indices = np.asarray(indices, dtype=int).reshape(-1, ndim);
+  spec['indices'] = indices;
+  spec['kernel'] = kernel;
+  spec['padding'] = np.max(np.abs(indices), axis=0);
+  spec['separable'] = method in ('rectangle', 'pixel') and kernel is None;
+  if spec['dtype'] is None:
+    if spec['weights'] is not None:
+      spec['dtype'] = io.dtype(spec['weights']);
+    elif kernel is not None:
+      spec['dtype'] = np.asarray(kernel).dtype;
+    else:
+      spec['dtype'] = int;
+  return spec;
+
+
+def _convolve_counts(counts, indices, kernel, padding, separable = False, block_size = 32, processes = None):
+  """Convolve a count volume padded by the kernel radius with the kernel."""
+  if separable:
+    result = counts;
+    for d in range(counts.ndim):
+      result = _box_sum(result, padding[d], axis=d);
+    return result;
+  kernel_array = np.zeros(tuple(2 * padding + 1));
+  kernel_array[tuple((indices + padding).T)] = 1 if kernel is None else np.asarray(kernel, dtype=float);
+  return _fft_convolve_blocks(counts, kernel_array, block_size=block_size, processes=processes);
+
+
+def _write_result(sink, result):
+  if np.dtype(sink.dtype).kind in 'iub':
+    result = np.round(result);
+  sink[:] = result.astype(sink.dtype, copy=False);
+
+
+def _box_sum(array, radius, axis):
+  """Valid sums over windows of size 2 * radius + 1 along an axis."""
+  if radius == 0:
+    return array;
+  cumulative = np.cumsum(array, axis=axis);
+  cumulative = np.concatenate([np.zeros_like(np.take(cumulative, [0], axis=axis)), cumulative], axis=axis);
+  n = array.shape[axis] - 2 * radius;
+  return np.take(cumulative, np.arange(2 * radius + 1, 2 * radius + 1 + n), axis=axis) - \
+         np.take(cumulative, np.arange(n), axis=axis);
+
+
+def _fft_convolve_blocks(counts, kernel, block_size = 32, processes = None):
+  """Valid convolution of a padded volume with a kernel in overlapping blocks along the last axis."""
+  if processes is None:
+    processes = mp.cpu_count();
+  width = kernel.shape[-1] - 1;
+  n = counts.shape[-1] - width;
+  result = np.zeros(tuple(s - k + 1 for s, k in zip(counts.shape, kernel.shape)));
+  
+  def _convolve(start):
+    stop = min(start + block_size, n);
+    result[..., start:stop] = signal.fftconvolve(counts[..., start:stop + width], kernel, mode='valid');
+  
+  with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+    list(executor.map(_convolve, range(0, n, block_size)));
+  
+  return result;
 
 ###############################################################################
 ### Search indices
@@ -217,10 +217,10 @@ def weights_from_precentiles(intensities, percentiles = [25,50,75,100]):
 def count_points_group_in_regions(point_group, annotation_file = ano.default_annotation_file, weight_group = None, invalid = 0, hierarchical = True):
   """Generates a table of counts for the various point datasets in pointGroup"""
 
-  if intensity_group is None: 
-    counts = [ano.count_points(point_group[i], annotation_file=annotation_file, invalid=invalid, hierarchical=heirarchical) for i in range(len(point_group))];
+  if weight_group is None: 
+    counts = [ano.count_points(point_group[i], annotation_file=annotation_file, invalid=invalid, hierarchical=hierarchical) for i in range(len(point_group))];
   else:
-    counts = [ano.count_points(point_group[i], weight=weight_group[i], annotation_file=annotation_file, invalid=invalid, hierarchical=heirarchical) for i in range(len(point_group))];
+    counts = [ano.count_points(point_group[i], weight=weight_group[i], annotation_file=annotation_file, invalid=invalid, hierarchical=hierarchical) for i in range(len(point_group))];
   
   counts = np.vstack(counts).T;
 
@@ -43,6 +43,9 @@ print("ClearMap.IO.IO Imported")
 import ClearMap.IO.Workspace as wsp
 print("ClearMap.IO.Workspace Imported")
 
+import ClearMap.IO.CellTable as ct
+print("ClearMap.IO.CellTable Imported")
+
 import ClearMap.Tests.Files as tfs 
 print("ClearMap.Tests.Files Imported")
 
@@ -69,9 +72,15 @@ print("ClearMap.Alignment.Annotation Imported")
 import ClearMap.Alignment.Resampling as res
 print("ClearMap.Alignment.Resampling Imported")
 
+import ClearMap.Alignment.Pyramid as pyr
+print("ClearMap.Alignment.Pyramid Imported")
+
 import ClearMap.Alignment.Elastix as elx
 print("ClearMap.Alignment.Elastix Imported")
 
+import ClearMap.Alignment.Transformation as trf
+print("ClearMap.Alignment.Transformation Imported")
+
 #image processing
 import ClearMap.ImageProcessing.Clipping.Clipping as clp
 print("ClearMap.ImageProcessing.Clipping.Clipping Imported")
@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+"""
+CellTable
+=========
+
+Columnar binary format for large cell tables.
+
+A cell table is a directory holding one npy file per column together with a
+small json schema. Columns are memory mapped on reading and string columns,
+such as region names, are dictionary encoded: the table stores integer codes
+per cell and the distinct strings only once in the schema.
+
+Example
+-------
+>>> import ClearMap.IO.CellTable as ct
+>>> ct.write('cells.table', cells)
+>>> table = ct.Table('cells.table')
+>>> table['x'][:10]
+>>> ct.export_csv('cells.table', 'cells.csv')
+
+Note
+----
+Tables can be written in chunks with a :class:`Writer`, so that cells do not
+need to be held in memory at once.
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+
+import os
+import json
+import collections
+import multiprocessing as mp
+import concurrent.futures
+
+import numpy as np
+
+import ClearMap.IO.FileUtils as fu
+import ClearMap.IO.MMP as mmp
+
+
+schema_file = 'schema.json'
+"""The name of the schema file in the table directory."""
+
+code_dtype = np.dtype('int32')
+"""The data type of the codes of dictionary encoded columns."""
+
+
+###############################################################################
+### Writer
+###############################################################################
+
+class Writer(object):
+  """Incremental writer of a cell table.
+
+  Example
+  -------
+  >>> with Writer('cells.table', dtype=cells.dtype) as writer:
+  >>>   for block in blocks:
+  >>>     writer.append(block)
+  """
+
+  def __init__(self, location, dtype, categorical = None, categories = None):
+    """Cell table writer constructor.
+
+    Arguments
+    ---------
+    location : str
+      The directory of the cell table.
+    dtype : dtype
+      The structured data type of the cells.
+    categorical : list of str or None
+      Names of the columns to dictionary encode. If None, all string columns
+      are encoded.
+    categories : dict or None
+      The known categories of already encoded columns. The values of these
+      columns are codes into the categories and are written as they are.
+    """
+    self.location = fu.abspath(location);
+    self.dtype = np.dtype(dtype);
+    if self.dtype.names is None:
+      raise ValueError('Cell tables require a structured dtype, found %r!' % self.dtype);
+    self._encoded = {n : np.asarray(c) for n, c in (categories or {}).items()};
+    if categorical is None:
+      categorical = [n for n in self.dtype.names if self.dtype[n].kind in 'USO' and n not in self._encoded];
+    self.categorical = list(categorical) + [n for n in self._encoded if n not in categorical];
+
+    fu.create_directory(self.location, split=False);
+    self._categories = {n : {} for n in self.categorical if n not in self._encoded};
+    self._writers = collections.OrderedDict(
+                      (n, mmp.Writer(os.path.join(self.location, _column_file(n)),
+                                     code_dtype if n in self.categorical else self.dtype[n]))
+                      for n in self.dtype.names);
+
+  @property
+  def size(self):
+    return self._writers[self.dtype.names[0]].size;
+
+  def append(self, data):
+    """Append cells to the table.
+
+    Arguments
+    ---------
+    data : array
+      Structured array of cells to append.
+    """
+    data = np.asarray(data).reshape(-1);
+    for name, writer in self._writers.items():
+      values = data[name];
+      if name in self._encoded:
+        values = np.asarray(values, dtype=code_dtype);
+        if len(values) > 0 and (values.min() < 0 or values.max() >= len(self._encoded[name])):
+          raise ValueError('Codes of column %r are not in its categories!' % name);
+      elif name in self._categories:
+        values = _encode(values, self._categories[name]);
+      writer.append(values);
+
+  def close(self):
+    """Close the column files and write the schema."""
+    if self._writers is None:
+      return;
+    size = self.size;
+    for writer in self._writers.values():
+      writer.close();
+    self._writers = None;
+
+    columns = [];
+    for name in self.dtype.names:
+      if name in self._encoded:
+        categories = self._encoded[name];
+        column = dict(name=name, file=_column_file(name), dtype=np.lib.format.dtype_to_descr(categories.dtype),
+                      categories=[str(c) for c in categories]);
+        columns.append(column);
+        continue;
+      column = dict(name=name, file=_column_file(name), dtype=np.lib.format.dtype_to_descr(self.dtype[name]));
+      if name in self._categories:
+        categories = sorted(self._categories[name].items(), key=lambda c: c[1]);
+        column['categories'] = [str(c[0]) for c in categories];
+      columns.append(column);
+
+    with open(os.path.join(self.location, schema_file), 'w') as f:
+      json.dump(dict(version=1, size=size, columns=columns), f, indent=1);
+
+  def __enter__(self):
+    return self;
+
+  def __exit__(self, *args):
+    self.close();
+
+  def __str__(self):
+    return 'CellTable-Writer[%d]{%s}' % (len(self.dtype.names), self.location);
+
+  def __repr__(self):
+    return self.__str__();
+
+
+###############################################################################
+### Table
+###############################################################################
+
+class Table(object):
+  """Memory mapped cell table."""
+
+  def __init__(self, location):
+    """Cell table constructor.
+
+    Arguments
+    ---------
+    location : str
+      The directory of the cell table.
+    """
+    self.location = fu.abspath(location);
+    with open(os.path.join(self.location, schema_file), 'r') as f:
+      self.schema = json.load(f);
+    self._columns = {c['name'] : c for c in self.schema['columns']};
+
+  @property
+  def columns(self):
+    """The names of the columns."""
+    return tuple(c['name'] for c in self.schema['columns']);
+
+  @property
+  def dtype(self):
+    """The structured data type of decoded cells."""
+    return np.dtype([(c['name'], np.lib.format.descr_to_dtype(c['dtype'])) for c in self.schema['columns']]);
+
+  @property
+  def shape(self):
+    return (self.schema['size'],);
+
+  def __len__(self):
+    return self.schema['size'];
+
+  def is_categorical(self, name):
+    return 'categories' in self._columns[name];
+
+  def categories(self, name):
+    """The distinct values of a dictionary encoded column."""
+    return np.array(self._columns[name]['categories'], dtype=self.dtype[name]);
+
+  def __getitem__(self, name):
+    """The memory mapped column, codes for dictionary encoded columns, or the decoded cells of a slicing."""
+    if not isinstance(name, str):
+      return self.records(slicing=name);
+    return np.load(os.path.join(self.location, self._columns[name]['file']), mmap_mode='r');
+
+  def column(self, name, slicing = slice(None), decode = True):
+    """Read a column.
+
+    Arguments
+    ---------
+    name : str
+      The name of the column.
+    slicing : slice or array
+      The cells to read.
+    decode : bool
+      If True, dictionary encoded columns are returned as strings.
+
+    Returns
+    -------
+    column : array
+      The column values.
+    """
+    values = self[name][slicing];
+    if decode and self.is_categorical(name):
+      values = self.categories(name)[values];
+    return values;
+
+  def records(self, slicing = slice(None), columns = None, decode = True):
+    """Read cells as a structured array.
+
+    Arguments
+    ---------
+    slicing : slice or array
+      The cells to read.
+    columns : list of str or None
+      The columns to read, if None all columns.
+    decode : bool
+      If True, dictionary encoded columns are returned as strings.
+
+    Returns
+    -------
+    cells : array
+      The cells.
+    """
+    if columns is None:
+      columns = self.columns;
+    values = [self.column(n, slicing=slicing, decode=decode) for n in columns];
+    dtype = [(n, v.dtype) for n, v in zip(columns, values)];
+    cells = np.empty(values[0].shape[0] if len(values) > 0 else 0, dtype=dtype);
+    for n, v in zip(columns, values):
+      cells[n] = v;
+    return cells;
+
+  def __str__(self):
+    return 'CellTable(%d,)[%s]{%s}' % (len(self), ', '.join(self.columns), self.location);
+
+  def __repr__(self):
+    return self.__str__();
+
+
+###############################################################################
+### IO Interface
+###############################################################################
+
+def is_cell_table(source):
+  """Checks if the source is a cell table."""
+  if isinstance(source, Table):
+    return True;
+  if isinstance(source, str):
+    return fu.is_file(os.path.join(source, schema_file));
+  return False;
+
+
+def read(source, slicing = slice(None), columns = None, decode = True):
+  """Read cells from a cell table.
+
+  Arguments
+  ---------
+  source : str or Table
+    The cell table.
+  slicing : slice or array
+    The cells to read.
+  columns : list of str or None
+    The columns to read, if None all columns.
+  decode : bool
+    If True, dictionary encoded columns are returned as strings.
+
+  Returns
+  -------
+  cells : array
+    The cells as structured array.
+  """
+  if not isinstance(source, Table):
+    source = Table(source);
+  return source.records(slicing=slicing, columns=columns, decode=decode);
+
+
+def write(sink, data, categorical = None, categories = None, chunk_size = 2**20):
+  """Write cells to a cell table.
+
+  Arguments
+  ---------
+  sink : str
+    The directory of the cell table.
+  data : array
+    Structured array of cells.
+  categorical : list of str or None
+    Names of the columns to dictionary encode. If None, all string columns
+    are encoded.
+  categories : dict or None
+    The known categories of columns that hold codes into them, e.g. from
+    :meth:`ClearMap.Alignment.Annotation.LabelMap.code`.
+  chunk_size : int
+    Number of cells to encode at once.
+
+  Returns
+  -------
+  sink : str
+    The cell table directory.
+  """
+  with Writer(sink, dtype=data.dtype, categorical=categorical, categories=categories) as writer:
+    for start in range(0, data.shape[0], chunk_size):
+      writer.append(data[start:start+chunk_size]);
+  return sink;
+
+
+def take(source, sink, indices, chunk_size = 2**20):
+  """Write the cells of a table at the given indices to a new table.
+
+  Arguments
+  ---------
+  source : str or Table
+    The cell table.
+  sink : str
+    The directory of the new cell table.
+  indices : array
+    The indices of the cells to write, e.g. a permutation.
+  chunk_size : int
+    Number of cells to gather at once.
+
+  Returns
+  -------
+  sink : str
+    The new cell table directory.
+
+  Note
+  ----
+  The table is gathered column by column and keeps the dictionary encoding,
+  so only a chunk of a single column is held in memory.
+  """
+  if not isinstance(source, Table):
+    source = Table(source);
+  indices = np.asarray(indices);
+  location = fu.abspath(sink);
+  fu.create_directory(location, split=False);
+
+  for name in source.columns:
+    column = source[name];
+    with mmp.Writer(os.path.join(location, _column_file(name)), dtype=column.dtype) as writer:
+      for start in range(0, len(indices), chunk_size):
+        chunk = indices[start:start + chunk_size];
+        order = np.argsort(chunk);
+        values = np.empty(len(chunk), dtype=column.dtype);
+        values[order] = column[chunk[order]]; # read the memory map in increasing order
+        writer.append(values);
+
+  schema = dict(source.schema, size=len(indices));
+  with open(os.path.join(location, schema_file), 'w') as f:
+    json.dump(schema, f, indent=1);
+
+  return sink;
+
+
+###############################################################################
+### Export
+###############################################################################
+
+def export_csv(source, sink, columns = None, delimiter = ',', header = True, chunk_size = 2**18, processes = None, verbose = False):
+  """Export a cell table to a csv file.
+
+  Arguments
+  ---------
+  source : str
+    The directory of the cell table.
+  sink : str
+    The csv file name.
+  columns : list of str or None
+    The columns to export, if None all columns.
+  delimiter : str
+    The column delimiter.
+  header : bool
+    If True, write a header line '# name1, name2, ...' as np.savetxt.
+  chunk_size : int
+    Number of cells formatted by a single process.
+  processes : int or None
+    Number of processes to format chunks in parallel.
+  verbose : bool
+    Print progress information.
+
+  Returns
+  -------
+  sink : str
+    The csv file name.
+
+  Note
+  ----
+  Chunks are formatted in parallel and written in order, so that at most a
+  few chunks are held in memory.
+  """
+  table = Table(source);
+  if columns is None:
+    columns = table.columns;
+  if processes is None:
+    processes = mp.cpu_count();
+
+  chunks = [(table.location, tuple(columns), start, min(start + chunk_size, len(table)), delimiter)
+            for start in range(0, len(table), chunk_size)];
+
+  with open(sink, 'w') as f:
+    if header:
+      f.write('# ' + ', '.join(columns) + '\n');
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+      for window in range(0, len(chunks), 2 * processes):
+        for i, text in enumerate(executor.map(_format_chunk, *zip(*chunks[window:window + 2 * processes]))):
+          f.write(text);
+          if verbose:
+            print('Cell table export: chunk %d/%d written' % (window + i + 1, len(chunks)));
+
+  return sink;
+
+
+def export_mat(source, sink, columns = None, name = 'cells'):
+  """Export a cell table to a MATLAB file.
+
+  Arguments
+  ---------
+  source : str
+    The directory of the cell table.
+  sink : str
+    The mat file name.
+  columns : list of str or None
+    The columns to export, if None all columns.
+  name : str
+    The name of the struct in the MATLAB file.
+
+  Returns
+  -------
+  sink : str
+    The mat file name.
+
+  Note
+  ----
+  Dictionary encoded columns are exported as one based codes together with a
+  cell array '<column>_categories' of the distinct values.
+  """
+  from scipy.io import savemat
+
+  table = Table(source);
+  if columns is None:
+    columns = table.columns;
+
+  struct = {};
+  for n in columns:
+    if table.is_categorical(n):
+      struct[n] = np.asarray(table[n]) + 1;
+      struct[n + '_categories'] = np.array(table.categories(n), dtype=object);
+    else:
+      struct[n] = np.asarray(table[n]);
+
+  savemat(sink, {name : struct}, do_compression=False);
+  return sink;
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def _column_file(name):
+  return '%s.npy' % name;
+
+
+def _encode(values, categories):
+  """Dictionary encode values, adding new values to the categories."""
+  #note: hashing is much faster than np.unique on wide string columns
+  return np.fromiter((categories.setdefault(v, len(categories)) for v in values.tolist()),
+                     dtype=code_dtype, count=len(values));
+
+
+def _format_chunk(location, columns, start, stop, delimiter):
+  """Format a chunk of a cell table as csv text."""
+  table = Table(location);
+  values = [];
+  for n in columns:
+    values.append(table.column(n, slicing=slice(start, stop), decode=True).astype(str));
+  if len(values) == 0:
+    return '';
+  lines = values[0].astype(object);
+  for v in values[1:]:
+    lines = lines + delimiter + v.astype(object);
+  return '\n'.join(lines) + '\n';
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import os
+  import numpy as np
+  import ClearMap.IO.CellTable as ct
+
+  cells = np.zeros(1000, dtype=[('x', int), ('y', float), ('name', 'U256')]);
+  cells['x'] = np.arange(1000);
+  cells['y'] = np.random.rand(1000);
+  cells['name'] = np.random.choice(['cortex', 'striatum', 'thalamus'], size=1000);
+
+  ct.write('test.table', cells, chunk_size=100);
+  table = ct.Table('test.table');
+  print(table)
+  print(np.all(table.records() == cells))
+
+  ct.take('test.table', 'test_sorted.table', np.argsort(cells['y']));
+  print(np.all(ct.Table('test_sorted.table')[10:20] == np.sort(cells, order='y')[10:20]))
+  fu.delete_directory('test_sorted.table');
+
+  # already encoded columns
+  categories = np.array(['cortex', 'striatum', 'thalamus']);
+  codes = np.zeros(1000, dtype=[('x', int), ('name', 'int32')]);
+  codes['x'] = cells['x'];
+  codes['name'] = np.searchsorted(categories, cells['name']);
+  ct.write('test_codes.table', codes, categories={'name' : categories});
+  print(np.all(ct.Table('test_codes.table').column('name') == cells['name']))
+  fu.delete_directory('test_codes.table');
+
+  ct.export_csv('test.table', 'test.csv', processes=2);
+  print(open('test.csv').readlines()[:3])
+
+  os.remove('test.csv');
+  fu.delete_directory('test.table');
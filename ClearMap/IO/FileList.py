@@ -450,7 +450,8 @@ class Source(src.VirtualSource):
     return self;
 
   def as_virtual(self):
-    return VirtualSource(expression=self.expression, file_list=None,
+    #note: pass the file list to avoid scanning the directory again in each worker
+    return VirtualSource(expression=self.expression, file_list=self._file_list,
                          shape = self._shape, dtype = self._dtype, order = self._order,
                          axes_order = self._axes_order);
                          
@@ -19,6 +19,7 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
 import importlib
 import functools
+import itertools
 
 import numpy as np
 
@@ -714,6 +715,149 @@ def convert(source, sink, processes = None, verbose = False, **kwargs):
 
 
 
+def reorient(source, sink = None, orientation = None, slicing = None, order = None, 
+             block_size = 2**26, processes = None, verbose = False):
+  """Reorients and crops a source into a contiguous sink out of core.
+  
+  Arguments
+  ---------
+  source : source specification
+    The source to reorient.
+  sink : sink specification or None
+    The sink, if None an array is created.
+  orientation : tuple or None
+    The orientation as signed permutation of (1,2,3), i.e. sink axis d is 
+    the source axis abs(orientation[d])-1, reversed if the sign is negative.
+  slicing : tuple of slices or None
+    Optional slicing of the reoriented data.
+  order : 'C', 'F' or None
+    The memory order of the sink. If None, use the order of the source.
+  block_size : int
+    The maximal size of a tile in bytes.
+  processes : int, 'serial' or None
+    The number of threads to copy tiles in parallel.
+  verbose : bool
+    If True, print progress information.
+  
+  Returns
+  -------
+  sink : sink specification
+    The reoriented sink.
+  
+  Note
+  ----
+  The sink is written in tiles. For each tile the bounding block of the 
+  source is read, transposed in memory and written to the sink, so that
+  only a few tiles are held in memory at any time. Tiles keep the fastest 
+  axes of the source and sink long to read and write contiguous runs.
+  
+  Tif files and file lists decode whole pages for any read. For these the
+  tiles always contain full pages and are only split along the page axes, 
+  so each page is decoded once, even if a single page exceeds block_size.
+  """
+  if verbose:
+    timer = tmr.Timer();
+  
+  source = as_source(source);
+  ndim = source.ndim;
+  if orientation is None:
+    orientation = tuple(range(1, ndim + 1));
+  axes = [abs(int(o)) - 1 for o in orientation];
+  if sorted(axes) != list(range(ndim)):
+    raise ValueError('Orientation %r is not a valid orientation for a %dd source!' % (orientation, ndim));
+  
+  #source indices along each sink axis
+  indices = [];
+  for a, o in zip(axes, orientation):
+    index = np.arange(source.shape[a]);
+    indices.append(index[::-1] if o < 0 else index);
+  if slicing is not None:
+    slicing = slc.unpack_slicing(slicing, ndim);
+    for d, s in enumerate(slicing):
+      if not isinstance(s, slice):
+        raise ValueError('Only slices are supported for reorienting, found %r!' % (s,));
+      indices[d] = indices[d][s];
+  shape = tuple(len(i) for i in indices);
+  
+  if source.order in ('C', 'F'):
+    source_order = source.order;
+  else:
+    source_order = 'F' if isinstance(source, tif.Source) else 'C';
+  if order is None:
+    order = source_order;
+  result = sink;
+  sink = as_source(initialize(sink, shape=shape, dtype=source.dtype, order=order));
+  
+  #tiles of bounded size keeping the fast axes of source and sink and whole pages
+  fast = (ndim - 1 if order == 'C' else 0, axes.index(ndim - 1 if source_order == 'C' else 0));
+  page = [d for d in range(ndim) if axes[d] in _page_axes(source)];
+  tile = list(shape);
+  while np.prod(tile) * np.dtype(source.dtype).itemsize > block_size:
+    candidates = [d for d in range(ndim) if tile[d] > 1 and d not in fast and d not in page];
+    if len(candidates) == 0:
+      candidates = [d for d in range(ndim) if tile[d] > 1 and d not in page];
+    if len(candidates) == 0:
+      break;
+    d = max(candidates, key=lambda d: tile[d]);
+    tile[d] = (tile[d] + 1) // 2;
+  tiles = [tuple(slice(s, min(s + t, n)) for s, t, n in zip(start, tile, shape))
+           for start in itertools.product(*[range(0, n, t) for n, t in zip(shape, tile)])];
+  
+  if verbose:
+    print('reorient: %s -> %s in %d tiles of shape %r' % (source, sink, len(tiles), tuple(tile)));
+  
+  _copy = functools.partial(_reorient_tile, source=source, sink=sink, axes=axes, indices=indices);
+  if processes == 'serial':
+    for t in tiles:
+      _copy(t);
+  else:
+    if processes is None:
+      processes = mp.cpu_count();
+    with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+      list(executor.map(_copy, tiles));
+  
+  if verbose:
+    timer.print_elapsed_time('Reorienting');
+  
+  return result if isinstance(result, str) else sink;
+
+
+def _page_axes(source):
+  """Helper returning the source axes that are decoded as a whole for any read."""
+  if isinstance(source, tif.Source):
+    return tuple(range(source.ndim - 1)) if source.ndim >= 3 else tuple(range(source.ndim));
+  if isinstance(source, fl.Source):
+    return source.axes_file;
+  return ();
+
+
+def _reorient_tile(tile, source, sink, axes, indices):
+  """Helper to copy a tile of a reoriented sink."""
+  index = [i[t] for i, t in zip(indices, tile)];
+  if any(len(i) == 0 for i in index):
+    return;
+  lower = [int(i.min()) for i in index];
+  
+  slicing = [None] * len(axes);
+  for i, a, l in zip(index, axes, lower):
+    slicing[a] = slice(l, int(i.max()) + 1);
+  block = np.asarray(source[tuple(slicing)]).transpose(axes);
+  
+  #use basic slicing for regularly spaced indices
+  local = [];
+  for i, l in zip(index, lower):
+    i = i - l;
+    step = i[1] - i[0] if len(i) > 1 else 1;
+    if step != 0 and np.all(np.diff(i) == step):
+      stop = i[-1] + step;
+      local.append(slice(i[0], stop if stop >= 0 else None, step));
+    else:
+      local.append(i);
+  if any(not isinstance(l, slice) for l in local):
+    local = np.ix_(*[np.arange(*l.indices(n)) if isinstance(l, slice) else l for l, n in zip(local, block.shape)]);
+  sink[tile] = block[tuple(local)];
+
+
 def convert_files(filenames, extension = None, path = None, processes = None, verbose = False):
   """Transforms list of files to their sink format in parallel.
   
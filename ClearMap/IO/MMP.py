@@ -159,6 +159,75 @@ class VirtualSource(src.VirtualSource):
     return self.as_real().array;
 
 
+class Writer(object):
+  """Incremental writer of a one dimensional npy file.
+  
+  Note
+  ----
+  Data is appended chunk by chunk to the end of the file, the header reserves
+  space for the final length and is updated on closing. The written file is a
+  standard npy file that can be memory mapped.
+  
+  Example
+  -------
+  >>> with Writer('cells.npy', dtype=[('x', int), ('y', int)]) as writer:
+  >>>   writer.append(np.zeros(10, dtype=writer.dtype))
+  >>>   writer.append(np.ones(5, dtype=writer.dtype))
+  >>> Source('cells.npy').shape
+  (15,)
+  """
+  
+  def __init__(self, location, dtype):
+    """Incremental writer constructor.
+    
+    Arguments
+    ---------
+    location : str
+      The filename of the npy file to write.
+    dtype : dtype
+      The (structured) data type of the array elements.
+    """
+    self.location = fu.abspath(location);
+    self.dtype = np.dtype(dtype);
+    self.size = 0;
+    self._header_size = len(_npy_header(self.dtype, 10**18));
+    self._file = open(self.location, 'wb');
+    self._file.write(_npy_header(self.dtype, 0, self._header_size));
+  
+  def append(self, data):
+    """Append data to the end of the file.
+    
+    Arguments
+    ---------
+    data : array
+      One dimensional array of elements to append.
+    """
+    data = np.ascontiguousarray(data, dtype=self.dtype).reshape(-1);
+    self._file.write(data.tobytes());
+    self.size += data.shape[0];
+  
+  def close(self):
+    """Write the final header and close the file."""
+    if self._file is None:
+      return;
+    self._file.seek(0);
+    self._file.write(_npy_header(self.dtype, self.size, self._header_size));
+    self._file.close();
+    self._file = None;
+  
+  def __enter__(self):
+    return self;
+  
+  def __exit__(self, *args):
+    self.close();
+  
+  def __str__(self):
+    return 'Memmap-Writer(%d,)[%s]{%s}' % (self.size, self.dtype, self.location);
+  
+  def __repr__(self):
+    return self.__str__();
+
+
 ###############################################################################
 ### IO Interface
 ###############################################################################
@@ -421,6 +490,34 @@ def header_size(filename):
   
   return offset;
 
+
+
+def _npy_header(dtype, size, header_size = None):
+  """Version 1.0 npy header of a one dimensional C contiguous array.
+  
+  Arguments
+  ---------
+  dtype : dtype
+    The data type of the array.
+  size : int
+    The number of elements in the array.
+  header_size : int or None
+    Pad the header to this size in bytes. If None, pad to a multiple of 64.
+  
+  Returns
+  -------
+  header : bytes
+    The npy header including the magic string.
+  """
+  header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(dtype), size);
+  prefix = len(np.lib.format.magic(1, 0)) + 2;
+  if header_size is None:
+    header_size = ((prefix + len(header) + 1 + 63) // 64) * 64;
+  header_length = header_size - prefix;
+  if len(header) + 1 > header_length:
+    raise ValueError('Header for %d elements does not fit into %d bytes!' % (size, header_size));
+  header = (header + ' ' * (header_length - len(header) - 1) + '\n').encode('latin1');
+  return np.lib.format.magic(1, 0) + header_length.to_bytes(2, 'little') + header;
      
 ###############################################################################
 ### Tests
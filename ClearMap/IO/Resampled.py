@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Resampled
+=========
+
+Virtual source representing a source resampled to a new shape with nearest
+neighbour interpolation.
+
+The data is computed on demand from the underlying source via index
+arithmetic, so that e.g. an atlas annotation can be used at the resolution
+of the full data set without materializing the up-sampled label volume.
+
+Example
+-------
+>>> import ClearMap.IO.IO as io
+>>> import ClearMap.IO.Resampled as rsd
+>>> annotation = rsd.Source('annotation_25um.tif', shape=io.shape('stitched.npy'))
+>>> annotation[100:200, 100:200, 500].shape
+(100, 100)
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+
+import numbers
+
+import numpy as np
+
+import ClearMap.IO.Source as src
+import ClearMap.IO.Slice as slc
+
+
+###############################################################################
+### Source class
+###############################################################################
+
+class Source(src.Source):
+  """Nearest neighbour resampled source."""
+
+  def __init__(self, source, shape, name = None):
+    """Resampled source class construtor.
+
+    Arguments
+    ---------
+    source : str, array or Source
+      The source to resample, e.g. the atlas annotation.
+    shape : tuple of int
+      The shape of the resampled source.
+    """
+    super(Source, self).__init__(name=name);
+    import ClearMap.IO.IO as io
+    self._source = io.as_source(source);
+    self._shape = tuple(int(s) for s in shape);
+    if len(self._shape) != len(self._source.shape):
+      raise ValueError('Dimension of the shape %r does not match the source %r!' % (self._shape, self._source.shape));
+    self._array = None;
+
+  @property
+  def name(self):
+    return "Resampled-Source";
+
+  @property
+  def source(self):
+    """The underlying source."""
+    return self._source;
+
+  @property
+  def shape(self):
+    return self._shape;
+
+  @shape.setter
+  def shape(self, value):
+    raise NotImplementedError('Cannot set shape of resampled source!');
+
+  @property
+  def dtype(self):
+    return self._source.dtype;
+
+  @dtype.setter
+  def dtype(self, value):
+    raise NotImplementedError('Cannot set dtype of resampled source!');
+
+  @property
+  def order(self):
+    return 'C';
+
+  @order.setter
+  def order(self, value):
+    raise NotImplementedError('Cannot set order of resampled source!');
+
+  @property
+  def location(self):
+    return self._source.location;
+
+  @location.setter
+  def location(self, value):
+    raise NotImplementedError('Cannot set location of resampled source!');
+
+  @property
+  def base_array(self):
+    """The underlying (small) source array, read once."""
+    if self._array is None:
+      self._array = np.asarray(self._source[:]);
+    return self._array;
+
+  @property
+  def array(self):
+    """The full resampled array.
+    
+    Note
+    ----
+    This materializes the resampled data, use indexing to read parts of it.
+    """
+    return self[:];
+
+  def indices(self, axis, index):
+    """Indices in the underlying source of resampled indices along an axis.
+
+    Arguments
+    ---------
+    axis : int
+      The axis.
+    index : int or array
+      Indices in the resampled source.
+
+    Returns
+    -------
+    indices : int or array
+      The nearest neighbour indices in the underlying source.
+    """
+    n_source, n = self._source.shape[axis], self._shape[axis];
+    index = (2 * np.asarray(index, dtype=np.int64) + 1) * n_source // (2 * n);
+    return np.clip(index, 0, n_source - 1);
+
+  ### Data
+  def __getitem__(self, slicing):
+    slicing = slc.unpack_slicing(slicing, self.ndim);
+
+    if all(isinstance(s, np.ndarray) and s.dtype.kind in 'iu' for s in slicing):
+      # point wise indexing, e.g. labeling points
+      return self.base_array[tuple(self.indices(d, s) for d, s in enumerate(slicing))];
+
+    indices = [];
+    squeeze = [];
+    for d, s in enumerate(slicing):
+      if isinstance(s, slice):
+        s = np.arange(*s.indices(self._shape[d]));
+      elif isinstance(s, (numbers.Integral, np.integer)):
+        squeeze.append(d);
+        s = np.array([s if s >= 0 else s + self._shape[d]]);
+      elif s is None or s is Ellipsis:
+        raise IndexError('New axis and ellipsis are not supported for resampled sources!');
+      else:
+        s = np.asarray(s);
+        if s.dtype == bool:
+          s = np.nonzero(s)[0];
+      indices.append(self.indices(d, s));
+
+    # read the minimal block of the underlying source
+    if self._array is not None:
+      block = self._array;
+      offsets = [0] * len(indices);
+    else:
+      offsets = [int(i.min()) if len(i) > 0 else 0 for i in indices];
+      block = np.asarray(self._source[tuple(slice(o, int(i.max()) + 1 if len(i) > 0 else o) for o, i in zip(offsets, indices))]);
+
+    data = block[np.ix_(*[i - o for i, o in zip(indices, offsets)])];
+    if squeeze:
+      data = np.squeeze(data, axis=tuple(squeeze));
+    return data;
+
+  def __setitem__(self, *args):
+    raise NotImplementedError('Cannot write to resampled source!');
+
+  ### Source conversions
+  def as_virtual(self):
+    return VirtualSource(source=self);
+
+  def as_real(self):
+    return self;
+
+  def as_buffer(self):
+    return self[:];
+
+
+class VirtualSource(src.VirtualSource):
+  """Virtual resampled source holding only the underlying virtual source."""
+
+  def __init__(self, source = None, shape = None, dtype = None, order = None, location = None, name = None):
+    super(VirtualSource, self).__init__(source=source, shape=shape, dtype=dtype, order=order, location=location, name=name);
+    if isinstance(source, Source):
+      self._base = source.source.as_virtual();
+    else:
+      self._base = None;
+
+  @property
+  def name(self):
+    return 'Virtual-Resampled-Source';
+
+  def as_virtual(self):
+    return self;
+
+  def as_real(self):
+    return Source(source=self._base.as_real(), shape=self.shape);
+
+  def as_buffer(self):
+    return self.as_real().as_buffer();
+
+
+###############################################################################
+### IO Interface
+###############################################################################
+
+def is_resampled(source):
+  """Checks if this source is a resampled source."""
+  return isinstance(source, (Source, VirtualSource));
+
+
+def read(source, slicing = None, as_source = None, **kwargs):
+  """Read data from a resampled source.
+
+  Arguments
+  ---------
+  source : Source
+    The resampled source.
+  slicing : slice, Slice or None
+    An optional sub-slice to consider.
+  as_source : bool
+    If True, return results as a source.
+
+  Returns
+  -------
+  array : array
+    The resampled data as a buffer or source.
+  """
+  if slicing is None:
+    if as_source:
+      return source;
+    return source[:];
+  if as_source:
+    return slc.Slice(source, slicing=slicing);
+  return source.__getitem__(slicing);
+
+
+def write(sink, data, slicing = None, **kwargs):
+  raise NotImplementedError('Cannot write to resampled source!');
+
+
+def create(location = None, shape = None, dtype = None, order = None, mode = None, array = None, as_source = True, **kwargs):
+  raise NotImplementedError('Creating resampled sources not implemented yet!')
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import ClearMap.IO.Resampled as rsd
+
+  labels = np.random.randint(0, 10, size=(10, 12, 8));
+  s = rsd.Source(labels, shape=(40, 36, 24));
+  print(s)
+
+  full = labels.repeat(4, axis=0).repeat(3, axis=1).repeat(3, axis=2);
+  print(np.all(s[:] == full))
+  print(np.all(s[5:20, 3, ::2] == full[5:20, 3, ::2]))
+
+  points = (np.array([0, 39, 17]), np.array([1, 35, 4]), np.array([0, 23, 10]));
+  print(np.all(s[points] == full[points]))
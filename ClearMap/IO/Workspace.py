@@ -46,6 +46,7 @@ default_file_type_to_name = odict(
     layout                    = "layout.lyt",
     background                = "background.npy",
     resampled                 = "resampled.tif",
+    pyramid                   = "pyramid",
     resampled_to_auto         = 'elastix_resampled_to_auto',
     auto_to_reference         = 'elastix_auto_to_reference', 
     );
@@ -20,6 +20,8 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 import numpy as np
 import tempfile as tmpf 
 import gc            
+import multiprocessing as mp
+import concurrent.futures
 
 import cv2
 import scipy.ndimage as ndi
@@ -27,6 +29,7 @@ import scipy.ndimage.filters as ndf
 import skimage.filters as skif
 
 import ClearMap.IO.IO as io
+import ClearMap.IO.MMP as mmp
 
 import ClearMap.ParallelProcessing.BlockProcessing as bp
 import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
@@ -34,6 +37,7 @@ import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
 import ClearMap.ImageProcessing.IlluminationCorrection as ic
 import ClearMap.ImageProcessing.Filter.StructureElement as se
 import ClearMap.ImageProcessing.Filter.FilterKernel as fk
+import ClearMap.ImageProcessing.Filter.LineMorphology as lm
 import ClearMap.ImageProcessing.LocalStatistics as ls
 
 import ClearMap.Analysis.Measurements.MaximaDetection as md
@@ -110,8 +114,11 @@ def detect_cells(source, sink = None, cell_detection_parameter = default_cell_de
   
   Arguments
   ---------
-  source : source specification
-    The source of the stitched raw data.
+  source : source specification or list of source specifications
+    The source of the stitched raw data. If a list of aligned sources is 
+    given, cells are detected in the first source and the intensities of the
+    other channels are measured under the same cell shapes in the same pass
+    over the blocks.
   sink : sink specification or None
     The sink to write the result to. If None, an array is returned.
   cell_detection_parameter : dict
@@ -179,7 +186,7 @@ def detect_cells(source, sink = None, cell_detection_parameter = default_cell_de
       This should be larger than the typical cell size.
     
     form : str
-      The form of the structur element (e.g. 'Disk')
+      The form of the structur element (e.g. 'Disk'), see :func:`remove_background`.
         
     save : str or None
       Save the result of this step to the specified file if not None.
@@ -285,6 +292,14 @@ def detect_cells(source, sink = None, cell_detection_parameter = default_cell_de
       If no cell shapes are detected a disk of this shape is used to measure
       the cell intensity.
     
+    measure : list of str
+      The intermediate results to measure the intensities in, 
+      e.g. ['source', 'background'].
+    
+    channels : list of str or None
+      Column names for the intensities measured in the additional channels.
+      If None, the names 'channel1', 'channel2', ... are used.
+    
     save : str or None
       Save the result of this step to the specified file if not None.
   
@@ -295,8 +310,12 @@ def detect_cells(source, sink = None, cell_detection_parameter = default_cell_de
   """
     
   #initialize sink
-  shape = io.shape(source);
-  order = io.order(source);
+  sources = source if isinstance(source, list) else [source];
+  shape = io.shape(sources[0]);
+  order = io.order(sources[0]);
+  for s in sources[1:]:
+    if io.shape(s) != shape:
+      raise ValueError('The channel shapes %r and %r do not match!' % (io.shape(s), shape));
   
   for key in cell_detection_parameter.keys():
     par = cell_detection_parameter[key];
@@ -307,11 +326,6 @@ def detect_cells(source, sink = None, cell_detection_parameter = default_cell_de
         
   cell_detection_parameter.update(verbose=processing_parameter.get('verbose', False));
   
-  results, blocks = bp.process(detect_cells_block, source, sink=None, function_type='block', return_result=True, return_blocks=True, parameter=cell_detection_parameter, **processing_parameter)                   
-  
-  #merge results
-  results = np.vstack([np.hstack(r) for r in results])
-  
   #create column headers
   header = ['x','y','z'];
   dtypes = [int, int, int];
@@ -321,18 +335,52 @@ def detect_cells(source, sink = None, cell_detection_parameter = default_cell_de
   measures = cell_detection_parameter['intensity_detection']['measure'];
   header +=  measures
   dtypes += [float] * len(measures)
-
-  dt = {'names' : header, 'formats' : dtypes};
-  cells = np.zeros(len(results), dtype=dt);
-  for i,h in enumerate(header):
-    cells[h] = results[:,i];
+  if len(sources) > 1:
+    channels = cell_detection_parameter['intensity_detection'].get('channels', None);
+    if channels is None:
+      channels = ['channel%d' % c for c in range(1, len(sources))];
+    if len(channels) != len(sources) - 1:
+      raise ValueError('Expected %d channel names, got %r!' % (len(sources) - 1, channels));
+    header += list(channels);
+    dtypes += [float] * len(channels);
+  dt = np.dtype({'names' : header, 'formats' : dtypes});
+  
+  #stream block results into npy sinks, collect them otherwise
+  stream = isinstance(sink, str) and io.file_extension(sink) == 'npy';
+  if stream:
+    writer = mmp.Writer(sink, dtype=dt);
+    def append(result):
+      writer.append(_block_to_cells(result, dt));
+  else:
+    cells = [];
+    def append(result):
+      cells.append(_block_to_cells(result, dt));
+  
+  try:
+    bp.process(detect_cells_block, sources, sink=None, function_type='block', callback=append, parameter=cell_detection_parameter, **processing_parameter)
+  finally:
+    if stream:
+      writer.close();
+  
+  if stream:
+    return sink;
   
-  #save results  
+  #save results
+  cells = np.concatenate(cells) if len(cells) > 0 else np.zeros(0, dtype=dt);
   return io.write(sink, cells);
 
 
-def detect_cells_block(source, parameter = default_cell_detection_parameter):
-  """Detect cells in a Block."""
+def _block_to_cells(result, dtype):
+  """Convert the result of a block into a structured cell array."""
+  result = np.hstack(result);
+  cells = np.zeros(len(result), dtype=dtype);
+  for i,h in enumerate(dtype.names):
+    cells[h] = result[:,i];
+  return cells;
+
+
+def detect_cells_block(source, *channels, parameter = default_cell_detection_parameter):
+  """Detect cells in a Block and measure intensities in additional channel blocks."""
   
   #initialize parameter and slicings
   verbose = parameter.get('verbose', False);
@@ -351,6 +399,7 @@ def detect_cells_block(source, parameter = default_cell_detection_parameter):
   if parameter_intensity: 
     parameter_intensity = parameter_intensity.copy();
     measure = parameter_intensity.pop('measure', []);
+    parameter_intensity.pop('channels', None);
     if measure is None:
       measure = [];
     for m in measure:
@@ -548,16 +597,17 @@ def detect_cells_block(source, parameter = default_cell_detection_parameter):
       timer = tmr.Timer(prefix);
       hdict.pprint(parameter_intensity, head = prefix + 'Intensity detection:')    
     
-    if not shape is None:
-      r = parameter_intensity.pop('shape', 3);
-      if isinstance(r, tuple):
-        r = r[0];
+    r = parameter_intensity.pop('shape', 3);
+    if isinstance(r, tuple):
+      r = r[0];
     
-    for m in measure:
+    #channel blocks are read once and share the cell labels
+    arrays = [measure_to_array[m] for m in measure] + [np.asarray(c.array) for c in channels];
+    for array in arrays:
       if shape is not None:
-        intensity = sd.find_intensity(measure_to_array[m], label=shape, max_label=max_label, **parameter_intensity);
+        intensity = sd.find_intensity(array, label=shape, max_label=max_label, **parameter_intensity);
       else:
-        intensity = me.measure_expression(measure_to_array[m], centers, search_radius=r, **parameter_intensity, processes=1, verbose=False)
+        intensity = me.measure_expression(array, centers, search_radius=r, **parameter_intensity, processes=1, verbose=False)
       
       results += (intensity,)
     
@@ -585,15 +635,39 @@ def detect_cells_block(source, parameter = default_cell_detection_parameter):
 ### Cell detection processing steps
 ###############################################################################
 
-def remove_background(source, shape, form = 'Disk'):
-  selem = se.structure_element(shape, form=form, ndim=2).astype('uint8');
-  removed = np.empty(source.shape, dtype=source.dtype);
-  for z in range(source.shape[2]):
-    #img[:,:,z] = img[:,:,z] - grey_opening(img[:,:,z], structure = structureElement('Disk', (30,30)));
-    #img[:,:,z] = img[:,:,z] - morph.grey_opening(img[:,:,z], structure = self.structureELement('Disk', (150,150)));
-    # removed[:,:,z] = source[:,:,z] - cv2.morphologyEx(source[:,:,z], cv2.MORPH_OPEN, selem)
-    removed[:,:,z] = source[:,:,z] - np.minimum(source[:,:,z], cv2.GaussianBlur(source[:,:,z], (0,0), 5));
-  return removed; 
+def remove_background(source, shape, form = 'Disk', processes = 1):
+  """Removes the background of each z-plane via a top-hat transform.
+  
+  Arguments
+  ---------
+  source : array
+    The 3d image.
+  shape : tuple
+    The shape of the 2d structure element to estimate the background.
+  form : str or None
+    The form of the structure element. 'Disk' or 'Sphere' use an octagonal 
+    approximation, 'Cube' or 'Rectangle' a rectangle. The grey opening is 
+    computed with line structure elements via 
+    :func:`~ClearMap.ImageProcessing.Filter.LineMorphology.opening` 
+    at a cost independent of the shape.
+    'Gaussian' or None estimate the background by a Gaussian blur instead.
+  processes : int or None
+    Number of threads used to process the z-planes. Defaults to a single 
+    thread as this runs inside the block processing workers. If None, use 
+    the number of cpus.
+  
+  Returns
+  -------
+  removed : array
+    The background corrected image.
+  """
+  if form in [None, 'Gaussian', 'gaussian', 'g']:
+    removed = np.empty(source.shape, dtype=source.dtype);
+    for z in range(source.shape[2]):
+      removed[:,:,z] = source[:,:,z] - np.minimum(source[:,:,z], cv2.GaussianBlur(source[:,:,z], (0,0), 5));
+    return removed;
+  
+  return lm.top_hat(source, shape=shape, form=form, axis=2, processes=processes);
 
 
 def equalize(source, percentile = (0.5, 0.95), max_value = 1.5, selem = (200,200,5), spacing = (50,50,5), interpolate = 1, mask = None):
@@ -671,6 +745,141 @@ def filter_cells(source, sink, thresholds):
   return io.write(sink, cells_filtered)
 
 
+def remove_overlapping_cells(source, sink = None, distances = ((3,3,3),), conditional = False, intensity = 'source', coordinates = ('x','y','z'), processes = None, verbose = False):
+  """Remove cells that overlap with a brighter cell (non-maximum suppression).
+  
+  Arguments
+  ---------
+  source : str, array or Source
+    The source for the cell data.
+  sink : str, array, Source or None
+    The sink for the results. If None, the filtered array is returned.
+  distances : list of tuples
+    Each entry gives per axis distances. A cell is removed if for one of the 
+    entries all of its coordinate differences to a brighter, not removed cell
+    are smaller than these distances, e.g. [(3,3,3), (1.5,1.5,6)] also 
+    removes cells repeated in neighbouring z-planes.
+  conditional : bool
+    If True, the further distance entries only apply to cells that overlap 
+    some other cell within the first entry, as in the original ClearMap 
+    overlap filter.
+  intensity : str or None
+    The column used to rank the cells. If None, the cells are assumed to be 
+    sorted by decreasing intensity.
+  coordinates : tuple of str
+    The coordinate columns.
+  processes : int or None
+    Number of threads used to find overlapping cells in spatial tiles.
+  verbose : bool
+    If True, print progress information.
+  
+  Returns
+  -------
+  sink : str, array or Source
+    The cell data with overlapping cells removed, in the original order.
+  
+  Note
+  ----
+  Candidate pairs are found with a kd-tree in parallel over spatial tiles 
+  with overlapping halos. The greedy suppression in order of decreasing 
+  intensity is then resolved in vectorized rounds on the pair graph, which 
+  gives the same result as processing the cells one by one.
+  """
+  if verbose:
+    timer = tmr.Timer();
+  
+  source = io.as_source(source);
+  cells = source[:];
+  points = np.array([cells[c] for c in coordinates], dtype=float).T;
+  n_cells = len(points);
+  
+  if intensity is None:
+    rank = np.arange(n_cells);
+  else:
+    rank = np.empty(n_cells, dtype=int);
+    rank[np.argsort(-np.asarray(cells[intensity]), kind='stable')] = np.arange(n_cells);
+  
+  distances = np.array(distances, dtype=float).reshape(-1, points.shape[1]);
+  pairs, within = _overlapping_pairs(points, distances, processes=processes);
+  if conditional and len(distances) > 1:
+    primary = np.zeros(n_cells, dtype=bool);
+    primary[pairs[within[:,0]].ravel()] = True;
+  
+  #a dominates b if a ranks higher
+  a, b = pairs.T;
+  swap = rank[a] > rank[b];
+  a[swap], b[swap] = b[swap], a[swap];
+  if conditional and len(distances) > 1:
+    active = np.logical_or(within[:,0], primary[a]);
+    a, b = a[active], b[active];
+  
+  #greedy suppression: a cell is kept if all its dominating cells are removed 
+  state = np.zeros(n_cells, dtype='int8'); # 0 undecided, 1 kept, -1 removed
+  while True:
+    undecided = state == 0;
+    if not np.any(undecided):
+      break;
+    removed = np.zeros(n_cells, dtype=bool);
+    removed[b[state[a] == 1]] = True;
+    blocked = np.zeros(n_cells, dtype=bool);
+    blocked[b[state[a] == 0]] = True;
+    state[np.logical_and(undecided, removed)] = -1;
+    state[np.logical_and(undecided, ~np.logical_or(removed, blocked))] = 1;
+    active = np.logical_and(state[b] == 0, state[a] != -1);
+    a, b = a[active], b[active];
+  
+  cells_filtered = cells[state == 1];
+  
+  if verbose:
+    timer.print_elapsed_time('Overlap removal: %d of %d cells removed' % (n_cells - len(cells_filtered), n_cells));
+  
+  return io.write(sink, cells_filtered);
+
+
+def _overlapping_pairs(points, distances, processes = None):
+  """Pairs of points whose differences are within one of the distance boxes and the boxes they are within."""
+  import scipy.spatial as spatial
+  
+  if processes is None:
+    processes = mp.cpu_count();
+  if not isinstance(processes, int):
+    processes = 1;
+  
+  extent = distances.max(axis=0);
+  scaled = points / extent;
+  
+  #tiles along the last axis, cores are disjoint, halos have width 1
+  axis = scaled.shape[1] - 1;
+  order = np.argsort(scaled[:,axis], kind='stable');
+  z = scaled[order, axis];
+  n_tiles = max(1, min(4 * processes, len(points) // 10000));
+  bounds = np.quantile(z, np.linspace(0, 1, n_tiles + 1)) if len(z) > 0 else np.zeros(2);
+  bounds[-1] = np.inf;
+  
+  def _tile(t):
+    lo, hi = bounds[t], bounds[t+1];
+    start = np.searchsorted(z, lo, side='left');
+    core  = np.searchsorted(z, hi, side='left');
+    stop  = np.searchsorted(z, hi + 1, side='right');
+    if core <= start:
+      return np.zeros((0,2), dtype=int);
+    ids = order[start:stop];
+    tree = spatial.cKDTree(scaled[ids]);
+    pairs = tree.query_pairs(1, p=np.inf, output_type='ndarray');
+    pairs = pairs[np.min(pairs, axis=1) < core - start];
+    return ids[pairs];
+  
+  with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+    pairs = list(executor.map(_tile, range(n_tiles)));
+  pairs = np.concatenate(pairs) if len(pairs) > 0 else np.zeros((0,2), dtype=int);
+  
+  #exact anisotropic test
+  diff = np.abs(points[pairs[:,0]] - points[pairs[:,1]]);
+  within = np.array([np.all(diff < d, axis=1) for d in distances]).reshape(len(distances), len(pairs)).T;
+  overlap = np.any(within, axis=1);
+  return pairs[overlap], within[overlap];
+
+
 ###############################################################################
 ### Tests
 ###############################################################################
@@ -680,4 +889,13 @@ def _test():
   import numpy as np
   import ClearMap.Visualization.Plot3d as p3d
   import ClearMap.Tests.Files as tsf
-  import ClearMap.ImageProcessing.Experts.Cells as cells
\ No newline at end of file
+  import ClearMap.ImageProcessing.Experts.Cells as cells
+  
+  #overlap removal, z-repeats are only removed next to overlapping cells
+  points = np.zeros(3, dtype=[('x',float),('y',float),('z',float)]);
+  points['z'] = [0, 5, 20];
+  distances = [(4,4,4), (2,2,8)];
+  assert len(cells.remove_overlapping_cells(points, distances=distances, intensity=None)) == 2
+  assert len(cells.remove_overlapping_cells(points, distances=distances, conditional=True, intensity=None)) == 3
+  points = np.concatenate([points, np.array([(3,3,0)], dtype=points.dtype)]);
+  assert len(cells.remove_overlapping_cells(points, distances=distances, conditional=True, intensity=None)) == 2
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+LineMorphology
+==============
+
+Fast grey scale morphology with large structuring elements.
+
+Erosions and dilations with line structuring elements are calculated with the
+van Herk / Gil-Werman algorithm [1, 2] which needs a constant number of
+comparisons per pixel independent of the length of the line.
+
+Rectangles are decomposed exactly into a horizontal and a vertical line,
+disks are approximated by octagons, i.e. the Minkowski sum of a horizontal,
+a vertical and two diagonal lines. Large structuring elements,
+e.g. 19x19 or larger, thus cost about as much as small ones.
+
+References
+----------
+[1] van Herk, "A fast algorithm for local minimum and maximum filters on
+    rectangular and octagonal kernels", Pattern Recognit. Lett. 13, 517 (1992)
+[2] Gil and Werman, "Computing 2-D min, median, and max filters",
+    IEEE Trans. Pattern Anal. Mach. Intell. 15, 504 (1993)
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+import numpy as np
+import multiprocessing as mp
+import concurrent.futures
+
+
+###############################################################################
+### Line filter
+###############################################################################
+
+def _extreme_value(dtype, minimum):
+  """Neutral padding value for a min (minimum=True) or max filter."""
+  dtype = np.dtype(dtype);
+  if dtype == bool:
+    return minimum;
+  if np.issubdtype(dtype, np.integer):
+    info = np.iinfo(dtype);
+  else:
+    info = np.finfo(dtype);
+  return info.max if minimum else info.min;
+
+
+def line_filter_1d(source, length, axis = 0, minimum = True):
+  """Minimum or maximum filter along an axis with the van Herk/Gil-Werman algorithm.
+
+  Arguments
+  ---------
+  source : array
+    The data to filter.
+  length : int
+    The length of the line structuring element. Should be odd.
+  axis : int
+    The axis along which to filter.
+  minimum : bool
+    If True, calculate the minimum filter, otherwise the maximum filter.
+
+  Returns
+  -------
+  filtered : array
+    The filtered array.
+
+  Note
+  ----
+  The borders are padded with the neutral element of the filter.
+  """
+  source = np.asarray(source);
+  if length <= 1:
+    return source.copy();
+
+  op = np.minimum if minimum else np.maximum;
+  fill = _extreme_value(source.dtype, minimum);
+
+  data = np.moveaxis(source, axis, -1);
+  n = data.shape[-1];
+  offset = length // 2;
+
+  n_blocks = (n + length - 1 + length - 1) // length;
+  padded = np.full(data.shape[:-1] + (n_blocks * length,), fill, dtype=source.dtype);
+  padded[...,offset:offset+n] = data;
+  blocks = padded.reshape(data.shape[:-1] + (n_blocks, length));
+
+  prefix = op.accumulate(blocks, axis=-1).reshape(padded.shape);
+  suffix = op.accumulate(blocks[...,::-1], axis=-1)[...,::-1].reshape(padded.shape);
+  del padded, blocks;
+
+  filtered = op(suffix[...,:n], prefix[...,length-1:length-1+n]);
+  return np.moveaxis(filtered, -1, axis);
+
+
+def _diagonal_indices(shape, direction):
+  """Indices that shear a 2d array so that its diagonals become rows."""
+  x = np.arange(shape[0])[:,None];
+  y = np.arange(shape[1])[None,:];
+  if direction > 0:
+    rows = x - y + shape[1] - 1;
+  else:
+    rows = x + y;
+  cols = np.broadcast_to(y, shape);
+  return rows, cols, shape[0] + shape[1] - 1;
+
+
+def line_filter(source, line, minimum = True):
+  """Minimum or maximum filter of a 2d image with a line structuring element.
+
+  Arguments
+  ---------
+  source : array
+    The 2d image to filter.
+  line : tuple
+    The line as (length, direction) with direction in
+    'x', 'y', 'xy' (main diagonal) or 'yx' (anti-diagonal).
+  minimum : bool
+    If True, calculate the minimum filter, otherwise the maximum filter.
+
+  Returns
+  -------
+  filtered : array
+    The filtered image.
+  """
+  length, direction = line;
+  if direction == 'x':
+    return line_filter_1d(source, length, axis=0, minimum=minimum);
+  elif direction == 'y':
+    return line_filter_1d(source, length, axis=1, minimum=minimum);
+  elif direction in ('xy', 'yx'):
+    rows, cols, n_rows = _diagonal_indices(source.shape, 1 if direction == 'xy' else -1);
+    sheared = np.full((n_rows, source.shape[1]), _extreme_value(source.dtype, minimum), dtype=source.dtype);
+    sheared[rows, cols] = source;
+    sheared = line_filter_1d(sheared, length, axis=1, minimum=minimum);
+    return sheared[rows, cols];
+  else:
+    raise ValueError('Line direction %r not valid!' % (direction,));
+
+
+###############################################################################
+### Line decompositions
+###############################################################################
+
+def line_decomposition(shape, form = 'Disk'):
+  """Decomposes a 2d structuring element into line structuring elements.
+
+  Arguments
+  ---------
+  shape : int or tuple
+    The shape of the structuring element.
+  form : str
+    The form of the structuring element, 'Disk' is approximated by an octagon,
+    'Rectangle' is decomposed exactly.
+
+  Returns
+  -------
+  lines : list of tuples
+    The (length, direction) of the line structuring elements whose Minkowski
+    sum yields the structuring element.
+  """
+  if isinstance(shape, int):
+    shape = (shape, shape);
+  shape = tuple(shape)[:2];
+  radii = [s // 2 for s in shape];
+
+  if form in ['Cube', 'cube', 'c', 'Rectangle', 'rectangle', 'r']:
+    lines = [(2 * radii[0] + 1, 'x'), (2 * radii[1] + 1, 'y')];
+  elif form in ['Disk', 'disk', 'd', 'Sphere', 'sphere', 'shpere', 's']:
+    # regular octagon: the horizontal side equals the diagonal side
+    diagonal = int(np.round(min(radii) / (2 + np.sqrt(2))));
+    lines = [(2 * (radii[0] - 2 * diagonal) + 1, 'x'), (2 * (radii[1] - 2 * diagonal) + 1, 'y'),
+             (2 * diagonal + 1, 'xy'), (2 * diagonal + 1, 'yx')];
+  else:
+    raise ValueError('Form %r for line decomposition not valid!' % (form,));
+
+  return [l for l in lines if l[0] > 1];
+
+
+###############################################################################
+### Morphological operations
+###############################################################################
+
+def erode(source, lines):
+  """Grey erosion of a 2d image with the Minkowski sum of line elements."""
+  for line in lines:
+    source = line_filter(source, line, minimum=True);
+  return source;
+
+
+def dilate(source, lines):
+  """Grey dilation of a 2d image with the Minkowski sum of line elements."""
+  for line in lines:
+    source = line_filter(source, line, minimum=False);
+  return source;
+
+
+def opening(source, shape, form = 'Disk', axis = 2, processes = None):
+  """Grey opening of the planes of an image.
+
+  Arguments
+  ---------
+  source : array
+    The 2d or 3d image.
+  shape : int or tuple
+    The shape of the 2d structuring element.
+  form : str
+    The form of the structuring element, see :func:`line_decomposition`.
+  axis : int
+    For 3d images, the axis along which the planes are processed.
+  processes : int or None
+    The number of threads to process the planes with. If None use number
+    of cpus.
+
+  Returns
+  -------
+  opened : array
+    The opened image.
+  """
+  source = np.asarray(source);
+  lines = line_decomposition(shape, form=form);
+
+  # dilating in reverse order keeps the opening anti-extensive at the borders
+  def _opening(plane):
+    return dilate(erode(plane, lines), lines[::-1]);
+
+  if source.ndim == 2:
+    return _opening(source);
+
+  if processes is None:
+    processes = mp.cpu_count();
+
+  opened = np.empty(source.shape, dtype=source.dtype);
+  planes = np.moveaxis(source, axis, 0);
+  opened_planes = np.moveaxis(opened, axis, 0);
+
+  def _process(z):
+    opened_planes[z] = _opening(planes[z]);
+
+  with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+    list(executor.map(_process, range(planes.shape[0])));
+
+  return opened;
+
+
+def top_hat(source, shape, form = 'Disk', axis = 2, processes = None):
+  """White top-hat transform, i.e. the image minus its grey opening.
+  
+  For binary images this is the image without its opening.
+
+  Arguments
+  ---------
+  source : array
+    The 2d or 3d image.
+  shape : int or tuple
+    The shape of the 2d structuring element.
+  form : str
+    The form of the structuring element, see :func:`line_decomposition`.
+  axis : int
+    For 3d images, the axis along which the planes are processed.
+  processes : int or None
+    The number of threads to process the planes with. If None use number
+    of cpus.
+
+  Returns
+  -------
+  filtered : array
+    The top-hat filtered image.
+  """
+  source = np.asarray(source);
+  opened = opening(source, shape=shape, form=form, axis=axis, processes=processes);
+  if source.dtype == bool:
+    return np.logical_and(source, np.logical_not(opened), out=opened);
+  return np.subtract(source, opened, out=opened);
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import scipy.ndimage as ndi
+  import ClearMap.ImageProcessing.Filter.LineMorphology as lm
+
+  data = np.random.rand(50,40,3);
+
+  # rectangles are exact
+  opened = lm.opening(data, shape=(9,7), form='Rectangle');
+  for z in range(data.shape[2]):
+    check = ndi.grey_opening(data[:,:,z], size=(9,7), mode='nearest');
+    print(np.allclose(opened[:,:,z], check))
+
+  # octagon
+  lines = lm.line_decomposition((19,19), form='Disk');
+  print(lines)
+  filtered = lm.top_hat(data, shape=(19,19), form='Disk');
+  print(filtered.min() >= 0)
+
+  # binary images
+  binary = data > 0.5;
+  filtered = lm.top_hat(binary, shape=(3,3), form='Rectangle');
+  check = binary & (lm.opening(binary.astype('uint8'), shape=(3,3), form='Rectangle') == 0);
+  print(np.all(filtered == check))
@@ -70,6 +70,7 @@ import ClearMap.ParallelProcessing.ParallelTraceback as ptb
 
 import ClearMap.IO.IO as io
 import ClearMap.IO.SMA as sma
+import ClearMap.IO.FileList as fl
 
 import ClearMap.Utils.Timer as tmr;
 
@@ -123,7 +124,7 @@ def process(function, source, sink = None,
             axes = None, size_max = None, size_min = None, overlap = None,  
             optimization = True, optimization_fix = 'all', neighbours = False,
             function_type = None, as_memory = False, return_result = False,
-            return_blocks = False,
+            return_blocks = False, callback = None,
             processes = None, verbose = False, 
             **kwargs):
   """Create blocks and process a function on them in parallel.
@@ -175,6 +176,11 @@ def process(function, source, sink = None,
     If True, return the results of the proceessing functions.
   return_blocks : bool
     If True, return the block information used to distribute the processing.
+  callback : function or None
+    If not None, the result of each block is passed to this function in the 
+    main process in block order as soon as it is available. The results are 
+    then not collected, which keeps the memory bounded when processing many 
+    blocks with large results.
   processes : int
     The number of parallel processes, if 'serial', use serial processing.
   verbose : bool
@@ -226,7 +232,7 @@ def process(function, source, sink = None,
   if function_type is None:
     function_type = 'array';
   if function_type == 'block':
-    func = ft.partial(process_block_block, function=function, as_memory=as_memory, return_result=return_result, verbose=verbose, **kwargs);
+    func = ft.partial(process_block_block, function=function, as_memory=as_memory, return_result=return_result or callback is not None, verbose=verbose, **kwargs);
   elif function_type == 'source':
     func = ft.partial(process_block_source, function=function, as_memory=as_memory, as_array=False, verbose=verbose, **kwargs);
   elif function_type == 'array':
@@ -246,10 +252,22 @@ def process(function, source, sink = None,
     with cf.ProcessPoolExecutor(max_workers=processes) as executor:
     #with BoundedProcessPoolExecutor(max_workers=processes) as executor:
       futures = [executor.submit(func, *args) for args in zip(source_blocks, sink_blocks)];
-      result  = [f.result() for f in futures];
+      if callback is not None:
+        for i in range(n_blocks):
+          r = futures[i].result();
+          futures[i] = None;
+          callback(r);
+        result = None;
+      else:
+        result  = [f.result() for f in futures];
       #executor.map(function, source_blocks, sink_blocks)
   else:
-    result = [func(*args) for args in zip(source_blocks, sink_blocks)]; #analysis:ignore
+    if callback is not None:
+      for args in zip(source_blocks, sink_blocks):
+        callback(func(*args));
+      result = None;
+    else:
+      result = [func(*args) for args in zip(source_blocks, sink_blocks)]; #analysis:ignore
   
   if verbose:
     timer.print_elapsed_time("Processed %d blocks with function %r" % (n_blocks, function.__name__))
@@ -573,7 +591,10 @@ def block_axes(source, axes = None):
     return axes;
   
   source = io.as_source(source);
-  if source.order == 'F':
+  if isinstance(source, (fl.Source, fl.VirtualSource)):
+    #split along the files so that each file is read by a single block
+    axes = [source.ndim-1];
+  elif source.order == 'F':
     axes = [source.ndim-1];
   else:
     axes = [0];
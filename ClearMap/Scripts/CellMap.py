@@ -49,8 +49,9 @@ if __name__ == "__main__":
             cfos_tiff = os.path.join(directory, raw_fn)
             autof_tiff = os.path.join(directory, autof_fn)
             
-            np.save(os.path.join(directory, expression_raw), np.transpose(tiff.imread(cfos_tiff), (2,1,0)))
-            np.save(os.path.join(directory, expression_auto), np.transpose(tiff.imread(autof_tiff), (2,1,0)))
+            # tif sources are (x,y,z) views of the (z,y,x) pages, copy them in tiles
+            io.reorient(cfos_tiff, os.path.join(directory, expression_raw), processes=32)
+            io.reorient(autof_tiff, os.path.join(directory, expression_auto), processes=32)
             
         # expression_raw = config.get('raw_data_path')
         # expression_auto = config.get('autof_data_path')
@@ -255,15 +256,9 @@ if __name__ == "__main__":
     
     print("\nResampling and aligning channels...\n")
 
-    # Convert raw image stack to NumPy array
+    # Tiff folders are read directly as file lists by resampling and cell detection
     
-    if filetype == "tiff_folder":
-        source = ws.source('raw')
-        sink   = ws.filename('stitched')
-        io.delete_file(sink)
-        io.convert(source, sink, processes=32, verbose=True)
-    else:
-        ws.update(stitched=expression_raw)
+    ws.update(stitched=expression_raw)
         
     # cfos = os.path.join(directory, expression_raw.split('.')[0] + '_conv.tif')
     # autof = os.path.join(directory, expression_auto.split('.')[0] + '_conv.tif')
@@ -279,11 +274,12 @@ if __name__ == "__main__":
     
     # # Upscale reference atlas and annotation atlas to match data size
     # upscale(directory, reference_file, autof, 'reference_upscaled.tif')
-    # annotation_array = np.transpose(upscale(directory, annotation_file, autof, 'annotation_upscaled.tif'), (2,1,0))
+    # annotation_array = upscale(directory, annotation_file, autof)
     #!!!!!!!!!!!!!!!!!!!!!!!!!
     resample_parameter = {
         "source_resolution" : (raw_x_res,raw_y_res,raw_z_res),
         "sink_resolution"   : (25,25,25),
+        "method" : 'stream',
         "processes" : 32,
         "verbose" : True,             
         };    
@@ -295,6 +291,7 @@ if __name__ == "__main__":
     resample_parameter_auto = {
         "source_resolution" : (autof_x_res,autof_y_res,autof_z_res),
         "sink_resolution"   : (25,25,25),
+        "method" : 'stream',
         "processes" : 32,
         "verbose" : True,                
         };   
@@ -429,29 +426,30 @@ if __name__ == "__main__":
                        sink = ws.filename('cells', postfix='filtered'), 
                        thresholds=thresholds); 
 
-    source = ws.source('cells', postfix='filtered')
+    source = ws.source('cells', postfix='filtered')[:]
     coordinates = np.array([source[c] for c in 'xyz']).T
 
     coordinates_transformed = transformation(coordinates, align_channel_outdir, align_reference_outdir, workspace=ws)
     
     # Annotate cells based on position in annotation image
     label = ano.label_points(coordinates_transformed, key='order', annotation_file=annotation_file)
-    names = ano.convert_label(label, key='order', value='name')
-    ID = ano.convert_label(label, key='order', value='id')
-    parent_ID = ano.convert_label(label, key='order', value='parent_structure_id')
-
-    coordinates_transformed.dtype=[(t,float) for t in ('xt','yt','zt')]
-    label = np.array(label, dtype=[('order', int)])
-    names = np.array(names, dtype=[('name', 'U256')])
-    ID = np.array(ID, dtype=[('id', int)])
-    parent_ID = np.array(parent_ID, dtype=[('parent_structure_id', 'U256')])
-
-    import numpy.lib.recfunctions as rfn
-
-    # Assemble cell information into NumPy array
-    cells_data = rfn.merge_arrays([source[:], coordinates_transformed, label, ID, parent_ID, names], flatten=True, usemask=False)
-
-    io.write(ws.filename('cells'), cells_data)
+    annotation = ano.get_annotation()
+    name_map = annotation.get_label_map(key='order', value='name')
+    ids = np.asarray(annotation.get_list('id'), dtype=int)
+    parent_ids = np.array([-1 if p is None else p for p in annotation.get_list('parent_structure_id')], dtype=int)
+
+    # Assemble cell information into NumPy array, region names as codes into name_map.categories
+    annotation_fields = [('xt', float), ('yt', float), ('zt', float), ('order', int), ('id', int),
+                         ('parent_structure_id', int), ('name', 'int32')]
+    cells_data = np.empty(len(source), dtype=source.dtype.descr + annotation_fields)
+    for name in source.dtype.names:
+        cells_data[name] = source[name]
+    for d, name in enumerate(('xt', 'yt', 'zt')):
+        cells_data[name] = coordinates_transformed[:, d]
+    cells_data['order'] = label
+    cells_data['id'] = ids[label]
+    cells_data['parent_structure_id'] = parent_ids[label]
+    cells_data['name'] = name_map.code(label)
     
     if checkpoints:
         print("\nCell annotation complete!")
@@ -460,13 +458,12 @@ if __name__ == "__main__":
     print("\nRemoving invalid cells and exporting detected cell data...\n")
     
     # Remove invalid and overlapping cells. Export corrected cell data to CSV
-    source = ws.source('cells')
-    header = ', '.join([h for h in source.dtype.names])
-    source = remove_universe(source.array)
-    source = np.flip(np.sort(source, order=['source']),axis=0)
-    # source = remove_overlap(source, filter_distance_min) 
-    source = np.sort(source, order=['z'])
-    np.savetxt(ws.filename('cells', extension='csv'), source, header=header, delimiter=',', fmt='%s')
+    source = remove_universe(cells_data, categories=name_map.categories)
+    source = source[np.argsort(-source['source'], kind='stable')]
+    source = remove_overlap(source, filter_distance_min)
+    source = source[np.argsort(source['z'], kind='stable')]
+    ct.write(ws.filename('cells', extension='table'), source, categories={'name': name_map.categories})
+    ct.export_csv(ws.filename('cells', extension='table'), ws.filename('cells', extension='csv'))
 
     # print("\nBeginning cell voxelization...\n")
     # Voxelize detected cells
@@ -491,9 +488,7 @@ if __name__ == "__main__":
     # Obtain and export region-specific detection results
     num_regions, region_names, region_acronyms, region_ids, region_parent_ids, region_children = get_region_info(os.path.join(clearmap_path, 'ClearMap/Resources/Atlas/annotations_reform.json'))
 
-    register_annotation(directory, annotation_file)
-    
-    region_counts, region_volumes, region_densities = get_region_stats(num_regions, directory, region_ids, region_parent_ids, [25,25,25])
+    region_counts, region_volumes, region_densities = get_region_stats(num_regions, directory, region_ids, region_parent_ids, [25,25,25], source, annotation_file)
     
     print("\nExporting cell count statistics...\n")
     
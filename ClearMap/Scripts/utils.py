@@ -4,14 +4,11 @@ import termios
 import yaml
 import csv
 import json
-import pandas as pd
 from scipy.io import savemat
 import shutil 
 import os 
 import tifffile as tiff
-import datetime
 import numpy as np
-from PIL import Image
 
 def checkpoint():
     
@@ -54,8 +51,9 @@ def remove_overlap(source, filter_distance_min):
     
     Cells are removed if all three coordinates are within filter_distance_min of
     a cell of greater intensity, or if they are within half of filter_distance_min
-    in the x and y direction, and 2x filter_distance_min in the z direction to correct
-    for cells appearing in multiple slices due to out-of-plane excitation during imaging
+    in the x and y direction, and 2x filter_distance_min in the z direction of a cell
+    of greater intensity that itself overlaps another cell, to correct for cells
+    appearing in multiple slices due to out-of-plane excitation during imaging
 
     Arguments
     ---------
@@ -68,36 +66,24 @@ def remove_overlap(source, filter_distance_min):
     -------
         source_filtered : array
             Input array with overlapping cells removed 
+            
+    Note
+    ----
+        Uses the kd-tree based non-maximum suppression in
+        ClearMap.ImageProcessing.Experts.Cells.remove_overlapping_cells
     """    
     
-    indices_to_remove = set()
-    source_coordinates = np.column_stack((source['x'], source['y'], source['z']))
-    z_overlap_min = np.array([filter_distance_min/2, filter_distance_min/2, filter_distance_min*2])
-    
-    for i in range(len(source_coordinates)):
-        if i not in indices_to_remove:
-            current_point = source_coordinates[i]  
-            
-            diffs = abs(source_coordinates - current_point)
-            
-            close_indices = np.where(np.all(diffs < filter_distance_min, axis=1))[0]
-            close_indices = close_indices[close_indices != i]
-            
-            close_z_indices = np.where(np.all(diffs < z_overlap_min, axis=1))[0]
-            close_z_indices = close_z_indices[close_z_indices != i]
+    import ClearMap.ImageProcessing.Experts.Cells as cells
 
-            if close_indices.size > 0:
-                indices_to_remove.update(set(close_indices))
-                indices_to_remove.update(set(close_z_indices))
-        else:
-            print("Removed overlapping cell at index: " + str(i))
+    distances = [(filter_distance_min, filter_distance_min, filter_distance_min),
+                 (filter_distance_min/2, filter_distance_min/2, filter_distance_min*2)]
+    source_filtered = cells.remove_overlapping_cells(source, distances=distances, conditional=True, intensity=None)
 
-    source_filtered = np.delete(source, list(indices_to_remove), axis=0)
     return source_filtered
     
     
     
-def remove_universe(source):
+def remove_universe(source, categories=None):
     
     """Removes cells classified as "universe".
     
@@ -105,20 +91,26 @@ def remove_universe(source):
     ---------
         source : array
             Annotated cell detection results
+        categories : array or None
+            The region names the 'name' codes of the cells refer to. If None,
+            the 'name' field holds the names themselves.
     Returns
     -------
         source_filtered : array
             Input array with "universe" cells removed 
     """    
     
-    universe_indices = np.where(source['name'] == 'universe')[0]
-    source_filtered = np.delete(source, universe_indices, axis=0)
+    if categories is None:
+        universe = source['name'] == 'universe'
+    else:
+        universe = np.isin(source['name'], np.nonzero(np.asarray(categories) == 'universe')[0])
+    source_filtered = source[~universe]
     
     return source_filtered
     
     
     
-def transformation(coordinates, align_channel_outdir, align_reference_outdir, workspace=None):
+def transformation(coordinates, align_channel_outdir, align_reference_outdir, workspace=None, field=False):
 
     """Transforms detected cell coordinates onto atlas space
     
@@ -126,13 +118,17 @@ def transformation(coordinates, align_channel_outdir, align_reference_outdir, wo
     ---------
         coordinates : array
             x, y, and z coordinates for each detected cell on experimental data
+        field : bool
+            If True, map the points via cached displacement fields of the 
+            registrations instead of evaluating them exactly, see 
+            ClearMap.Alignment.Transformation.transform_points
     Returns
     -------
         coordinates : array
             Corresponding x, y, and z coordinates transformed onto the brain atlas space
     """    
     
-    import ClearMap.Alignment.Elastix as elx
+    import ClearMap.Alignment.Transformation as trf
 
     
     if workspace is not None:
@@ -144,88 +140,27 @@ def transformation(coordinates, align_channel_outdir, align_reference_outdir, wo
                         source_shape=io.shape(ws.filename('stitched')), 
                         sink_shape=io.shape(ws.filename('resampled')));
     
-    coordinates = elx.transform_points(
+    coordinates = trf.transform_points(
                     coordinates, sink=None, 
-                    transform_directory=align_channel_outdir, 
-                    binary=True, indices=False);
+                    transform_directory=align_channel_outdir,
+                    indices=False, field=field);
 
-    coordinates = elx.transform_points(
+    coordinates = trf.transform_points(
                     coordinates, sink=None, 
                     transform_directory=align_reference_outdir,
-                    binary=True, indices=False);
+                    indices=False, field=field);
 
     return coordinates
     
 
     
-def register_annotation(directory, annotation_file):
-    
-    """Aligns annotation atlas to fit the shape of the autofluorescence data
-    
-    Applies transformation parameters generated when aligning the reference atlas
-    to the autofluorescence data and saves the registered annotation to the experimental
-    directory.
-    
-    Arguments
-    ---------
-        directory : String
-            Path to experimental data directory
-            
-        annotation_file : String
-            Path to annotation atlas
-    """   
-    
-    import ClearMap.Alignment.Elastix as elx
-
-    auto_to_anno_path = os.path.join(directory, 'elastix_auto_to_anno')
-
-    if not os.path.exists(auto_to_anno_path):
-        os.makedirs(auto_to_anno_path)
-        
-    shutil.copy(os.path.join(directory, 'elastix_auto_to_reference/TransformParameters.0.txt'), auto_to_anno_path)
-    shutil.copy(os.path.join(directory, 'elastix_auto_to_reference/TransformParameters.1.txt'), auto_to_anno_path)
-
-    transform_anno_0 = os.path.join(auto_to_anno_path, 'TransformParameters.0.txt')
-    transform_anno_1 = os.path.join(auto_to_anno_path, 'TransformParameters.1.txt')
-
-    modify_transform_params(transform_anno_0)
-    modify_transform_params(transform_anno_1)
-
-    elx.transform(source=annotation_file, transform_parameter_file=transform_anno_1, result_directory=directory)
-    os.rename(os.path.join(directory, 'result.tiff'), os.path.join(directory, 'auto_to_anno.tif'))
-
-    
-    
-def modify_transform_params(transform_param_path):
-    
-    """Removes interpolation and changes output file type in transformation parameter file
-    
-    Arguments
-    ---------
-        transform_param_path : String
-            Path to transformation parameter file
-    """   
-        
-    with open(transform_param_path, 'r') as transform_file:
-        lines = transform_file.readlines()
-
-    for i, line in enumerate(lines):
-        if "(FinalBSplineInterpolationOrder 3)" in line:
-            lines[i] = line.replace("3", "0")
-        if "(ResultImageFormat \"mhd\")" in line:
-            lines[i] = line.replace("mhd", "tiff")
-            break
-    with open(transform_param_path, 'w') as transform_file:
-        transform_file.writelines(lines)    
-    
-    
-    
-def get_region_stats(num_regions, directory, region_ids, region_parent_ids, res):
+def get_region_stats(num_regions, directory, region_ids, region_parent_ids, res, cells, annotation_file, processes=None):
 
     """Computes experiment-specific region statistics
     
-    Observed brain regions and their respective volumes are computed from the registered annotation
-    atlas. The output csv file is read to obtain the number of detected cells per region, and the 
+    Observed brain regions and their respective volumes are computed by mapping the grid of the
+    autofluorescence data into the annotation with the registration, without writing a registered
+    annotation. The annotated cell array is used directly to obtain the number of detected cells per region, and the 
     density of cell expression is calculated by dividing the number of detected cells per region by
     the volume of the associated region.
     
@@ -246,6 +181,15 @@ def get_region_stats(num_regions, directory, region_ids, region_parent_ids, res)
         res : array
             x, y, and z resolution of experimental data
             
+        cells : structured array
+            Detected cells with an 'id' field holding the annotated region ID#
+            
+        annotation_file : String
+            Path to annotation atlas
+            
+        processes : int or None
+            Number of threads used to count the registered annotation per region
+            
     Returns
     -------
         region_counts : array
@@ -258,43 +202,23 @@ def get_region_stats(num_regions, directory, region_ids, region_parent_ids, res)
             Number of cells per mm^3 detected in each region
     """   
     
-    import ClearMap.IO.IO as io
-
-    region_volumes = np.zeros(num_regions, dtype=float)
-    region_counts = np.zeros(num_regions)
-    region_densities = np.zeros(num_regions)
-
-    csv_in_path = os.path.join(directory, 'cells.csv')
-    csv_in = pd.read_csv(csv_in_path)
+    import ClearMap.Alignment.Annotation as ano
+    import ClearMap.Alignment.Transformation as trf
 
-    region_image_path = os.path.join(directory, 'auto_to_anno.tif')
-    unique_regions, pixel_count = np.unique(io.as_source(region_image_path).array, return_counts=True)
+    # Ancestor index to allocate counts and volumes to regions and their parent regions
+    hierarchy = ano.RegionHierarchy(region_ids[:num_regions], region_parent_ids[:num_regions])
 
+    # Region volumes in the experimental data, counted on the grid of the autofluorescence data
     resolution = (res[0]*res[1]*res[2])/(10**9) # Converted from micrometers^3 to millimeters^3
-    volumes = pixel_count*resolution
-
-    # Obtain frequency counts for each region ID
-    total_counts = csv_in[' id'].value_counts()
-
-    # Allocate counts to appropriate regions and their parent regions
-    for region_id, count in total_counts.items():
-        current_id = region_id
-        while current_id != 997 or current_id != 0:
-            i, = np.where(region_ids == current_id)
-            region_counts[i] += count
-            current_id = region_parent_ids[i]
-
-    # Allocate volumes to appropriate regions and their parent regions
-    for i, volume in enumerate(volumes):
-        current_id = unique_regions[i]
-        while current_id != 997 or current_id != 0:
-            j, = np.where(region_ids == current_id)
-            region_volumes[j] += volume
-            current_id = region_parent_ids[j]
+    volumes = trf.label_volumes(annotation_file, ids=hierarchy.ids, 
+                                transform_directory=os.path.join(directory, 'elastix_auto_to_reference'), 
+                                processes=processes) * resolution
+
+    region_counts = hierarchy.count(cells['id'])
+    region_volumes = hierarchy.roll_up(volumes)
 
     # Calculate cell expression densities
-    region_densities = np.divide(region_counts, region_volumes, where=region_volumes!=0)
-    region_densities[region_volumes == 0] = 0
+    region_densities = hierarchy.density(region_counts, region_volumes)
 
     return region_counts, region_volumes, region_densities
 
@@ -418,10 +342,14 @@ def get_region_info(json_path):
     
     
 
-def upscale(directory, source_file, target_shape_file, output_file):
+def upscale(directory, source_file, target_shape_file, output_file=None):
 
     """Upscales atlas images to match experimental data size
     
+    The upscaled image is a virtual source that computes nearest neighbour blocks on 
+    demand from the atlas image, so it can be used for labeling, overlays and block
+    processing without materializing the full resolution volume.
+    
     Arguments
     ---------
         directory : String
@@ -431,79 +359,31 @@ def upscale(directory, source_file, target_shape_file, output_file):
             Path to image to be upscaled
             
         target_shape_file : String
-            Path to image with the target shape
+            Path to image with the target shape, relative to the experimental directory. 
+            If empty, the image is upscaled by a factor of 2
             
-        output_file : String
-            Filename for output image
+        output_file : String or None
+            Optional filename to also write the upscaled image to, plane by plane
 
     Returns
     -------
-        target_rot : array
-            Upscaled image data
+        target : Source
+            Virtual upscaled image
     """
     
-    # Initialization - set parameters
-    source_mm = tiff.imread(source_file) 
-    src_x, src_y, src_z = source_mm.shape[2], \
-                          source_mm.shape[1], \
-                          source_mm.shape[0] # define the source resolution out of the source annotation file
+    import ClearMap.IO.IO as io
+    import ClearMap.IO.Resampled as rsd
 
-    if len(target_shape_file) != 0: # define the resolution for the target file either manuel or match a target file so the annotation can be used as overlay  
-        target_image        = tiff.imread(os.path.join(directory, target_shape_file))
-        tar_x, tar_y, tar_z = target_image.shape[2], target_image.shape[1], target_image.shape[0]
-        del target_image, target_shape_file
+    if len(target_shape_file) != 0: # match a target file so the annotation can be used as overlay
+        target_shape = io.shape(os.path.join(directory, target_shape_file))
     else:
-        tar_x, tar_y, tar_z = src_x*2, src_y*2, src_z*2 #matching resolution
-
-    # 1. STEP: upscale x,y direction and hold z stable
-    starttime = datetime.datetime.now()
-    target_file = os.path.join(directory, "anno_upscaled_to_stitched.npy")
-    target_mm = np.memmap(target_file, dtype="float32", mode="w+", shape=(src_z,tar_y,tar_x)) # create the final upscale file (just reserves the space on HDD)
-
-    for i in range(source_mm.shape[0]):
-        slice = np.array(Image.fromarray(source_mm[i]).resize((tar_x, tar_y), Image.NEAREST))
-        target_mm[i] = slice
-        target_mm.flush()
-        if i!=0 and (round(i/source_mm.shape[0],2)*100)%10 == 0: 
-            print(f"slice {i} of {len(source_mm[:,:,0])} ({round(i*100/source_mm.shape[0],1)}%)")
-
-    print(f"S1 x,y upscale done: {len(source_mm[:,:,0])} slices upscaled in {datetime.datetime.now()-starttime}")
-
-    # 2. STEP: upscale z direction and hold xy stable
-    source_file = os.path.join(directory, "anno_upscaled_to_stitched.npy")
-    source_mm = np.memmap(source_file, dtype="float32", mode="r", shape=(src_z,tar_y,tar_x)) # load the source registration file as mm (write protected) [z,y,x]
-    
-    target_file = os.path.join(directory, "anno_upscaled_to_rot-stitched.npy")
-    target_rot = np.memmap(target_file, dtype="float32", mode="w+", shape=(tar_y,tar_z,tar_x)) # create the final upscale file (just reserves the space on HDD)
+        target_shape = tuple(2*s for s in io.shape(source_file))
 
-    source_mm = np.rot90(source_mm, 1, axes=(0,1))
+    target = rsd.Source(source_file, shape=target_shape)
 
-    starttime2 = datetime.datetime.now()
+    if output_file is not None:
+        with tiff.TiffWriter(os.path.join(directory, output_file), bigtiff=True) as tif:
+            for z in range(target.shape[2]):
+                tif.save(target[:, :, z].T, photometric='minisblack') # min-is-black
 
-    for i in range(source_mm.shape[0]):
-        slice = np.array(Image.fromarray(source_mm[i]).resize((tar_x,tar_z), Image.NEAREST))
-        target_rot[i] = slice
-        target_rot.flush()
-
-        if i!=0 and (round(i*100/source_mm.shape[0]))%20 == 0: 
-            print(f"slice {i} of {len(source_mm[:,:,0])} ({round(i*100/source_mm.shape[0],1)}%)")
-
-    target_rot = np.rot90(target_rot, -1, axes=(0,1))
-    target_rot.flush()
-
-    print(f"{len(source_mm[:,:,0])} slices upscaled in {datetime.datetime.now()-starttime2}")
-
-    # 3. STEP: convert to tif
-    with tiff.TiffWriter(os.path.join(directory, output_file), bigtiff=True) as tif:
-        for i in range(target_rot.shape[0]):
-            tif.save(target_rot[i], photometric='minisblack') # min-is-black
-            if i!=0 and (round(i*100/source_mm.shape[0]))%20 == 0: 
-                print(f"slice {i} of {target_rot.shape[0]} ({round(i*100/target_rot.shape[0],1)}%)")
-
-    # 4. STEP: delete the working files
-    os.remove(target_file)
-    os.remove(source_file)
-
-    print(f"Full processing time: {datetime.datetime.now()-starttime}")
-    
-    return target_rot
\ No newline at end of file
+    return target
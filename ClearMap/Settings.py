@@ -73,6 +73,14 @@ Note
 """
 elastix_path = os.path.join(external_path, 'elastix', 'build')
 
+"""Directory of the cache of elastix registrations, if None alignments are not cached
+
+Note
+----
+  See :func:`ClearMap.Alignment.Elastix.align`.
+"""
+elastix_cache_path = None
+
 """Absolute path to the TeraStitcher installation
 
 Note